@@ -59,6 +59,16 @@ aws_instance_id() {
 }
 
 
+###############################################################################
+# get a tag handed over through user-data, if any
+###############################################################################
+local_get_tag() {
+    if [ -f /tmp/rancher-ci-tags ]; then
+	sed -n -e "s/^$1=//p" /tmp/rancher-ci-tags | head -1
+    fi
+}
+
+
 ###############################################################################
 # get the preferred Docker version from EC2 tag
 ###############################################################################
@@ -67,6 +77,12 @@ ec2_get_tag() {
     local region
     local ec2_tag
 
+    ec2_tag="$(local_get_tag "$1")"
+    if [ -n "${ec2_tag}" ]; then
+	echo "${ec2_tag}"
+	return 0
+    fi
+
     instance_id="$(aws_instance_id)" || exit $?
     region="$(aws_region)" || exit $?
 
@@ -89,6 +105,11 @@ ros_ec2_get_tag() {
     local region
     local ec2_tag
 
+    ec2_tag="$(local_get_tag "$1")"
+    if [ -n "${ec2_tag}" ]; then
+	echo "${ec2_tag}"
+	return 0
+    fi
 
     instance_id="$(sudo docker run --rm melsayed/docker-awscli:latest ec2metadata --instance-id | cut -f2 -d' ')" || exit $?
 
@@ -0,0 +1,150 @@
+import os, time, threading
+
+from .. import log_debug, log_info, yaml, aws_client, cache_path, load_json_cache, save_json_cache
+from .. import boto3_exceptions, botocore_exceptions
+
+
+DEFAULT_CATALOG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'catalog.yaml')
+DEFAULT_CACHE_TTL = 86400
+
+
+#
+class AMICatalogError(RuntimeError):
+    message = None
+
+    def __init__(self, message):
+        self.message = message
+        super(AMICatalogError, self).__init__(self.message)
+
+
+#
+class AMICatalog(object):
+    """
+    Region aware OS -> AMI resolution driven by a YAML catalog.
+
+    AMIs pinned in the catalog are used as-is. Anything else is resolved through
+    a public SSM parameter or describe_images() and cached on disk with a TTL so
+    repeated builds do no lookups at all.
+    """
+
+    #
+    def __init__(self, catalog=None, cachefile=None, ttl=None, client_factory=None):
+        """
+        Args:
+          catalog (str): catalog YAML file, defaults to RANCHER_AMI_CATALOG or the bundled catalog.yaml
+          cachefile (str): JSON file caching looked up AMIs, defaults to .cache/ami.json
+          ttl (int): seconds a looked up AMI stays valid, defaults to RANCHER_AMI_CACHE_TTL or one day
+          client_factory (callable): (service, region) -> boto3 client, defaults to aws_client()
+        """
+        self.catalog = catalog or str(os.environ.get('RANCHER_AMI_CATALOG', DEFAULT_CATALOG)).rstrip()
+        self.cachefile = cachefile or cache_path('ami.json')
+        self.ttl = int(ttl if ttl is not None else os.environ.get('RANCHER_AMI_CACHE_TTL', DEFAULT_CACHE_TTL))
+        self.client_factory = client_factory or aws_client
+
+        self.__entries = None
+        self.__cache = None
+        self.__lock = threading.Lock()
+
+    #
+    def entries(self):
+        if self.__entries is None:
+            try:
+                with open(self.catalog, 'r') as f:
+                    self.__entries = yaml.safe_load(f) or {}
+            except (IOError, yaml.YAMLError) as e:
+                msg = "Failed to load AMI catalog '{}'!: {}".format(self.catalog, str(e))
+                log_debug(msg)
+                raise AMICatalogError(msg) from e
+
+        return self.__entries
+
+    #
+    def entry(self, os_name):
+        try:
+            return self.entries()[os_name]
+        except KeyError:
+            raise AMICatalogError("Unsupported OS specified '{}'!".format(os_name))
+
+    #
+    def __lookup_ssm(self, parameter, region):
+        log_debug("Resolving AMI from SSM parameter '{}' in '{}'...".format(parameter, region))
+        return self.client_factory('ssm', region).get_parameter(Name=parameter)['Parameter']['Value']
+
+    #
+    def __lookup_images(self, images, region):
+        log_debug("Resolving AMI from images owned by '{}' named '{}' in '{}'...".format(images['owner'], images['name'], region))
+
+        response = self.client_factory('ec2', region).describe_images(
+            Owners=[str(images['owner'])],
+            Filters=[{'Name': 'name', 'Values': [images['name']]},
+                     {'Name': 'state', 'Values': ['available']}])
+
+        if 0 == len(response['Images']):
+            return None
+
+        return sorted(response['Images'], key=lambda image: image['CreationDate'])[-1]['ImageId']
+
+    #
+    def __lookup(self, os_name, region):
+        entry = self.entry(os_name)
+        ami = None
+
+        try:
+            if 'ssm' in entry:
+                ami = self.__lookup_ssm(entry['ssm'], region)
+            if ami is None and 'images' in entry:
+                ami = self.__lookup_images(entry['images'], region)
+
+        except (KeyError, botocore_exceptions.ClientError, boto3_exceptions.Boto3Error) as e:
+            msg = "Failed while resolving AMI for '{}' in '{}'!: {}".format(os_name, region, str(e))
+            log_debug(msg)
+            raise AMICatalogError(msg) from e
+
+        if ami is None:
+            raise AMICatalogError("No AMI available for '{}' in region '{}'!".format(os_name, region))
+
+        return ami
+
+    #
+    def ami(self, os_name, region):
+        entry = self.entry(os_name)
+
+        pinned = (entry.get('amis') or {}).get(region)
+        if pinned is not None:
+            return pinned
+
+        key = "{}/{}".format(region, os_name)
+        with self.__lock:
+            if self.__cache is None:
+                self.__cache = load_json_cache(self.cachefile)
+
+            cached = self.__cache.get(key)
+            if cached is not None and time.time() - cached['resolved_at'] < self.ttl:
+                return cached['ami']
+
+            ami = self.__lookup(os_name, region)
+            log_info("Resolved AMI for '{}' in '{}' to '{}'.".format(os_name, region, ami))
+
+            self.__cache[key] = {'ami': ami, 'resolved_at': time.time()}
+            save_json_cache(self.cachefile, self.__cache)
+
+        return ami
+
+    #
+    def settings(self, os_name, region):
+        entry = self.entry(os_name)
+        return {'ami-id': self.ami(os_name, region),
+                'ssh_username': entry['ssh_username'],
+                'family': entry.get('family', 'unknown')}
+
+
+# catalog shared by every caller of os_to_settings() in this process
+_catalog = None
+
+
+#
+def ami_catalog():
+    global _catalog
+    if _catalog is None:
+        _catalog = AMICatalog()
+    return _catalog
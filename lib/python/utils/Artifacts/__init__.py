@@ -0,0 +1,262 @@
+import os, io, gzip, base64, tarfile, hashlib, threading
+
+from concurrent.futures import ThreadPoolExecutor
+from invoke import run, Failure
+
+from .. import log_debug, log_info, cache_path
+from ..SSH import ssh_options
+from ..Deadline import DeadlineError, run_deadline
+
+
+BUNDLE_SOURCE = 'lib/bash'
+BUNDLE_REMOTE_DIR = '/tmp'
+BUNDLE_MARKER = '/tmp/rancher-ci-bundle.sha256'
+BOOTSTRAP_SCRIPT = 'rancher_ci_bootstrap.sh'
+
+# EC2 tag through which a node reports the outcome of its user-data bootstrap
+BOOTSTRAP_TAG = 'rancher.ci.bootstrap'
+
+# EC2 caps user-data at 16 KB before base64 encoding
+USERDATA_LIMIT = 16384
+
+USERDATA_TEMPLATE = '''#!/bin/bash
+# rancher-ci user-data bootstrap, runs as root once the node boots
+
+rancher_ci_signal() {{
+    local instance_id region
+    instance_id="$(curl -s http://169.254.169.254/latest/meta-data/instance-id)"
+    region="$(curl -s http://169.254.169.254/latest/meta-data/placement/availability-zone | sed -e 's/.$//')"
+    if command -v aws > /dev/null 2>&1; then
+        aws ec2 create-tags --region "${{region}}" --resources "${{instance_id}}" --tags "Key={tag},Value=$1"
+    else
+        docker run --rm melsayed/docker-awscli:latest aws ec2 create-tags --region "${{region}}" --resources "${{instance_id}}" --tags "Key={tag},Value=$1"
+    fi
+}}
+
+export HOME=/home/{user}
+
+cat > /tmp/rancher-ci-tags <<'RANCHER_CI_TAGS'
+{tags}
+RANCHER_CI_TAGS
+
+echo '{script}' | base64 -d | gunzip > /tmp/{name}
+chmod +x /tmp/{name}
+
+status=done
+/tmp/{name} || status=failed
+if [ 'done' == "${{status}}" ]; then
+{commands}
+fi
+rancher_ci_signal "${{status}}"
+'''
+
+
+#
+class ArtifactsError(RuntimeError):
+    message = None
+
+    def __init__(self, message):
+        self.message = message
+        super(ArtifactsError, self).__init__(self.message)
+
+
+#
+class Bundle(object):
+    """
+    The bootstrap scripts packed into one gzipped tarball named by its content hash.
+
+    Distribution streams the tarball over a single ssh session per host which
+    compares the hash against a marker file on the node first, so hosts which
+    already hold this bundle transfer nothing. Hosts are handled concurrently.
+    """
+
+    #
+    def __init__(self, srcdir=BUNDLE_SOURCE, max_workers=None):
+        """
+        Args:
+          srcdir (str): directory whose files make up the bundle
+          max_workers (int): concurrent uploads, defaults to RANCHER_ARTIFACT_WORKERS or 8
+        """
+        self.srcdir = srcdir
+        self.max_workers = int(max_workers or os.environ.get('RANCHER_ARTIFACT_WORKERS', 8))
+
+        self.__path = None
+        self.__digest = None
+        self.__lock = threading.Lock()
+
+    #
+    def __members(self):
+        members = []
+        for entry in sorted(os.listdir(self.srcdir)):
+            path = os.path.join(self.srcdir, entry)
+            if os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    members.append((entry, f.read()))
+        return members
+
+    #
+    def __pack(self, members, path):
+        # fixed mtimes and ownership so the same scripts always give the same bytes
+        tmpfile = "{}.tmp.{}".format(path, os.getpid())
+        with open(tmpfile, 'wb') as raw:
+            with gzip.GzipFile(filename='', mode='wb', fileobj=raw, mtime=0) as gz:
+                with tarfile.open(fileobj=gz, mode='w') as tar:
+                    for name, data in members:
+                        info = tarfile.TarInfo(name)
+                        info.size = len(data)
+                        info.mode = 0o755
+                        info.mtime = 0
+                        info.uid = info.gid = 0
+                        info.uname = info.gname = 'root'
+                        tar.addfile(info, io.BytesIO(data))
+        os.replace(tmpfile, path)
+
+    #
+    def build(self):
+        """
+        Returns:
+          tuple: (path of the tarball, its sha256 hex digest)
+        """
+        with self.__lock:
+            if self.__path is not None:
+                return self.__path, self.__digest
+
+            try:
+                members = self.__members()
+                if 0 == len(members):
+                    raise ArtifactsError("No files to bundle in '{}'!".format(self.srcdir))
+
+                sha = hashlib.sha256()
+                for name, data in members:
+                    sha.update(name.encode('utf-8') + b'\0' + hashlib.sha256(data).digest())
+                digest = sha.hexdigest()
+
+                path = cache_path("bundle-{}.tar.gz".format(digest))
+                if not os.path.isfile(path):
+                    self.__pack(members, path)
+                    log_info("Built bootstrap bundle '{}' from {} files in '{}'.".format(path, len(members), self.srcdir))
+                else:
+                    log_debug("Reusing bootstrap bundle '{}'.".format(path))
+
+            except (IOError, OSError, tarfile.TarError) as e:
+                msg = "Failed while building bootstrap bundle from '{}'!: {}".format(self.srcdir, str(e))
+                log_debug(msg)
+                raise ArtifactsError(msg) from e
+
+            self.__path, self.__digest = path, digest
+            return self.__path, self.__digest
+
+    #
+    def __remote_cmd(self, digest):
+        return ('if [ "$(cat {marker} 2>/dev/null)" = "{digest}" ]; then echo skipped; '
+                'else tar -xzf - -C {dir} && echo {digest} > {marker} && echo uploaded; fi').format(
+                    marker=BUNDLE_MARKER, digest=digest, dir=BUNDLE_REMOTE_DIR)
+
+    #
+    def __upload(self, key, addr, user, path, digest, timeout=10, max_attempts=10):
+        sshcmd = "ssh {} {}@{} '{}' < {}".format(ssh_options(key, timeout), user, addr, self.__remote_cmd(digest), path)
+
+        attempts = 0
+        while True:
+            try:
+                attempts += 1
+                log_debug("Running ssh cmd  '{}'...".format(sshcmd))
+                result = run(sshcmd, hide=True)
+                return result.stdout.strip().splitlines()[-1]
+
+            except (Failure, IndexError) as e:
+                if attempts >= max_attempts:
+                    msg = "Failed to deliver bundle to '{}' after {} attempts!: {}".format(addr, attempts, str(e))
+                    log_debug(msg)
+                    raise ArtifactsError(msg) from e
+                log_info("Bundle upload to '{}' failed, attempt {}/{}. Retrying...".format(addr, attempts, max_attempts))
+                run_deadline().sleep(30, "bundle upload to '{}'".format(addr))
+
+    #
+    def distribute(self, hosts, timeout=10, max_attempts=10):
+        """
+        Make sure every host holds the current bundle, unpacked into /tmp.
+
+        Args:
+          hosts (list): (ssh key name, address, ssh user) tuples
+
+        Returns:
+          dict: 'uploaded' or 'skipped' per address
+        """
+        path, digest = self.build()
+        log_info("Distributing bundle {} to {} hosts...".format(digest[:12], len(hosts)))
+
+        results = {}
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(hosts)))) as pool:
+            futures = dict((pool.submit(self.__upload, key, addr, user, path, digest, timeout, max_attempts), addr)
+                           for key, addr, user in hosts)
+            errors = []
+            exceeded = False
+            for future, addr in futures.items():
+                try:
+                    results[addr] = future.result()
+                except ArtifactsError as e:
+                    errors.append(e.message)
+                except DeadlineError as e:
+                    errors.append("{}: {}".format(addr, e.message))
+                    exceeded = True
+
+        if exceeded:
+            run_deadline().log_report()
+        if 0 != len(errors):
+            raise ArtifactsError("Bundle distribution failed for {} of {} hosts!: {}".format(len(errors), len(hosts), ' :: '.join(errors)))
+
+        skipped = len([r for r in results.values() if 'skipped' == r])
+        log_info("Bundle {} uploaded to {} hosts, {} already had it.".format(digest[:12], len(results) - skipped, skipped))
+        return results
+
+
+#
+def bootstrap_userdata(tags, ssh_user, commands=None, srcdir=BUNDLE_SOURCE):
+    """
+    User-data which runs the bootstrap script while the node boots, then any extra
+    commands, and finally sets the rancher.ci.bootstrap tag to 'done' or 'failed'.
+
+    Args:
+      tags (list): EC2 tags ({'Key': .., 'Value': ..}) the script would otherwise query
+      ssh_user (str): login user of the AMI, whose home the script populates
+      commands (list): shell commands run as root after a successful bootstrap
+
+    Returns:
+      str: the user-data script
+    """
+    try:
+        packed = io.BytesIO()
+        with open(os.path.join(srcdir, BOOTSTRAP_SCRIPT), 'rb') as f:
+            with gzip.GzipFile(filename='', mode='wb', fileobj=packed, mtime=0) as gz:
+                gz.write(f.read())
+        script = base64.b64encode(packed.getvalue()).decode('ascii')
+    except (IOError, OSError) as e:
+        msg = "Failed while reading bootstrap script from '{}'!: {}".format(srcdir, str(e))
+        log_debug(msg)
+        raise ArtifactsError(msg) from e
+
+    userdata = USERDATA_TEMPLATE.format(
+        tag=BOOTSTRAP_TAG,
+        user=ssh_user,
+        tags='\n'.join("{}={}".format(tag['Key'], tag['Value']) for tag in tags),
+        script=script,
+        name=BOOTSTRAP_SCRIPT,
+        commands='\n'.join("    {} || status=failed".format(cmd) for cmd in (commands or [':'])))
+
+    if len(userdata) > USERDATA_LIMIT:
+        raise ArtifactsError("Bootstrap user-data is {} bytes, more than the EC2 limit of {}!".format(len(userdata), USERDATA_LIMIT))
+
+    return userdata
+
+
+# bundle shared by every stage in this process so it is built once per run
+_bundle = None
+
+
+#
+def bootstrap_bundle():
+    global _bundle
+    if _bundle is None:
+        _bundle = Bundle()
+    return _bundle
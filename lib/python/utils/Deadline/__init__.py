@@ -0,0 +1,170 @@
+import os, time, threading
+
+from contextlib import contextmanager
+
+from .. import log_debug, log_info
+
+
+# seconds 'pipeline' and 'matrix' get for all of their waiting unless RANCHER_CI_DEADLINE
+# says otherwise, 0 for no limit
+DEFAULT_BUDGET = 7200
+
+# waits listed when the budget runs out
+REPORT_TOP = 5
+
+# seconds between polls of the boto3 instance and volume waiters
+WAITER_DELAY = 15
+
+
+#
+class DeadlineError(RuntimeError):
+    message = None
+
+    def __init__(self, message):
+        self.message = message
+        super(DeadlineError, self).__init__(self.message)
+
+
+#
+class Deadline(object):
+    """
+    One time budget for every wait and retry loop of a task or pipeline run.
+
+    Waits take at most what is left of the budget, and once it is spent the next
+    wait fails straight away, listing where the time went, instead of every
+    loop running into its own timeout one after the other.
+    """
+
+    #
+    def __init__(self, budget=None):
+        """
+        Args:
+          budget (float): seconds from now, None or 0 for no limit
+        """
+        self.budget = budget or None
+        self.start = time.time()
+        self.expires = None if self.budget is None else self.start + self.budget
+
+        self.__spent = {}
+        self.__lock = threading.Lock()
+
+    #
+    def remaining(self):
+        if self.expires is None:
+            return float('inf')
+        return max(0.0, self.expires - time.time())
+
+    #
+    def record(self, what, seconds):
+        with self.__lock:
+            count, total = self.__spent.get(what, (0, 0.0))
+            self.__spent[what] = (count + 1, total + seconds)
+
+    #
+    def report(self, top=None):
+        """
+        Returns:
+          list: (what, times waited, seconds) for the longest waits first
+        """
+        with self.__lock:
+            spent = sorted(((what, count, total) for what, (count, total) in self.__spent.items()),
+                           key=lambda item: -item[2])
+        return spent[:top] if top else spent
+
+    #
+    def __exceeded(self, what):
+        waits = ', '.join("{} {:.0f}s/{}x".format(w, total, count) for w, count, total in self.report(REPORT_TOP))
+        msg = "Deadline of {:.0f}s exceeded while waiting for {}! Time went to: {}".format(
+            self.budget, what, waits or 'nothing recorded')
+        log_debug(msg)
+        return DeadlineError(msg)
+
+    #
+    def check(self, what):
+        if 0 >= self.remaining():
+            raise self.__exceeded(what)
+
+    #
+    def clamp(self, timeout, what):
+        """
+        Returns:
+          float: 'timeout' cut down to what is left of the budget
+        """
+        self.check(what)
+        return min(timeout, self.remaining())
+
+    #
+    def sleep(self, seconds, what):
+        """
+        Sleep 'seconds', or what is left of the budget if that is less, and raise once it is spent.
+        """
+        seconds = self.clamp(seconds, what)
+        time.sleep(seconds)
+        self.record(what, seconds)
+        self.check(what)
+
+    #
+    @contextmanager
+    def span(self, what):
+        # account a blocking call, e.g. a boto3 waiter, which can not sleep through us
+        self.check(what)
+        start = time.time()
+        try:
+            yield self.remaining()
+        finally:
+            self.record(what, time.time() - start)
+
+    #
+    def log_report(self):
+        elapsed = time.time() - self.start
+        log_info("Waited in {} places over {:.0f}s, {} left.".format(
+            len(self.report()), elapsed, 'no limit' if self.expires is None else "{:.0f}s".format(self.remaining())))
+        for what, count, total in self.report(REPORT_TOP):
+            log_info("    {:<60} {:>4}x {:>8.1f}s".format(what[:60], count, total))
+
+
+#
+def waiter_config(remaining, delay=WAITER_DELAY):
+    """
+    WaiterConfig polling a boto3 waiter for no longer than 'remaining' seconds, e.g. as yielded by Deadline.span().
+
+    Returns:
+      dict: 'Delay' and, unless there is no limit, 'MaxAttempts' fitting the budget
+    """
+    config = {'Delay': delay}
+    if remaining != float('inf'):
+        config['MaxAttempts'] = max(1, int(remaining // delay))
+    return config
+
+
+# deadline shared by every stage and thread of this process
+_deadline = None
+_deadline_lock = threading.Lock()
+
+
+#
+def _budget():
+    return float(str(os.environ.get('RANCHER_CI_DEADLINE', DEFAULT_BUDGET)).rstrip() or 0)
+
+
+#
+def start_deadline(budget=None):
+    """
+    Start a fresh budget for this process, RANCHER_CI_DEADLINE seconds unless 'budget' is given.
+
+    Only the tasks which run a whole pipeline start one, every other task waits
+    without a limit beyond each call's own timeout.
+    """
+    global _deadline
+    with _deadline_lock:
+        _deadline = Deadline(_budget() if budget is None else budget)
+        return _deadline
+
+
+#
+def run_deadline():
+    global _deadline
+    with _deadline_lock:
+        if _deadline is None:
+            _deadline = Deadline(None)
+        return _deadline
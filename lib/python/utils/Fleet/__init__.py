@@ -0,0 +1,222 @@
+import base64
+
+from .. import log_debug, log_info, log_warn, aws_client, ec2_compute_tags, ec2_launch_spec
+from .. import boto3_exceptions, botocore_exceptions
+from ..Deadline import run_deadline, waiter_config
+from ..Inventory import node_index
+from ..Placement import parse_instance_types, CAPACITY_ERRORS
+
+
+CAPACITY_TYPES = ['on-demand', 'spot']
+
+
+#
+class FleetError(RuntimeError):
+    message = None
+
+    def __init__(self, message):
+        self.message = message
+        super(FleetError, self).__init__(self.message)
+
+
+#
+class Fleet(object):
+    """
+    Launch a batch of identically configured nodes through one EC2 Fleet request.
+
+    The fleet may use any of a ranked list of instance types in any of the
+    scheduler's placements, on-demand or spot. Whatever spot capacity is missing
+    is topped up on-demand.
+
+    EC2 Fleet does not let overrides pick the subnet of a network interface, so
+    the launch template has one version per placement, each with its subnet set
+    on the interface, and the overrides only pick the instance type.
+    """
+
+    #
+    def __init__(self, name, scheduler, instance_types, capacity='on-demand', config=None):
+        """
+        Args:
+          name (str): fleet name, used for the launch template
+          scheduler (PlacementScheduler): supplies the subnets and records outcomes
+          instance_types (str|list): ranked instance types, a list or comma separated
+          capacity (str): 'on-demand' or 'spot'
+          config (RunConfig): cluster the nodes belong to, for their tags
+        """
+        if capacity not in CAPACITY_TYPES:
+            raise FleetError("Unsupported capacity type '{}'! Choose one of: {}".format(capacity, ', '.join(CAPACITY_TYPES)))
+
+        self.name = name
+        self.scheduler = scheduler
+        self.region = scheduler.region
+        self.instance_types = parse_instance_types(instance_types)
+        self.capacity = capacity
+        self.config = config
+        self.ec2 = aws_client('ec2', self.region)
+
+    #
+    def __create_launch_template(self, os_settings, keyname, userdata=None):
+        """
+        Returns:
+          tuple: (launch template id, template version per placement)
+        """
+        launch_spec = ec2_launch_spec(os_settings)
+        self.__delete_launch_template()
+
+        # every instance carries the fleet's tags from the start, all but its Name, so
+        # one which is never named can still be found through the run tag
+        tags = [tag for tag in ec2_compute_tags(self.name, self.config) if 'Name' != tag['Key']]
+
+        data = {
+            'ImageId': os_settings['ami-id'],
+            'KeyName': keyname,
+            'IamInstanceProfile': launch_spec['IamInstanceProfile'],
+            'BlockDeviceMappings': launch_spec['BlockDeviceMappings'],
+            'TagSpecifications': [{'ResourceType': 'instance', 'Tags': tags}],
+        }
+
+        # unlike run_instances(), launch templates want the user-data base64 encoded already
+        if userdata is not None:
+            data['UserData'] = base64.b64encode(userdata.encode('utf-8')).decode('ascii')
+
+        template_id = None
+        versions = []
+        for zone, subnet in self.scheduler.placements:
+            data['NetworkInterfaces'] = [dict(launch_spec['NetworkInterface'], SubnetId=subnet)]
+            if template_id is None:
+                template = self.ec2.create_launch_template(LaunchTemplateName=self.name, LaunchTemplateData=data)
+                template_id = template['LaunchTemplate']['LaunchTemplateId']
+                version = template['LaunchTemplate']['LatestVersionNumber']
+            else:
+                version = self.ec2.create_launch_template_version(
+                    LaunchTemplateId=template_id, LaunchTemplateData=data)['LaunchTemplateVersion']['VersionNumber']
+            versions.append(((zone, subnet), str(version)))
+
+        return template_id, versions
+
+    #
+    def __delete_launch_template(self):
+        try:
+            self.ec2.delete_launch_template(LaunchTemplateName=self.name)
+        except botocore_exceptions.ClientError as e:
+            log_debug("No launch template '{}' to delete: {}".format(self.name, str(e)))
+
+    #
+    def __overrides(self):
+        # lower priority value wins for on-demand 'prioritized' allocation
+        return [{'InstanceType': instance_type, 'Priority': float(rank)} for rank, instance_type in enumerate(self.instance_types)]
+
+    #
+    def __request(self, template_id, versions, count, capacity):
+        log_info("Requesting {} '{}' instances of {} for fleet '{}'...".format(count, capacity, self.instance_types, self.name))
+
+        response = self.ec2.create_fleet(
+            Type='instant',
+            LaunchTemplateConfigs=[{
+                'LaunchTemplateSpecification': {'LaunchTemplateId': template_id, 'Version': version},
+                'Overrides': self.__overrides(),
+            } for placement, version in versions],
+            TargetCapacitySpecification={'TotalTargetCapacity': count, 'DefaultTargetCapacityType': capacity},
+            OnDemandOptions={'AllocationStrategy': 'prioritized'},
+            SpotOptions={'AllocationStrategy': 'capacity-optimized'})
+
+        zones = dict((version, zone) for (zone, subnet), version in versions)
+
+        def zone_of(item):
+            return zones.get(str(item.get('LaunchTemplateAndOverrides', {}).get('LaunchTemplateSpecification', {}).get('Version')))
+
+        for error in response.get('Errors', []):
+            overrides = error.get('LaunchTemplateAndOverrides', {}).get('Overrides', {})
+            zone = zone_of(error)
+            log_warn("Fleet '{}' could not use '{}' in '{}{}': {} :: {}".format(
+                self.name, overrides.get('InstanceType'), self.region, zone, error.get('ErrorCode'), error.get('ErrorMessage')))
+            if error.get('ErrorCode') in CAPACITY_ERRORS and zone is not None:
+                self.scheduler.record(zone, overrides.get('InstanceType'), 'capacity')
+
+        launched = []
+        for group in response.get('Instances', []):
+            for instance_id in group['InstanceIds']:
+                launched.append({'id': instance_id,
+                                 'type': group['InstanceType'],
+                                 'lifecycle': group['Lifecycle'],
+                                 'zone': zone_of(group)})
+        return launched
+
+    #
+    def __terminate(self, nodes):
+        if 0 == len(nodes):
+            return
+        log_warn("Terminating {} instances of failed fleet '{}'...".format(len(nodes), self.name))
+        try:
+            self.ec2.terminate_instances(InstanceIds=[node['id'] for node in nodes])
+        except botocore_exceptions.ClientError as e:
+            log_warn("Could not terminate the instances of fleet '{}', the reaper will: {}".format(self.name, str(e)))
+
+    #
+    def launch(self, nodenames, os_settings, keyname, userdata=None):
+        """
+        Launch one instance per name, tag it with that name and wait for all to run.
+
+        Every instance gets the same user-data, so it must not depend on the node name.
+
+        Returns:
+          list: dicts with 'name', 'id', 'type', 'lifecycle' and 'zone' of each node
+        """
+        capacities = [self.capacity]
+        if 'spot' == self.capacity:
+            capacities.append('on-demand')
+
+        launched = []
+        try:
+            template_id, versions = self.__create_launch_template(os_settings, keyname, userdata)
+
+            for capacity in capacities:
+                missing = len(nodenames) - len(launched)
+                if 0 == missing:
+                    break
+                launched += self.__request(template_id, versions, missing, capacity)
+
+            if len(launched) < len(nodenames):
+                msg = "Fleet '{}' only got {} of {} instances!".format(self.name, len(launched), len(nodenames))
+                log_debug(msg)
+                raise FleetError(msg)
+
+            for nodename, node in zip(nodenames, launched):
+                node['name'] = nodename
+                self.ec2.create_tags(Resources=[node['id']], Tags=ec2_compute_tags(nodename, self.config))
+                node_index(self.region).discard(nodename)
+                self.scheduler.record(node['zone'], node['type'], 'ok', nodename)
+
+            log_info("Waiting for {} fleet instances to enter state 'running'...".format(len(launched)))
+            with run_deadline().span("fleet '{}' to run".format(self.name)) as remaining:
+                self.ec2.get_waiter('instance_running').wait(InstanceIds=[node['id'] for node in launched],
+                                                             WaiterConfig=waiter_config(remaining))
+
+        except FleetError:
+            self.__terminate(launched)
+            raise
+
+        except (botocore_exceptions.ClientError, botocore_exceptions.WaiterError, boto3_exceptions.Boto3Error) as e:
+            self.__terminate(launched)
+            msg = "Failed while launching fleet '{}'!: {}".format(self.name, str(e))
+            log_debug(msg)
+            raise FleetError(msg) from e
+
+        finally:
+            self.__delete_launch_template()
+
+        log_info("Fleet '{}' instance mix: {}".format(self.name, self.mix(launched)))
+        return launched
+
+    #
+    @staticmethod
+    def mix(nodes):
+        """
+        Returns:
+          dict: number of nodes per '<instance type>/<lifecycle>'
+        """
+        counts = {}
+        for node in nodes:
+            key = "{}/{}".format(node['type'], node['lifecycle'])
+            counts[key] = counts.get(key, 0) + 1
+        return counts
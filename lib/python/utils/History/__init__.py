@@ -0,0 +1,253 @@
+import os, time, sqlite3, threading
+
+from collections import OrderedDict
+
+from .. import log_debug, log_info
+
+
+# SQLite file under WORKSPACE_DIR which outlives the builds of a job
+HISTORY_FILE = 'ci-history.sqlite'
+
+# columns of 'runs' results can be grouped by
+DIMENSIONS = ['rancher_version', 'docker_version', 'orchestration', 'server_os', 'agent_os', 'label']
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    build TEXT,
+    label TEXT NOT NULL DEFAULT '',
+    started REAL NOT NULL,
+    rancher_version TEXT,
+    docker_version TEXT,
+    orchestration TEXT,
+    server_os TEXT,
+    agent_os TEXT
+);
+CREATE TABLE IF NOT EXISTS stage_timings (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    stage TEXT NOT NULL,
+    seconds REAL NOT NULL,
+    exit_code INTEGER NOT NULL,
+    PRIMARY KEY (run_id, stage)
+);
+CREATE TABLE IF NOT EXISTS test_timings (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    module TEXT NOT NULL,
+    classname TEXT NOT NULL,
+    name TEXT NOT NULL,
+    seconds REAL NOT NULL,
+    outcome TEXT NOT NULL,
+    PRIMARY KEY (run_id, classname, name)
+);
+CREATE INDEX IF NOT EXISTS test_timings_module ON test_timings (module);
+CREATE INDEX IF NOT EXISTS runs_build ON runs (build, label);
+'''
+
+
+#
+class HistoryError(RuntimeError):
+    message = None
+
+    def __init__(self, message):
+        self.message = message
+        super(HistoryError, self).__init__(self.message)
+
+
+#
+def percentile(values, q):
+    """
+    Percentile 'q' (0..1) of 'values' by linear interpolation between the closest ranks.
+    """
+    values = sorted(values)
+    if 0 == len(values):
+        return None
+    pos = (len(values) - 1) * q
+    lower = int(pos)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (pos - lower)
+
+
+#
+class History(object):
+    """
+    Test and provisioning timings of every build, kept in SQLite.
+
+    A run is one build of one cluster, identified by BUILD_NUMBER and the matrix
+    label, and remembers the versions and OSes it ran with so timings can be
+    compared across them. Connections are shared between threads behind a lock.
+    """
+
+    #
+    def __init__(self, path):
+        self.path = path
+        self.__lock = threading.Lock()
+
+        try:
+            self.__db = sqlite3.connect(path, check_same_thread=False)
+            self.__db.executescript(SCHEMA)
+            self.__db.commit()
+        except sqlite3.Error as e:
+            msg = "Failed while opening history '{}'!: {}".format(path, str(e))
+            log_debug(msg)
+            raise HistoryError(msg) from e
+
+    #
+    def __execute(self, sql, params=(), many=False):
+        with self.__lock:
+            try:
+                if many:
+                    cursor = self.__db.executemany(sql, params)
+                else:
+                    cursor = self.__db.execute(sql, params)
+                rows = cursor.fetchall()
+                self.__db.commit()
+                return rows, cursor.lastrowid
+            except sqlite3.Error as e:
+                self.__db.rollback()
+                msg = "History query failed!: {} :: {}".format(str(e), sql.strip().splitlines()[0])
+                log_debug(msg)
+                raise HistoryError(msg) from e
+
+    #
+    def record_run(self, config):
+        """
+        Returns:
+          int: id of the run for 'config', created unless this build already recorded it
+        """
+        label = config.label or ''
+        if config.build_number:
+            rows, _ = self.__execute('SELECT id FROM runs WHERE build = ? AND label = ?', (config.build_number, label))
+            if 0 != len(rows):
+                return rows[0][0]
+
+        _, run_id = self.__execute(
+            'INSERT INTO runs (build, label, started, rancher_version, docker_version, orchestration, server_os, agent_os) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (config.build_number, label, time.time(), config.rancher_version, config.docker_version,
+             config.orchestration, config.server_os, config.agent_os))
+        log_debug("Recording timings as run {} of build '{}'.".format(run_id, config.build_number))
+        return run_id
+
+    #
+    def record_stages(self, run_id, stages):
+        """
+        Args:
+          stages (dict): {'exit_code': .., 'elapsed': ..} per stage name, as kept by Pipeline
+        """
+        self.__execute('INSERT OR REPLACE INTO stage_timings (run_id, stage, seconds, exit_code) VALUES (?, ?, ?, ?)',
+                       [(run_id, stage, result['elapsed'], result['exit_code']) for stage, result in stages.items()],
+                       many=True)
+
+    #
+    def record_tests(self, run_id, cases):
+        """
+        Args:
+          cases (list): (classname, name, seconds, outcome) per test case
+        """
+        from ..Shards import module_key
+
+        self.__execute('INSERT OR REPLACE INTO test_timings (run_id, module, classname, name, seconds, outcome) '
+                       'VALUES (?, ?, ?, ?, ?, ?)',
+                       [(run_id, module_key(classname), classname, name, seconds, outcome)
+                        for classname, name, seconds, outcome in cases],
+                       many=True)
+        log_info("Recorded {} test timings for run {}.".format(len(cases), run_id))
+
+    #
+    def ingest_junit(self, run_id, filename):
+        from ..Shards import ShardsError, parse_junit
+
+        try:
+            cases = parse_junit(filename)
+        except ShardsError as e:
+            raise HistoryError(e.message) from e
+        self.record_tests(run_id, cases)
+        return len(cases)
+
+    #
+    def module_durations(self, runs=5):
+        """
+        Returns:
+          dict: median duration per test module over the last 'runs' runs which ran it
+        """
+        rows, _ = self.__execute(
+            'SELECT module, run_id, SUM(seconds) FROM test_timings '
+            'WHERE outcome != ? GROUP BY module, run_id ORDER BY module, run_id DESC', ('skipped',))
+
+        samples = {}
+        for module, run_id, seconds in rows:
+            if len(samples.setdefault(module, [])) < runs:
+                samples[module].append(seconds)
+        return dict((module, percentile(values, 0.5)) for module, values in samples.items())
+
+    #
+    def __samples(self, kind, dimension):
+        if dimension not in DIMENSIONS:
+            raise HistoryError("Cannot group timings by '{}'! Choose one of: {}".format(dimension, ', '.join(DIMENSIONS)))
+
+        if 'stage' == kind:
+            sql = ('SELECT t.stage, r.{0}, t.seconds FROM stage_timings t JOIN runs r ON r.id = t.run_id '
+                   'WHERE t.exit_code = 0 ORDER BY r.started').format(dimension)
+        elif 'test' == kind:
+            sql = ('SELECT t.module, r.{0}, SUM(t.seconds) FROM test_timings t JOIN runs r ON r.id = t.run_id '
+                   "WHERE t.outcome != 'skipped' GROUP BY t.run_id, t.module ORDER BY MIN(r.started)").format(dimension)
+        else:
+            raise HistoryError("Unknown timing kind '{}'! Choose one of: stage, test".format(kind))
+
+        rows, _ = self.__execute(sql)
+        return rows
+
+    #
+    def percentiles(self, kind='stage', dimension='docker_version', q=0.9):
+        """
+        Returns:
+          dict: {name: [(dimension value, runs, percentile q of seconds), ...]} with the
+                values in the order they first appeared
+        """
+        grouped = {}
+        for name, value, seconds in self.__samples(kind, dimension):
+            values = grouped.setdefault(name, OrderedDict())
+            values.setdefault(value, []).append(seconds)
+
+        result = {}
+        for name, values in grouped.items():
+            result[name] = [(value, len(seconds), percentile(seconds, q)) for value, seconds in values.items()]
+        return result
+
+    #
+    def regressions(self, kind='stage', dimension='docker_version', q=0.9, threshold=0.4, min_runs=3):
+        """
+        Compare each dimension value against the one before it, e.g. 'rancher_agents.provision
+        p90 up 40% since docker_version 17.03.2'.
+
+        Returns:
+          list: (name, previous value, value, previous seconds, seconds, relative change) for
+                every change of at least 'threshold', both sides backed by 'min_runs' runs
+        """
+        found = []
+        for name, values in sorted(self.percentiles(kind, dimension, q).items()):
+            values = [v for v in values if v[1] >= min_runs]
+            for (before, _, old), (after, _, new) in zip(values, values[1:]):
+                if old and (new - old) / old >= threshold:
+                    found.append((name, before, after, old, new, (new - old) / old))
+        return found
+
+    #
+    def close(self):
+        with self.__lock:
+            self.__db.close()
+
+
+# history shared by every stage and thread of this process
+_history = None
+_history_lock = threading.Lock()
+
+
+#
+def run_history(workspace=None):
+    global _history
+    with _history_lock:
+        if _history is None:
+            workspace = workspace or str(os.environ.get('WORKSPACE_DIR', os.getcwd())).rstrip()
+            _history = History(os.path.join(workspace, HISTORY_FILE))
+        return _history
@@ -0,0 +1,275 @@
+import os, re, time, threading
+
+from .. import log_debug, aws_get_region
+from .. import boto3_exceptions, botocore_exceptions
+from ..RateLimit import throttled_client
+
+
+# states of instances a lookup by name is interested in, in order of preference
+LIVE_STATES = ['running', 'pending']
+INDEXED_STATES = LIVE_STATES + ['stopping', 'stopped']
+
+# results per describe call, so a page stays small however large the account is
+PAGE_SIZE = 200
+
+# EC2 accepts at most 200 values per filter
+MAX_FILTER_VALUES = 200
+
+# states an instance only passes through, so a record in one of them is soon out of date
+TRANSIENT_STATES = ['pending', 'stopping', 'shutting-down']
+
+# seconds an indexed name, or the lack of one, is trusted before it is described again
+INDEX_TTL = 60
+
+
+#
+class InventoryError(RuntimeError):
+    message = None
+
+    def __init__(self, message):
+        self.message = message
+        super(InventoryError, self).__init__(self.message)
+
+
+#
+def run_prefix():
+    prefix = os.environ.get('AWS_PREFIX')
+    if prefix is None:
+        return ''
+    return "{}-".format(prefix.replace('.', '-')).rstrip()
+
+
+# node names end in '-server<N>' or '-agent<N>'
+ROLE_PATTERN = re.compile(r'-(server|agent)\d*$')
+
+
+#
+class NodeRecord(object):
+    """
+    What we keep of an EC2 instance: built once from a describe response and
+    passed around instead of the raw boto3 dicts.
+    """
+
+    __slots__ = ('name', 'id', 'state', 'public_ip', 'private_ip', 'zone', 'tags', 'role', 'launched')
+
+    #
+    def __init__(self, name, id, state, public_ip=None, private_ip=None, zone=None, tags=None, role=None, launched=None):
+        self.name = name
+        self.id = id
+        self.state = state
+        self.public_ip = public_ip
+        self.private_ip = private_ip
+        self.zone = zone
+        self.tags = tags or {}
+        self.role = role
+        self.launched = launched
+
+    #
+    @classmethod
+    def from_instance(cls, instance):
+        tags = dict((tag['Key'], tag['Value']) for tag in instance.get('Tags', []))
+        name = tags.get('Name')
+        match = ROLE_PATTERN.search(name or '')
+        launched = instance.get('LaunchTime')
+
+        return cls(name,
+                   instance['InstanceId'],
+                   instance['State']['Name'],
+                   public_ip=instance.get('PublicIpAddress'),
+                   private_ip=instance.get('PrivateIpAddress'),
+                   zone=instance.get('Placement', {}).get('AvailabilityZone'),
+                   tags=tags,
+                   role=match.group(1) if match else None,
+                   launched=launched.timestamp() if launched is not None else None)
+
+    #
+    def __repr__(self):
+        return "NodeRecord({}, {}, {}, {})".format(self.name, self.id, self.state, self.public_ip)
+
+
+#
+def volume_record(volume):
+    """
+    The parts of a describe_volumes() volume we care about, with the tags as a dict.
+    """
+    tags = dict((tag['Key'], tag['Value']) for tag in volume.get('Tags', []))
+    return {'name': tags.get('Name'),
+            'id': volume['VolumeId'],
+            'state': volume['State'],
+            'size': volume.get('Size'),
+            'zone': volume.get('AvailabilityZone'),
+            'attachments': [a['InstanceId'] for a in volume.get('Attachments', [])],
+            'tags': tags}
+
+
+#
+def iter_instances(filters, region=None):
+    """
+    Lazily yield a record for every instance matching the server side 'filters',
+    one page of PAGE_SIZE instances at a time.
+    """
+    paginator = throttled_client('ec2', region).get_paginator('describe_instances')
+    for page in paginator.paginate(Filters=filters, PaginationConfig={'PageSize': PAGE_SIZE}):
+        for reservation in page['Reservations']:
+            for instance in reservation['Instances']:
+                yield NodeRecord.from_instance(instance)
+
+
+#
+def iter_volumes(filters, region=None):
+    """
+    Lazily yield a record for every EBS volume matching the server side 'filters'.
+    """
+    paginator = throttled_client('ec2', region).get_paginator('describe_volumes')
+    for page in paginator.paginate(Filters=filters, PaginationConfig={'PageSize': PAGE_SIZE}):
+        for volume in page['Volumes']:
+            yield volume_record(volume)
+
+
+#
+class NodeIndex(object):
+    """
+    In-memory index of this run's nodes by Name tag.
+
+    The index is filled from one paginated describe_instances() of every node
+    whose name starts with the run prefix (AWS_PREFIX) and refreshed whenever a
+    lookup misses, so a burst of lookups after launching many nodes costs one
+    describe call rather than one per node.
+
+    A name is described again once its entry is older than INDEX_TTL, or when a
+    lookup wants other states than a transient one the node was last seen in,
+    e.g. 'running' for a node indexed while 'pending'.
+    """
+
+    #
+    def __init__(self, region, prefix=''):
+        self.region = region
+        self.prefix = prefix
+
+        self.__nodes = None
+        self.__read = {}
+        self.__lock = threading.Lock()
+
+    #
+    def __describe(self, names):
+        node_filter = [
+            {'Name': 'tag:Name', 'Values': names},
+            {'Name': 'instance-state-name', 'Values': INDEXED_STATES}
+        ]
+
+        nodes = {}
+        try:
+            for record in iter_instances(node_filter, self.region):
+                if record.name is not None:
+                    nodes.setdefault(record.name, []).append(record)
+
+        except (botocore_exceptions.ClientError, boto3_exceptions.Boto3Error) as e:
+            msg = "Failed while indexing nodes named '{}'!: {}".format(', '.join(names), str(e))
+            log_debug(msg)
+            raise InventoryError(msg) from e
+
+        return nodes
+
+    #
+    def refresh(self, name=None):
+        """
+        Re-read every node of the run prefix, or only 'name' when it lies outside the prefix.
+        """
+        if name is not None and not name.startswith(self.prefix):
+            nodes = self.__describe([name])
+            with self.__lock:
+                if self.__nodes is None:
+                    self.__nodes = {}
+                self.__nodes[name] = nodes.get(name, [])
+                self.__read[name] = time.time()
+            return
+
+        nodes = self.__describe([self.prefix + '*'])
+        log_debug("Indexed {} nodes named '{}*' in '{}'.".format(len(nodes), self.prefix, self.region))
+        with self.__lock:
+            self.__nodes = nodes
+            self.__read = dict.fromkeys(nodes, time.time())
+
+    #
+    def __fresh(self, name, states):
+        # caller holds the lock
+        if self.__nodes is None or name not in self.__nodes:
+            return False
+        if time.time() - self.__read.get(name, 0) > INDEX_TTL:
+            return False
+        return not any(r.state in TRANSIENT_STATES and r.state not in states for r in self.__nodes[name])
+
+    #
+    def find(self, name, states=LIVE_STATES):
+        """
+        Returns:
+          list: records of every node called 'name' in one of 'states', most preferred state first
+        """
+        with self.__lock:
+            fresh = self.__fresh(name, states)
+        if not fresh:
+            self.refresh(name)
+
+        with self.__lock:
+            # remember misses too, until INDEX_TTL runs out or launching a node discards its name again
+            if name not in self.__nodes:
+                self.__nodes[name] = []
+                self.__read[name] = time.time()
+            records = [r for r in self.__nodes[name] if r.state in states]
+        return sorted(records, key=lambda r: states.index(r.state))
+
+    #
+    def get(self, name, states=LIVE_STATES):
+        """
+        Returns:
+          NodeRecord: the node called 'name', None when there is no such node
+        """
+        records = self.find(name, states)
+        if 0 == len(records):
+            return None
+        return records[0]
+
+    #
+    def resolve(self, node):
+        """
+        Returns:
+          NodeRecord: 'node' itself when it already is a record, otherwise the live node of that name
+        """
+        if isinstance(node, NodeRecord):
+            return node
+        return self.get(node)
+
+    #
+    def public_ip(self, node):
+        record = self.resolve(node)
+        name = record.name if record is not None else node
+
+        # pending nodes get their public IP a little later
+        if record is not None and record.public_ip is None:
+            self.refresh(name)
+            record = self.get(name)
+
+        if record is None or record.public_ip is None:
+            raise InventoryError("No public IP address found for node '{}'!".format(name))
+        return record.public_ip
+
+    #
+    def discard(self, name):
+        with self.__lock:
+            if self.__nodes is not None:
+                self.__nodes.pop(name, None)
+            self.__read.pop(name, None)
+
+
+# one index per region, shared by every stage of a run
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+#
+def node_index(region=None):
+    region = region or aws_get_region()
+    with _indexes_lock:
+        if region not in _indexes:
+            _indexes[region] = NodeIndex(region, run_prefix())
+        return _indexes[region]
@@ -0,0 +1,215 @@
+import os, hashlib, threading
+
+from .. import log_debug, log_info, aws_client, aws_get_region
+from .. import boto3_exceptions, botocore_exceptions
+from ..Inventory import run_prefix
+
+
+# local directory holding the private and public key files
+KEY_DIR = '.ssh'
+
+KEY_BITS = 2048
+
+
+#
+class KeyPairError(RuntimeError):
+    message = None
+
+    def __init__(self, message):
+        self.message = message
+        super(KeyPairError, self).__init__(self.message)
+
+
+#
+def key_path(name):
+    return os.path.join(KEY_DIR, name)
+
+
+#
+class RunKeyPair(object):
+    """
+    The one ssh keypair every node of a run is launched with.
+
+    The key is generated in-process on first use and kept under .ssh/ so later
+    stages of the same run find it again. It is imported into each region once,
+    and only when the fingerprint AWS holds for the name differs from ours, then
+    deleted from every region it was used in when the run is torn down.
+    """
+
+    #
+    def __init__(self, name, keydir=KEY_DIR):
+        self.name = name
+        self.keydir = keydir
+        self.path = os.path.join(keydir, name)
+
+        self.__key = None
+        self.__regions = set()
+        self.__lock = threading.Lock()
+        self.__ensure_lock = threading.Lock()
+
+    #
+    def __load_or_generate(self):
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+
+        if os.path.isfile(self.path):
+            log_debug("Reusing ssh key '{}'.".format(self.path))
+            with open(self.path, 'rb') as f:
+                return serialization.load_pem_private_key(f.read(), password=None, backend=default_backend())
+
+        log_info("Generating ssh key '{}'...".format(self.path))
+        key = rsa.generate_private_key(public_exponent=65537, key_size=KEY_BITS, backend=default_backend())
+
+        os.makedirs(self.keydir, exist_ok=True)
+        private = key.private_bytes(serialization.Encoding.PEM,
+                                    serialization.PrivateFormat.TraditionalOpenSSL,
+                                    serialization.NoEncryption())
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(private)
+
+        public = key.public_key().public_bytes(serialization.Encoding.OpenSSH, serialization.PublicFormat.OpenSSH)
+        with open("{}.pub".format(self.path), 'wb') as f:
+            f.write(public + " {}\n".format(self.name).encode('ascii'))
+
+        return key
+
+    #
+    def __private_key(self):
+        if self.__key is None:
+            try:
+                self.__key = self.__load_or_generate()
+            except (IOError, OSError, ValueError) as e:
+                msg = "Failed while loading ssh key '{}'!: {}".format(self.path, str(e))
+                log_debug(msg)
+                raise KeyPairError(msg) from e
+        return self.__key
+
+    #
+    def public_key(self):
+        """
+        Returns:
+          str: the public key in OpenSSH format, as imported into AWS
+        """
+        from cryptography.hazmat.primitives import serialization
+
+        with self.__lock:
+            key = self.__private_key()
+        return key.public_key().public_bytes(serialization.Encoding.OpenSSH, serialization.PublicFormat.OpenSSH).decode('ascii')
+
+    #
+    def fingerprint(self):
+        """
+        Returns:
+          str: the fingerprint AWS reports for this key once imported, MD5 of the DER public key
+        """
+        from cryptography.hazmat.primitives import serialization
+
+        with self.__lock:
+            key = self.__private_key()
+        der = key.public_key().public_bytes(serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo)
+        digest = hashlib.md5(der).hexdigest()
+        return ':'.join(digest[i:i + 2] for i in range(0, len(digest), 2))
+
+    #
+    def ensure(self, region=None):
+        """
+        Make sure 'region' holds this key under its name, importing it at most once per process.
+
+        Returns:
+          str: the key name to launch nodes with
+        """
+        region = region or aws_get_region()
+        with self.__ensure_lock:
+            return self.__ensure(region)
+
+    #
+    def __ensure(self, region):
+        with self.__lock:
+            if region in self.__regions:
+                return self.name
+
+        fingerprint = self.fingerprint()
+        ec2 = aws_client('ec2', region)
+
+        try:
+            existing = None
+            try:
+                pairs = ec2.describe_key_pairs(KeyNames=[self.name])['KeyPairs']
+                existing = pairs[0]['KeyFingerprint'] if pairs else None
+            except botocore_exceptions.ClientError as e:
+                if 'InvalidKeyPair.NotFound' != e.response.get('Error', {}).get('Code'):
+                    raise
+
+            if fingerprint == existing:
+                log_debug("Key pair '{}' already present in '{}'.".format(self.name, region))
+
+            else:
+                if existing is not None:
+                    log_info("Key pair '{}' in '{}' does not match the local key, replacing it...".format(self.name, region))
+                    ec2.delete_key_pair(KeyName=self.name)
+
+                log_info("Importing key pair '{}' into '{}'...".format(self.name, region))
+                ec2.import_key_pair(KeyName=self.name, PublicKeyMaterial=self.public_key())
+
+        except (botocore_exceptions.ClientError, boto3_exceptions.Boto3Error) as e:
+            msg = "Failed while ensuring key pair '{}' in '{}'!: {}".format(self.name, region, str(e))
+            log_debug(msg)
+            raise KeyPairError(msg) from e
+
+        with self.__lock:
+            self.__regions.add(region)
+        return self.name
+
+    #
+    def cleanup(self, regions=None):
+        """
+        Delete the key pair from 'regions', by default every region it was imported
+        into by this process plus the current one, and remove the local key files.
+        """
+        with self.__lock:
+            regions = set(regions or self.__regions | set([aws_get_region()]))
+
+        for region in sorted(regions):
+            log_info("Removing key pair '{}' from '{}'...".format(self.name, region))
+            try:
+                aws_client('ec2', region).delete_key_pair(KeyName=self.name)
+            except (botocore_exceptions.ClientError, boto3_exceptions.Boto3Error) as e:
+                msg = "Failed while removing key pair '{}' from '{}'!: {}".format(self.name, region, str(e))
+                log_debug(msg)
+                raise KeyPairError(msg) from e
+
+        for path in [self.path, "{}.pub".format(self.path)]:
+            if os.path.isfile(path):
+                os.remove(path)
+
+        with self.__lock:
+            self.__key = None
+            self.__regions = set()
+        return True
+
+
+#
+def keypair_name(run_id):
+    return "{}{}-rancher-ci".format(run_prefix(), run_id)
+
+
+# keypair shared by the server and every agent of a run
+_keypair = None
+_keypair_lock = threading.Lock()
+
+
+#
+def run_keypair():
+    from ..RunConfig import RunConfig
+
+    global _keypair
+    with _keypair_lock:
+        if _keypair is None:
+            # the same run id the run's nodes are named after, WORKSPACE_DIR/run_id.BUILD_NUMBER
+            run_id = RunConfig.from_environ().run_id
+            if run_id is None:
+                raise KeyPairError("No run id has been allocated, so there is no run key pair!")
+            _keypair = RunKeyPair(keypair_name(run_id))
+        return _keypair
@@ -0,0 +1,39 @@
+import os
+
+from ..Lock import DEFAULT_TTL, TagLock, lock_value
+
+
+# EC2 tag holding '<holder>|<expiry>' of whoever leases the instance
+LEASE_TAG = 'rancher.ci.lease'
+
+# tags a leased server carries so servers of an outdated version can be found
+GROUP_TAG = 'rancher.ci.lease.group'
+VERSION_TAG = 'rancher.ci.lease.version'
+
+
+#
+def lease_mode():
+    mode = str(os.environ.get('RANCHER_SERVER_LEASE', 'off')).rstrip().lower()
+    if mode not in ['off', 'on']:
+        raise RuntimeError("Unsupported RANCHER_SERVER_LEASE '{}'! Choose one of: off, on".format(mode))
+    return mode
+
+
+#
+def lease_tags(holder=None, ttl=DEFAULT_TTL):
+    """
+    Tags which launch an instance already leased to 'holder'.
+    """
+    return [{'Key': LEASE_TAG, 'Value': lock_value(holder, ttl)}]
+
+
+#
+class InstanceLease(TagLock):
+    """
+    Exclusive, expiring use of an EC2 instance, recorded in its rancher.ci.lease tag.
+    """
+
+    #
+    def __init__(self, instance_id, region=None, holder=None, ttl=DEFAULT_TTL):
+        super(InstanceLease, self).__init__(instance_id, LEASE_TAG, region, holder, ttl)
+        self.instance_id = instance_id
@@ -0,0 +1,322 @@
+import os, abc, time, socket, hashlib
+
+from .. import log_debug, log_info, log_warn, aws_client, poll_with_backoff, cache_path
+from .. import boto3_exceptions, botocore_exceptions
+
+
+# seconds a lock is held unless renewed or released
+DEFAULT_TTL = 6 * 3600
+
+# seconds between writing a lock tag and reading it back, so a competing write lands first
+SETTLE_TIME = 3
+
+# prefix of the tags named locks are kept in
+LOCK_TAG_PREFIX = 'rancher.ci.lock.'
+
+# directory under the CI cache holding file locks
+LOCK_DIR = 'locks'
+
+
+#
+class LockError(RuntimeError):
+    message = None
+
+    def __init__(self, message):
+        self.message = message
+        super(LockError, self).__init__(self.message)
+
+
+#
+def lock_holder():
+    """
+    Who takes locks: the same for every task of a build, which run as separate processes.
+    """
+    if os.environ.get('BUILD_TAG'):
+        return str(os.environ['BUILD_TAG']).rstrip()
+    if os.environ.get('BUILD_NUMBER'):
+        return "build-{}".format(str(os.environ['BUILD_NUMBER']).rstrip())
+    return socket.gethostname()
+
+
+#
+def lock_backend():
+    backend = str(os.environ.get('RANCHER_CI_LOCKS', 'tags')).rstrip().lower()
+    if backend not in ['tags', 'files']:
+        raise RuntimeError("Unsupported RANCHER_CI_LOCKS '{}'! Choose one of: tags, files".format(backend))
+    return backend
+
+
+#
+def _value(holder, expiry):
+    return "{}|{:.0f}".format(holder, expiry)
+
+
+#
+def lock_value(holder=None, ttl=DEFAULT_TTL):
+    """
+    The value of a lock taken by 'holder' right now, e.g. to tag a resource as
+    locked from the moment it is created.
+    """
+    return _value(holder or lock_holder(), time.time() + ttl)
+
+
+#
+def _parse(value):
+    holder, _, expiry = value.rpartition('|')
+    try:
+        return holder, float(expiry)
+    except ValueError:
+        log_warn("Ignoring malformed lock '{}'.".format(value))
+        return None, None
+
+
+#
+class ExpiringLock(object, metaclass=abc.ABCMeta):
+    """
+    An exclusive lock which expires after 'ttl' seconds unless renewed, so a
+    crashed build never holds on to it for good. Subclasses store the
+    '<holder>|<expiry>' value somewhere every build can see.
+    """
+
+    #
+    def __init__(self, name, holder=None, ttl=DEFAULT_TTL):
+        self.name = name
+        self.holder = holder or lock_holder()
+        self.ttl = ttl
+
+    #
+    @abc.abstractmethod
+    def current(self):
+        """
+        Returns:
+          tuple: (holder, expiry) of the current lock, (None, None) when there is none
+        """
+
+    #
+    @abc.abstractmethod
+    def _write(self, value, previous):
+        """
+        Store 'value' if the lock still holds 'previous', as far as the backend can tell.
+
+        Returns:
+          bool: whether 'value' was stored
+        """
+
+    #
+    @abc.abstractmethod
+    def _delete(self, value):
+        pass
+
+    #
+    def try_acquire(self):
+        """
+        Returns:
+          bool: whether we hold the lock now
+        """
+        holder, expiry = self.current()
+        if holder is not None and holder != self.holder and expiry > time.time():
+            log_debug("'{}' is held by '{}' for another {:.0f}s.".format(self.name, holder, expiry - time.time()))
+            return False
+
+        if holder is not None and holder != self.holder:
+            log_warn("Taking over the expired lock of '{}' on '{}'.".format(holder, self.name))
+
+        previous = _value(holder, expiry) if holder is not None else None
+        return self._write(_value(self.holder, time.time() + self.ttl), previous)
+
+    #
+    def acquire(self, wait=1800):
+        """
+        Take the lock, waiting up to 'wait' seconds for its holder to release it or let it expire.
+        """
+        log_info("Locking '{}' as '{}'...".format(self.name, self.holder))
+        try:
+            _, elapsed = poll_with_backoff(self.try_acquire, timeout=wait, initial=5, max_step=60,
+                                           description="the lock on '{}'".format(self.name))
+        except LockError:
+            raise
+        except RuntimeError as e:
+            raise LockError("Could not lock '{}' within {}s!: {}".format(self.name, wait, str(e))) from e
+
+        log_info("Locked '{}' after {:.0f}s.".format(self.name, elapsed))
+        return True
+
+    #
+    def renew(self):
+        holder, expiry = self.current()
+        if self.holder != holder:
+            raise LockError("Lost the lock on '{}'!".format(self.name))
+        if not self._write(_value(self.holder, time.time() + self.ttl), _value(holder, expiry)):
+            raise LockError("Lost the lock on '{}' while renewing it!".format(self.name))
+
+    #
+    def release(self):
+        """
+        Returns:
+          bool: whether we held the lock
+        """
+        holder, expiry = self.current()
+        if self.holder != holder:
+            log_debug("Not releasing '{}', it is held by '{}'.".format(self.name, holder))
+            return False
+
+        self._delete(_value(holder, expiry))
+        log_info("Released the lock on '{}'.".format(self.name))
+        return True
+
+    #
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    #
+    def __exit__(self, *exc):
+        self.release()
+
+
+#
+class TagLock(ExpiringLock):
+    """
+    A lock kept in tag 'key' of an EC2 resource, visible to every build in the account.
+
+    EC2 has no conditional tag writes. The tag is re-read right before writing
+    and only written while it still holds the value the caller saw, then read
+    back after SETTLE_TIME, and only the build whose value stuck holds the lock.
+    Deleting by value leaves a lock someone else took over alone.
+
+    This narrows the race but does not close it: two builds which both re-read
+    the same expired value can both write, and if describe_tags lags behind the
+    writes for longer than SETTLE_TIME both read back their own value and both
+    hold the lock. Use FileLock where that is not acceptable.
+    """
+
+    #
+    def __init__(self, resource_id, key, region=None, holder=None, ttl=DEFAULT_TTL):
+        super(TagLock, self).__init__("{}:{}".format(resource_id, key), holder, ttl)
+        self.resource_id = resource_id
+        self.key = key
+        self.region = region
+
+    #
+    def __ec2_call(self, action, fn):
+        try:
+            return fn(aws_client('ec2', self.region))
+        except (botocore_exceptions.ClientError, boto3_exceptions.Boto3Error) as e:
+            msg = "Failed while {} the lock on '{}'!: {}".format(action, self.name, str(e))
+            log_debug(msg)
+            raise LockError(msg) from e
+
+    #
+    def current(self):
+        tags = self.__ec2_call('reading', lambda ec2: ec2.describe_tags(
+            Filters=[{'Name': 'resource-id', 'Values': [self.resource_id]},
+                     {'Name': 'key', 'Values': [self.key]}])['Tags'])
+        if 0 == len(tags):
+            return None, None
+        return _parse(tags[0]['Value'])
+
+    #
+    def _write(self, value, previous):
+        holder, expiry = self.current()
+        if (_value(holder, expiry) if holder is not None else None) != previous:
+            log_debug("'{}' changed hands before we could write it.".format(self.name))
+            return False
+
+        self.__ec2_call('writing', lambda ec2: ec2.create_tags(
+            Resources=[self.resource_id], Tags=[{'Key': self.key, 'Value': value}]))
+        time.sleep(SETTLE_TIME)
+        holder, expiry = self.current()
+        return holder is not None and value == _value(holder, expiry)
+
+    #
+    def _delete(self, value):
+        # with a value, the tag is only deleted while it still holds that value
+        self.__ec2_call('releasing', lambda ec2: ec2.delete_tags(
+            Resources=[self.resource_id], Tags=[{'Key': self.key, 'Value': value}]))
+
+
+#
+class FileLock(ExpiringLock):
+    """
+    A lock kept in a file, for builds sharing one host or a shared filesystem,
+    and as a stand-in for TagLock without AWS. Writes go through an exclusive
+    create of a guard file, so they are atomic where TagLock can only settle.
+    """
+
+    #
+    def __init__(self, path, holder=None, ttl=DEFAULT_TTL):
+        super(FileLock, self).__init__(path, holder, ttl)
+        self.path = path
+
+    #
+    def current(self):
+        try:
+            with open(self.path, 'r') as f:
+                return _parse(f.read().strip())
+        except (IOError, OSError):
+            return None, None
+
+    #
+    def __guarded(self, fn):
+        guard = "{}.guard".format(self.path)
+        try:
+            fd = os.open(guard, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+        except FileExistsError:
+            # a guard older than a minute was left behind by a killed process
+            try:
+                if time.time() - os.path.getmtime(guard) > 60:
+                    os.remove(guard)
+            except OSError:
+                pass
+            return False
+        except OSError as e:
+            msg = "Failed while locking '{}'!: {}".format(self.path, str(e))
+            log_debug(msg)
+            raise LockError(msg) from e
+
+        try:
+            os.close(fd)
+            return fn()
+        finally:
+            os.remove(guard)
+
+    #
+    def _write(self, value, previous):
+        def write():
+            holder, expiry = self.current()
+            if (_value(holder, expiry) if holder is not None else None) != previous:
+                return False
+            tmpfile = "{}.{}.tmp".format(self.path, os.getpid())
+            with open(tmpfile, 'w') as f:
+                f.write(value)
+            os.replace(tmpfile, self.path)
+            return True
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        return self.__guarded(write)
+
+    #
+    def _delete(self, value):
+        def delete():
+            holder, expiry = self.current()
+            if holder is not None and value == _value(holder, expiry):
+                os.remove(self.path)
+            return True
+
+        self.__guarded(delete)
+
+
+#
+def named_lock(name, region=None, holder=None, ttl=DEFAULT_TTL):
+    """
+    A lock on 'name', shared by every build: a tag on the run's VPC (AWS_VPC_ID),
+    or with RANCHER_CI_LOCKS=files a file in the CI cache.
+    """
+    digest = hashlib.sha1(name.encode('utf-8')).hexdigest()[:16]
+    if 'files' == lock_backend():
+        return FileLock(cache_path(LOCK_DIR, digest), holder, ttl)
+
+    vpc_id = str(os.environ.get('AWS_VPC_ID', '')).rstrip()
+    if '' == vpc_id:
+        raise LockError("Named locks need AWS_VPC_ID, or RANCHER_CI_LOCKS=files!")
+    return TagLock(vpc_id, LOCK_TAG_PREFIX + digest, region, holder, ttl)
@@ -0,0 +1,218 @@
+import re, time, itertools, threading
+
+from concurrent.futures import ThreadPoolExecutor
+from invoke import run, Failure
+
+from .. import log_debug, log_info, log_warn, log_error, yaml, save_json_cache
+from ..History import HistoryError, run_history
+from ..Pipeline import Pipeline
+from ..RancherServer import RancherServer
+from ..RancherAgents import RancherAgents
+from ..RunConfig import RunConfig, RunConfigError, ENVVARS
+
+
+#
+class MatrixError(RuntimeError):
+    message = None
+
+    def __init__(self, message):
+        self.message = message
+        super(MatrixError, self).__init__(self.message)
+
+
+#
+def _attribute(key):
+    # matrix files name settings by environment variable or by RunConfig attribute
+    if key in ENVVARS:
+        return ENVVARS[key]
+    if key in RunConfig._fields and 'label' != key:
+        return key
+    raise MatrixError("Unknown matrix axis '{}'!".format(key))
+
+
+#
+def _label(values):
+    return re.sub(r'[^A-Za-z0-9.-]+', '_', '-'.join(str(v) for v in values)).strip('_')
+
+
+#
+def load_matrix(filename, base=None):
+    """
+    Expand a matrix file into one RunConfig per combination.
+
+    The file holds 'axes', a list of values per setting, and optionally 'exclude',
+    a list of partial combinations to leave out, e.g.
+
+      axes:
+        RANCHER_DOCKER_VERSION: ['1.12.6', '17.03.2']
+        RANCHER_AGENT_OPERATINGSYSTEM: ['ubuntu-16.04', 'centos-7']
+      exclude:
+        - {RANCHER_DOCKER_VERSION: '1.12.6', RANCHER_AGENT_OPERATINGSYSTEM: 'centos-7'}
+
+    Every cell gets its own node name prefix (AWS_PREFIX-m<N>) so cells which only
+    differ in their agents do not share a server.
+
+    Args:
+      base (RunConfig): settings shared by every cell, read from the environment when omitted
+
+    Returns:
+      list: RunConfigs, one per cell
+    """
+    try:
+        with open(filename, 'r') as f:
+            spec = yaml.safe_load(f) or {}
+    except (IOError, OSError, yaml.YAMLError) as e:
+        msg = "Failed while reading matrix '{}'!: {}".format(filename, str(e))
+        log_debug(msg)
+        raise MatrixError(msg) from e
+
+    axes = spec.get('axes') or {}
+    if 0 == len(axes):
+        raise MatrixError("Matrix '{}' has no axes!".format(filename))
+
+    keys = sorted(axes)
+    attrs = [_attribute(key) for key in keys]
+    excludes = [dict((_attribute(k), str(v)) for k, v in exclude.items()) for exclude in spec.get('exclude') or []]
+
+    base = base or RunConfig.from_environ()
+    cells = []
+    for values in itertools.product(*[axes[key] for key in keys]):
+        combination = dict(zip(attrs, [str(v) for v in values]))
+        if any(all(combination.get(k) == v for k, v in exclude.items()) for exclude in excludes):
+            continue
+
+        prefix = "m{}".format(len(cells))
+        if base.prefix:
+            prefix = "{}-{}".format(base.prefix, prefix)
+
+        try:
+            cells.append(base.replace(prefix=prefix, label=_label(values), **combination))
+        except RunConfigError as e:
+            raise MatrixError("Invalid matrix cell {}!: {}".format(combination, e.message)) from e
+
+    log_info("Matrix '{}' expands to {} cells.".format(filename, len(cells)))
+    return cells
+
+
+#
+class MatrixRunner(object):
+    """
+    Provision, validate and tear down many clusters concurrently in one process.
+
+    Each worker takes a cell, runs its provision stages and the validation command,
+    and always tears the cluster down again before taking the next cell, so at most
+    'max_live' clusters exist at any time. All cells share the process wide boto3
+    clients, rate limiter, node index and keypair.
+    """
+
+    PROVISION_STAGES = ['rancher_server.provision', 'rancher_server.configure', 'rancher_agents.provision', 'validate']
+
+    #
+    def __init__(self, cells, max_live=2, validate_cmd=None, statefile='matrix.json'):
+        """
+        Args:
+          cells (list): RunConfig per cluster
+          max_live (int): clusters which may exist at the same time
+          validate_cmd (str): shell command run against each cluster, with CATTLE_TEST_URL
+                              and MATRIX_LABEL exported
+          statefile (str): JSON file the per-cell results are written to
+        """
+        if max_live < 1:
+            raise MatrixError("A matrix needs at least one live cluster, got {}!".format(max_live))
+
+        self.cells = cells
+        self.max_live = max_live
+        self.validate_cmd = validate_cmd
+        self.statefile = statefile
+        self.results = {}
+
+        self.__lock = threading.Lock()
+
+    #
+    def __validate(self, config):
+        if self.validate_cmd is None:
+            log_info("[{}] No validation command given, the cluster is up.".format(config.label))
+            return
+
+        cmd = "export CATTLE_TEST_URL='{}' MATRIX_LABEL='{}'; {}".format(
+            RancherServer(config).base_url(), config.label, self.validate_cmd)
+        try:
+            run(cmd, echo=True)
+        except Failure as e:
+            raise MatrixError("Validation of '{}' failed with exit code {}!".format(config.label, e.result.return_code)) from e
+
+    #
+    def __teardown(self, config):
+        # teardown failures must not stop other cells, they are reported with the result
+        errors = []
+        for step in [lambda: RancherAgents(config).deprovision(), lambda: RancherServer(config).deprovision()]:
+            try:
+                step()
+            except RuntimeError as e:
+                log_warn("[{}] Teardown step failed!: {}".format(config.label, str(e)))
+                errors.append(str(e))
+        return errors
+
+    #
+    def __run_cell(self, config):
+        start_time = time.time()
+        log_info("[{}] Starting cell: {}".format(config.label, config.describe()))
+
+        server = RancherServer(config)
+        agents = RancherAgents(config)
+        stages = list(zip(self.PROVISION_STAGES, [server.provision, server.configure, agents.provision,
+                                                  lambda: self.__validate(config)]))
+
+        pipeline = Pipeline(config.label, stages, config.workspace_file('pipeline-matrix.json'))
+        try:
+            exit_code = pipeline.run()
+        finally:
+            teardown_errors = self.__teardown(config)
+        pipeline.report()
+
+        try:
+            history = run_history()
+            history.record_stages(history.record_run(config), pipeline.state['stages'])
+        except HistoryError as e:
+            log_warn("[{}] Could not record stage timings!: {}".format(config.label, e.message))
+
+        result = {'exit_code': exit_code,
+                  'elapsed': time.time() - start_time,
+                  'stages': pipeline.state['stages'],
+                  'teardown_errors': teardown_errors,
+                  'config': dict(config._asdict())}
+
+        with self.__lock:
+            self.results[config.label] = result
+            save_json_cache(self.statefile, self.results)
+        return result
+
+    #
+    def run(self):
+        """
+        Returns:
+          int: number of cells which failed
+        """
+        log_info("Running {} matrix cells with at most {} live clusters...".format(len(self.cells), self.max_live))
+
+        with ThreadPoolExecutor(max_workers=min(self.max_live, max(1, len(self.cells)))) as pool:
+            futures = dict((pool.submit(self.__run_cell, cell), cell) for cell in self.cells)
+            for future, cell in futures.items():
+                try:
+                    future.result()
+                except (RuntimeError, SystemExit) as e:
+                    log_error("[{}] Cell aborted!: {}".format(cell.label, str(e)))
+                    with self.__lock:
+                        self.results[cell.label] = {'exit_code': 1, 'error': str(e), 'config': dict(cell._asdict())}
+                        save_json_cache(self.statefile, self.results)
+
+        return len([r for r in self.results.values() if 0 != r['exit_code']])
+
+    #
+    def report(self):
+        for cell in self.cells:
+            result = self.results.get(cell.label)
+            if result is None:
+                log_debug("{:<40} not run".format(cell.label))
+            else:
+                log_info("{:<40} exit code {:>4} {:>8.1f}s".format(cell.label, result['exit_code'], result.get('elapsed', 0.0)))
@@ -0,0 +1,108 @@
+import os, time, uuid, threading
+
+from .. import log_debug, log_info
+
+
+# EC2 tag every node of a run carries with the run's id
+RUN_TAG = 'rancher.ci.run'
+
+# EC2 tag holding the time, in seconds since the epoch, after which a node may be reaped
+RUN_EXPIRES_TAG = 'rancher.ci.run.expires'
+
+# seconds a run's nodes are kept unless RANCHER_CI_RUN_TTL says otherwise
+DEFAULT_RUN_TTL = 6 * 3600
+
+RUN_ID_LENGTH = 8
+
+
+# run ids already allocated by this process, by the file they are kept in
+_run_ids = {}
+_run_ids_lock = threading.Lock()
+
+
+#
+def _run_id_path(workspace=None, build_number=None):
+    workspace = workspace or str(os.environ.get('WORKSPACE_DIR', os.getcwd())).rstrip()
+    build_number = build_number or str(os.environ.get('BUILD_NUMBER', '')).rstrip()
+    path = os.path.join(workspace, 'run_id')
+    if build_number:
+        path = "{}.{}".format(path, build_number)
+    return path
+
+
+#
+def run_id(workspace=None, build_number=None):
+    """
+    The id of this build, unique among the builds sharing an account and embedded
+    in the names and tags of its nodes so builds of the same cell never collide.
+
+    RANCHER_CI_RUN_ID wins when set. Otherwise it is the id allocate_run_id() kept
+    in WORKSPACE_DIR/run_id[.BUILD_NUMBER], so every task of a build, each its
+    own process, finds the same one. Reading never allocates.
+
+    Returns:
+      str: the run id, None while none has been allocated
+    """
+    if os.environ.get('RANCHER_CI_RUN_ID'):
+        return str(os.environ['RANCHER_CI_RUN_ID']).rstrip()
+
+    path = _run_id_path(workspace, build_number)
+    with _run_ids_lock:
+        if path in _run_ids:
+            return _run_ids[path]
+
+    try:
+        with open(path, 'r') as f:
+            return f.read().strip() or None
+    except (IOError, OSError):
+        return None
+
+
+#
+def allocate_run_id(workspace=None, build_number=None):
+    """
+    Allocate this build's run id unless it already has one. Only the entry points
+    which provision nodes call this, everything else reads the id with run_id().
+
+    Returns:
+      str: the run id
+    """
+    if os.environ.get('RANCHER_CI_RUN_ID'):
+        return str(os.environ['RANCHER_CI_RUN_ID']).rstrip()
+
+    path = _run_id_path(workspace, build_number)
+    with _run_ids_lock:
+        if path not in _run_ids:
+            _run_ids[path] = _allocate(path)
+        return _run_ids[path]
+
+
+#
+def run_ttl():
+    return float(str(os.environ.get('RANCHER_CI_RUN_TTL', DEFAULT_RUN_TTL)).rstrip())
+
+
+#
+def run_expiry():
+    """
+    Value of the RUN_EXPIRES_TAG of a node launched now. Builds which stop after
+    provisioning for manual testing can keep their nodes longer through RANCHER_CI_RUN_TTL.
+    """
+    return "{:.0f}".format(time.time() + run_ttl())
+
+
+#
+def _allocate(path):
+    candidate = uuid.uuid4().hex[:RUN_ID_LENGTH]
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    except FileExistsError:
+        with open(path, 'r') as f:
+            existing = f.read().strip()
+        log_debug("Run id '{}' from '{}'.".format(existing, path))
+        return existing
+
+    with os.fdopen(fd, 'w') as f:
+        f.write(candidate)
+    log_info("Allocated run id '{}'.".format(candidate))
+    return candidate
@@ -0,0 +1,102 @@
+import time
+
+from .. import log_info, log_success, log_warn, log_error, log_debug, load_json_cache, save_json_cache
+
+
+#
+class Pipeline(object):
+    """
+    Run a sequence of named stages in a single process.
+
+    Every stage shares the process-wide boto3 clients, HTTP session and node
+    index, so later stages reuse what earlier ones learned. The exit code and
+    duration of each stage is written to a state file after every stage so a
+    failed run can be resumed from the stage which failed.
+    """
+
+    #
+    def __init__(self, name, stages, statefile):
+        """
+        Args:
+          name (str): name of the pipeline phase, used in log messages
+          stages (list): (name, callable) pairs run in order
+          statefile (str): JSON file recording per-stage results
+        """
+        self.name = name
+        self.stages = stages
+        self.statefile = statefile
+        self.state = {'stages': {}}
+
+    #
+    def __load_state(self):
+        state = load_json_cache(self.statefile)
+        if self.name != state.get('pipeline'):
+            state = {}
+        state.setdefault('stages', {})
+        return state
+
+    #
+    def __save_state(self):
+        self.state['pipeline'] = self.name
+        save_json_cache(self.statefile, self.state)
+
+    #
+    def __run_stage(self, stagename, stage):
+        log_info("[{}] Starting stage '{}'...".format(self.name, stagename))
+        exit_code = 0
+        start_time = time.time()
+
+        try:
+            stage()
+        except SystemExit as e:
+            # tasks report failure through err_and_exit()
+            exit_code = e.code if isinstance(e.code, int) else 1
+        except RuntimeError as e:
+            log_error("Stage '{}' failed!: {}".format(stagename, str(e)))
+            exit_code = 1
+
+        elapsed = time.time() - start_time
+        self.state['stages'][stagename] = {'exit_code': exit_code, 'elapsed': elapsed}
+        self.__save_state()
+
+        log_info("[{}] Stage '{}' finished with exit code {} after {:.1f} seconds.".format(self.name, stagename, exit_code, elapsed))
+        return exit_code
+
+    #
+    def run(self, resume=False):
+        """
+        Run the stages in order, stopping at the first one which fails.
+
+        Args:
+          resume (bool): skip stages which succeeded during a previous run
+
+        Returns:
+          int: 0 on success, otherwise the exit code of the failed stage
+        """
+        if resume:
+            self.state = self.__load_state()
+        else:
+            self.state = {'stages': {}}
+
+        for stagename, stage in self.stages:
+            previous = self.state['stages'].get(stagename)
+            if resume and previous is not None and 0 == previous['exit_code']:
+                log_info("[{}] Skipping stage '{}' which already succeeded.".format(self.name, stagename))
+                continue
+
+            exit_code = self.__run_stage(stagename, stage)
+            if 0 != exit_code:
+                log_warn("[{}] Halting at stage '{}'. Re-run with --resume to continue from here.".format(self.name, stagename))
+                return exit_code
+
+        log_success("[{}] All {} stages completed.".format(self.name, len(self.stages)))
+        return 0
+
+    #
+    def report(self):
+        for stagename, stage in self.stages:
+            result = self.state['stages'].get(stagename)
+            if result is None:
+                log_debug("{:<32} not run".format(stagename))
+            else:
+                log_info("{:<32} exit code {:>4} {:>8.1f}s".format(stagename, result['exit_code'], result['elapsed']))
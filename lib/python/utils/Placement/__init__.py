@@ -0,0 +1,178 @@
+import os, threading
+
+from .. import log_debug, log_info, log_warn, botocore_exceptions, cache_path, load_json_cache, save_json_cache
+
+
+# EC2 error codes which mean "this type has no capacity in this zone right now", as
+# opposed to a request which would fail anywhere.
+CAPACITY_ERRORS = ['InsufficientInstanceCapacity',
+                   'InsufficientHostCapacity',
+                   'InsufficientCapacity',
+                   'Unsupported']
+
+
+#
+class PlacementError(RuntimeError):
+    message = None
+
+    def __init__(self, message):
+        self.message = message
+        super(PlacementError, self).__init__(self.message)
+
+
+#
+def is_capacity_error(e):
+    return isinstance(e, botocore_exceptions.ClientError) and e.response.get('Error', {}).get('Code') in CAPACITY_ERRORS
+
+
+#
+def parse_instance_types(instance_types):
+    if isinstance(instance_types, list):
+        return instance_types
+    return [t.strip() for t in str(instance_types).split(',') if '' != t.strip()]
+
+
+#
+class PlacementScheduler(object):
+    """
+    Spread node launches round-robin across a list of (zone, subnet) placements.
+
+    A launch which fails for lack of capacity immediately fails over to the next
+    placement and that zone is skipped for the instance type from then on. Once
+    no zone has capacity for an instance type the next one in the ranked list
+    is tried.
+
+    Successes and capacity failures per region/zone/instance type are recorded in
+    .cache/placement.json.
+    """
+
+    #
+    def __init__(self, region, placements, statsfile=None):
+        """
+        Args:
+          region (str): AWS region of every placement
+          placements (list): (zone suffix, subnet id) pairs, e.g. ('a', 'subnet-123')
+          statsfile (str): JSON file recording placement outcomes, defaults to .cache/placement.json
+        """
+        if 0 == len(placements):
+            raise PlacementError("At least one placement is required!")
+
+        self.region = region
+        self.placements = list(placements)
+        self.statsfile = statsfile or cache_path('placement.json')
+        self.successes = []
+
+        self.__next = 0
+        self.__exhausted = set()
+        self.__lock = threading.Lock()
+
+    #
+    @classmethod
+    def from_environ(cls, region=None):
+        """
+        Placements come from AWS_SUBNETS ('a:subnet-123,b:subnet-456') when set,
+        otherwise from the single AWS_ZONE / AWS_SUBNET_ID pair.
+        """
+        region = region or str(os.environ['AWS_DEFAULT_REGION']).rstrip()
+        subnets = str(os.environ.get('AWS_SUBNETS', '')).strip()
+
+        if '' == subnets:
+            placements = [(str(os.environ['AWS_ZONE']).rstrip(), str(os.environ['AWS_SUBNET_ID']).rstrip())]
+        else:
+            placements = []
+            for item in subnets.split(','):
+                zone, sep, subnet = item.strip().partition(':')
+                if '' == sep or '' == subnet:
+                    raise PlacementError("AWS_SUBNETS must look like 'a:subnet-123,b:subnet-456', got '{}'!".format(subnets))
+                placements.append((zone, subnet))
+
+        return cls(region, placements)
+
+    #
+    def candidates(self, instance_type):
+        """
+        Placements to try for instance_type, starting after the last successful one
+        and leaving out zones which already ran out of capacity for it.
+        """
+        with self.__lock:
+            start = self.__next
+            exhausted = set(self.__exhausted)
+
+        ordered = self.placements[start:] + self.placements[:start]
+        return [p for p in ordered if (p[0], instance_type) not in exhausted]
+
+    #
+    def exhausted(self, zone, instance_type):
+        with self.__lock:
+            self.__exhausted.add((zone, instance_type))
+
+    #
+    def record(self, zone, instance_type, outcome, nodename=None):
+        """
+        Record the outcome ('ok' or 'capacity') of launching instance_type in zone.
+        """
+        key = "{}{}/{}".format(self.region, zone, instance_type)
+        with self.__lock:
+            if 'ok' == outcome:
+                self.successes.append((nodename, zone, instance_type))
+
+            stats = load_json_cache(self.statsfile)
+            stats.setdefault(key, {'ok': 0, 'capacity': 0})
+            stats[key][outcome] += 1
+            save_json_cache(self.statsfile, stats)
+
+    #
+    def launch(self, nodename, instance_types, launch):
+        """
+        Call launch(instance_type, zone, subnet) until some placement has capacity.
+
+        Every candidate zone is tried for the first instance type before falling
+        back to the next one in the ranked list.
+
+        Args:
+          nodename (str): name of the node, for logging and the placement record
+          instance_types (str|list): ranked instance types, a list or comma separated
+          launch (callable): performs the launch, raising ClientError on failure
+
+        Returns:
+          tuple: (result of launch, (zone, subnet) it succeeded in)
+        """
+        instance_types = parse_instance_types(instance_types)
+
+        for instance_type in instance_types:
+            for placement in self.candidates(instance_type):
+                zone, subnet = placement
+                try:
+                    log_debug("Launching '{}' as '{}' in zone '{}{}'...".format(nodename, instance_type, self.region, zone))
+                    result = launch(instance_type, zone, subnet)
+
+                except botocore_exceptions.ClientError as e:
+                    if not is_capacity_error(e):
+                        raise
+
+                    log_warn("No '{}' capacity in '{}{}', failing over...: {}".format(instance_type, self.region, zone, e.response['Error']['Message']))
+                    self.exhausted(zone, instance_type)
+                    self.record(zone, instance_type, 'capacity')
+                    continue
+
+                with self.__lock:
+                    self.__next = (self.placements.index(placement) + 1) % len(self.placements)
+                self.record(zone, instance_type, 'ok', nodename)
+
+                log_info("Placed '{}' as '{}' in zone '{}{}'.".format(nodename, instance_type, self.region, zone))
+                return result, placement
+
+        raise PlacementError("No capacity for any of '{}' in zones {}!".format(
+            ','.join(instance_types), ', '.join(self.region + zone for zone, subnet in self.placements)))
+
+    #
+    def summary(self):
+        """
+        Returns:
+          dict: number of nodes placed per '<zone>/<instance type>'
+        """
+        counts = {}
+        for nodename, zone, instance_type in self.successes:
+            key = "{}{}/{}".format(self.region, zone, instance_type)
+            counts[key] = counts.get(key, 0) + 1
+        return counts
@@ -0,0 +1,313 @@
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .. import log_debug, log_info, requests, http_session, poll_with_backoff
+from ..Deadline import run_deadline
+
+
+# project every Cattle install starts out with
+DEFAULT_PROJECT = '1a5'
+
+# concurrent PUTs when applying settings
+SETTINGS_WORKERS = 8
+
+# states of resources which are gone or on their way out
+REMOVED_STATES = ['removing', 'removed', 'purging', 'purged']
+
+
+#
+class RancherAPIError(RuntimeError):
+    message = None
+
+    def __init__(self, message):
+        self.message = message
+        super(RancherAPIError, self).__init__(self.message)
+
+
+#
+class RancherAPI(object):
+    """
+    Client for the Rancher server API, v2-beta and the v3 preview.
+
+    Collections are found through the schemas the server publishes, which are
+    fetched once per client. Project ids are cached by environment name, and
+    settings are applied declaratively: one GET of all settings, then parallel
+    PUTs for those which differ.
+    """
+
+    #
+    def __init__(self, base_url, version='v2-beta', timeout=10, attempts=3, step=2):
+        """
+        Args:
+          base_url (str): e.g. http://1.2.3.4:8080
+          version (str): API version, 'v2-beta' or 'v3'
+          timeout (int): seconds per request
+          attempts (int): tries per request on connection errors and HTTP 5xx
+          step (int): seconds between those tries
+        """
+        self.base_url = base_url.rstrip('/')
+        self.version = version
+        self.timeout = timeout
+        self.attempts = attempts
+        self.step = step
+
+        self.__schemas = None
+        self.__project_ids = {}
+        self.__lock = threading.Lock()
+
+    #
+    def url(self, *parts):
+        return '/'.join([self.base_url, self.version] + [str(part).strip('/') for part in parts])
+
+    #
+    def request(self, method, url, data=None, params=None):
+        """
+        Returns:
+          dict: the decoded response body, empty when there is none
+        """
+        url = url if url.startswith('http') else self.url(url)
+        log_debug("Rancher API {} '{}' params: {} data: {}".format(method, url, params, data))
+
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                timeout = run_deadline().clamp(self.timeout, "Rancher API {} '{}'".format(method, url))
+                response = http_session().request(method, url, params=params, json=data, timeout=timeout)
+                if response.status_code < 500 or attempts >= self.attempts:
+                    response.raise_for_status()
+                    return response.json() if response.content else {}
+
+            except (requests.HTTPError, ValueError) as e:
+                msg = "Rancher API {} '{}' failed!: {}".format(method, url, str(e))
+                log_debug(msg)
+                raise RancherAPIError(msg) from e
+
+            except requests.RequestException as e:
+                if attempts >= self.attempts:
+                    msg = "Rancher API {} '{}' failed after {} attempts!: {}".format(method, url, attempts, str(e))
+                    log_debug(msg)
+                    raise RancherAPIError(msg) from e
+
+            log_debug("Rancher API {} '{}' attempt {}/{} failed, retrying...".format(method, url, attempts, self.attempts))
+            run_deadline().sleep(self.step, "Rancher API {} '{}'".format(method, url))
+
+    #
+    def schemas(self):
+        """
+        Returns:
+          dict: schema per resource type, fetched on first use
+        """
+        with self.__lock:
+            schemas = self.__schemas
+        if schemas is None:
+            schemas = dict((schema['id'], schema) for schema in self.request('GET', 'schemas').get('data', []))
+            with self.__lock:
+                self.__schemas = schemas
+        return schemas
+
+    #
+    def collection_url(self, resource_type, project_id=None):
+        """
+        URL of the collection of 'resource_type', scoped to 'project_id' when given.
+        """
+        schema = self.schemas().get(resource_type)
+        if schema is None:
+            raise RancherAPIError("The {} API at '{}' has no '{}' resources!".format(self.version, self.base_url, resource_type))
+
+        plural = schema.get('pluralName') or "{}s".format(resource_type)
+        if project_id is not None:
+            return self.url('projects', project_id, plural.lower())
+        return schema.get('links', {}).get('collection') or self.url(plural.lower())
+
+    #
+    def list(self, resource_type, project_id=None, **filters):
+        params = dict(filters)
+        params.setdefault('limit', -1)
+        return self.request('GET', self.collection_url(resource_type, project_id), params=params).get('data', [])
+
+    #
+    def create(self, resource_type, data, project_id=None):
+        return self.request('POST', self.collection_url(resource_type, project_id), data=data)
+
+    #
+    def environments(self):
+        return self.list('project')
+
+    #
+    def environment(self, project_id):
+        return self.request('GET', self.url('projects', project_id))
+
+    #
+    def environment_id(self, name):
+        """
+        Returns:
+          str: id of the environment called 'name', looked up once per client
+        """
+        with self.__lock:
+            if name in self.__project_ids:
+                return self.__project_ids[name]
+
+        matches = [env['id'] for env in self.environments() if name == env.get('name') and env.get('state') not in REMOVED_STATES]
+        if 0 == len(matches):
+            raise RancherAPIError("No environment named '{}' at '{}'!".format(name, self.base_url))
+
+        with self.__lock:
+            self.__project_ids[name] = matches[0]
+        return matches[0]
+
+    #
+    def create_environment(self, name, template):
+        """
+        Create environment 'name' from the project template called 'template', unless it exists.
+
+        Returns:
+          str: the environment's id
+        """
+        try:
+            return self.environment_id(name)
+        except RancherAPIError:
+            pass
+
+        templates = [t['id'] for t in self.list('projectTemplate', name=template)]
+        if 0 == len(templates):
+            raise RancherAPIError("No project template named '{}' at '{}'!".format(template, self.base_url))
+
+        log_info("Creating environment '{}' from template '{}'...".format(name, template))
+        project_id = self.create('project', {'name': name, 'projectTemplateId': templates[0]})['id']
+        with self.__lock:
+            self.__project_ids[name] = project_id
+        return project_id
+
+    #
+    def create_registration_token(self, project_id=DEFAULT_PROJECT):
+        return self.create('registrationToken', {}, project_id)
+
+    #
+    def registration_command(self, project_id=DEFAULT_PROJECT):
+        """
+        Returns:
+          str: the docker run command agents register with
+        """
+        try:
+            if 'v3' == self.version:
+                return self.request('GET', self.url('clusters', '1c1'))['registrationToken']['hostCommand']
+
+            tokens = self.list('registrationToken', project_id, state='active', sort='name')
+            return tokens[0]['command']
+
+        except (IndexError, KeyError, TypeError) as e:
+            msg = "No active registration token in project '{}'!: {}".format(project_id, str(e))
+            log_debug(msg)
+            raise RancherAPIError(msg) from e
+
+    #
+    def hosts(self, project_id=DEFAULT_PROJECT):
+        return self.list('host', project_id)
+
+    #
+    def active_hosts(self, project_id=DEFAULT_PROJECT):
+        return [host for host in self.hosts(project_id) if 'active' == host.get('state')]
+
+    #
+    def stacks(self, project_id=DEFAULT_PROJECT):
+        return self.list('stack', project_id)
+
+    #
+    def remove(self, resource, timeout=120):
+        """
+        Remove 'resource', deactivating it first where Rancher insists on that.
+        """
+        actions = resource.get('actions', {})
+        if 'remove' not in actions and 'deactivate' in actions:
+            self.request('POST', actions['deactivate'])
+
+            def removable():
+                current = self.request('GET', resource['links']['self'])
+                return current.get('actions', {}).get('remove')
+
+            remove_url, _ = poll_with_backoff(removable, timeout=timeout, initial=1, max_step=10,
+                                              description="'{}' to deactivate".format(resource['id']))
+        else:
+            remove_url = actions.get('remove')
+
+        if remove_url is not None:
+            return self.request('POST', remove_url)
+        return self.request('DELETE', resource['links']['self'])
+
+    #
+    def reset(self, keep=DEFAULT_PROJECT):
+        """
+        Return the server to a freshly configured state: every host and every
+        user stack removed, every environment but 'keep' deleted.
+
+        Returns:
+          dict: number of 'hosts', 'stacks' and 'environments' removed
+        """
+        removed = {'hosts': 0, 'stacks': 0, 'environments': 0}
+        for env in self.environments():
+            if env.get('state') in REMOVED_STATES:
+                continue
+
+            for host in self.hosts(env['id']):
+                if host.get('state') not in REMOVED_STATES:
+                    self.remove(host)
+                    removed['hosts'] += 1
+
+            if keep == env['id']:
+                for stack in self.stacks(env['id']):
+                    if not stack.get('system') and stack.get('state') not in REMOVED_STATES:
+                        self.remove(stack)
+                        removed['stacks'] += 1
+            else:
+                self.request('DELETE', self.url('projects', env['id']))
+                removed['environments'] += 1
+
+        with self.__lock:
+            self.__project_ids = {}
+
+        log_info("Reset '{}': removed {hosts} hosts, {stacks} stacks and {environments} environments.".format(self.base_url, **removed))
+        return removed
+
+    #
+    def settings(self):
+        """
+        Returns:
+          dict: value per setting name
+        """
+        return dict((setting.get('name', setting.get('id')), setting.get('value')) for setting in self.list('setting'))
+
+    #
+    def apply_settings(self, desired):
+        """
+        Bring the server's settings to 'desired', writing only those which differ.
+
+        Returns:
+          list: names of the settings which were changed
+        """
+        current = self.settings()
+        changed = sorted(name for name, value in desired.items() if current.get(name) != value)
+        if 0 == len(changed):
+            log_debug("All {} settings already applied.".format(len(desired)))
+            return changed
+
+        log_info("Applying settings: {}".format(', '.join(changed)))
+        with ThreadPoolExecutor(max_workers=min(SETTINGS_WORKERS, len(changed))) as pool:
+            list(pool.map(lambda name: self.request('PUT', self.url('settings', name), data={'name': name, 'value': desired[name]}),
+                          changed))
+        return changed
+
+
+# clients shared by every stage and thread, keyed by (base url, API version)
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+#
+def rancher_api(base_url, version='v2-beta'):
+    key = (base_url.rstrip('/'), version)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = RancherAPI(base_url, version)
+        return _clients[key]
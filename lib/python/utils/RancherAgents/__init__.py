@@ -1,12 +1,20 @@
 import os
 
-from invoke import run, Failure
-from time import sleep, time
-from .. import log_info, log_success, log_debug, log_warn, os_to_settings
-from .. import ec2_node_ensure, ec2_node_terminate, ec2_node_public_ip
+from .. import log_info, log_success, log_debug, log_warn, poll_with_backoff
+from .. import ec2_node_ensure, ec2_node_public_ip, ec2_nodes_public_ips, ec2_ensure_ssh_keypair
+from .. import bootstrap_mode, ec2_bootstrap_userdata, ec2_compute_tags, ec2_wait_for_bootstrap
 
+from ..RancherAPI import RancherAPIError
 from ..RancherServer import RancherServer, RancherServerError
-from ..SSH import SSH, SCP, SSHError
+from ..SSH import SSH, SSHError, SSHBroadcast
+from ..Artifacts import ArtifactsError, bootstrap_bundle
+from ..Placement import PlacementScheduler
+from ..Fleet import Fleet, FleetError
+from ..Scale import ScaleLauncher, ScaleError, Progress, terminate_nodes
+from ..Volumes import VolumeManager, VolumeError
+from ..Inventory import InventoryError, node_index
+from ..KeyPair import run_keypair
+from ..RunConfig import RunConfig
 
 
 class RancherAgentsError(RuntimeError):
@@ -20,7 +28,7 @@ class RancherAgentsError(RuntimeError):
 class RancherAgents(object):
 
         #
-        def __validate_envvars(self):
+        def __validate_config(self):
                 required_envvars = ['AWS_ACCESS_KEY_ID',
                                     'AWS_SECRET_ACCESS_KEY',
                                     'AWS_DEFAULT_REGION',
@@ -36,124 +44,167 @@ class RancherAgents(object):
                                     'RANCHER_DOCKER_VERSION',
                                     'RANCHER_AGENTS_COUNT']
 
-                result = True
-                missing = []
-                for envvar in required_envvars:
-                        if envvar not in os.environ:
-                                log_debug("Missing envvar \'{}\'!".format(envvar))
-                                missing.append(envvar)
-                                result = False
-                if False is result:
+                missing = self.config.missing(required_envvars)
+                for envvar in missing:
+                        log_debug("Missing envvar \'{}\'!".format(envvar))
+                if 0 != len(missing):
                         raise RancherAgentsError("The following environment variables are required: {}".format(', '.join(missing)))
 
         #
-        def __init__(self):
-               self.__validate_envvars()
+        def __init__(self, config=None):
+               """
+               Args:
+                 config (RunConfig): the cluster the agents join, read from the environment when omitted
+               """
+               self.config = config or RunConfig.from_environ()
+               self.__validate_config()
+               self.__standalone = False
 
         #
-        def __agent_name_prefix(self):
-                n = ''
-                prefix = os.environ.get('AWS_PREFIX')
-                rancher_version = os.environ['RANCHER_VERSION'].replace('.', '')
-                docker_version = os.environ['RANCHER_DOCKER_VERSION'].replace('.', '').replace('~', '')
-                rancher_agent_os = os.environ['RANCHER_AGENT_OPERATINGSYSTEM']
-                rancher_orch = os.environ['RANCHER_ORCHESTRATION']
+        def __server(self):
+                return RancherServer(self.config)
 
-                if None is not prefix:
-                        prefix = prefix.replace('.', '-')
-                        n = "{}-".format(prefix)
+        #
+        def __agent_name_prefix(self):
+                return self.config.agent_prefix()
 
-                n += "{}-{}-d{}-{}-agent".format(rancher_version, rancher_orch, docker_version, rancher_agent_os)
-                return n.rstrip()
+        #
+        def __fleet_mode(self):
+                return self.config.agent_fleet
 
         #
         def __get_agent_names(self, count):
-                agent_names = []
-                for i in list(range(count)):
-                        agent_names.append("{}{}".format(self.__agent_name_prefix(), i))
-                return agent_names
+                return self.config.agent_names(count)
 
         #
-        def __wait_on_active_agents(self, count):
-                rancher_version = str(os.environ['RANCHER_VERSION']).rstrip()
-                if "v2" in rancher_version:
-                    rancher_url = "http://{}:8080/v3/schemas".format(RancherServer().IP())
-                else:
-                    rancher_url = "http://{}:8080/v2-beta/schemas".format(RancherServer().IP())
-                os.environ['RANCHER_URL'] = rancher_url
-                rancher_orch = str(os.environ['RANCHER_ORCHESTRATION']).rstrip()
+        def __wait_on_active_agents(self, count, timeout=600):
+                server = self.__server()
 
-                actual_count = 0
-                timeout = 600
-                elapsed_time = 0
-                sleep_step = 30
+                def active_agents():
+                        active = len(server.api().active_hosts(server.project_id()))
+                        log_info("{} of {} Rancher Agents active...".format(active, count))
+                        return active >= count
 
-                start_time = time()
-                while actual_count < count and elapsed_time < timeout:
-                        try:
-                                sleep(sleep_step)
-                                project_id = '1a5'
-                                if rancher_orch == 'k8s':
-                                    project_id = run('rancher --url http://{}:8080 env ls --quiet | grep -v 1a5'.format(RancherServer().IP())).stdout.rstrip('\n\r')
-                                result = run('rancher --env {} host list -q | grep active| wc -l'.format(project_id), echo=True)
-                                actual_count = int(result.stdout.rstrip())
-                                elapsed_time = time() - start_time
-                                log_info("{} seconds elapsed waiting for {} active Rancher Agents...".format(elapsed_time, count))
-
-                        except Failure as e:
-                                msg = "Failed while trying to count active agents!: {}".format(str(e))
-                                log_debug(msg)
-                                raise RancherAgentsError(msg) from e
-
-                if actual_count < count and elapsed_time > timeout:
-                        msg = "Timed out waiting for {} agents to become active!".format(count)
+                try:
+                        _, elapsed = poll_with_backoff(active_agents, timeout=timeout, initial=1, max_step=15,
+                                                       description="{} active Rancher Agents".format(count))
+
+                except (RancherAPIError, RancherServerError) as e:
+                        msg = "Failed while trying to count active agents!: {}".format(str(e))
                         log_debug(msg)
-                        raise RancherAgentsError(msg)
+                        raise RancherAgentsError(msg) from e
+
+                except RuntimeError as e:
+                        msg = "Timed out waiting for {} agents to become active!: {}".format(count, str(e))
+                        log_debug(msg)
+                        raise RancherAgentsError(msg) from e
+
+                log_info("{} Rancher Agents active after {:.0f} seconds.".format(count, elapsed))
+                return elapsed
 
         #
-        def __wait_on_active_k8s(self):
-                rancher_version = str(os.environ['RANCHER_VERSION']).rstrip()
-                if "v2" in rancher_version:
-                    rancher_url = "http://{}:8080/v3/schemas".format(RancherServer().IP())
-                else:
-                    rancher_url = "http://{}:8080/v2-beta/schemas".format(RancherServer().IP())
-                os.environ['RANCHER_URL'] = rancher_url
-                rancher_orch = str(os.environ['RANCHER_ORCHESTRATION']).rstrip()
+        def __wait_on_active_k8s(self, timeout=600):
+                server = self.__server()
 
-                stack_health = "unhealthy"
-                timeout = 600
-                elapsed_time = 0
-                sleep_step = 30
+                def k8s_healthy():
+                        health = server.api().environment(server.project_id()).get('healthState')
+                        log_info("Kubernetes environment is '{}'...".format(health))
+                        return 'healthy' == health
 
-                start_time = time()
-                while stack_health != "healthy" and elapsed_time < timeout:
-                        try:
-                                sleep(sleep_step)
-                                project_id = '1a5'
-                                if rancher_orch == 'k8s':
-                                    project_id = run('rancher --url http://{}:8080 env ls --quiet | grep -v 1a5'.format(RancherServer().IP())).stdout.rstrip('\n\r')
-                                stack_health = run("rancher inspect {} | jq .healthState".format(project_id)).stdout.rstrip('\n\r')
-                                elapsed_time = time() - start_time
-                                log_info("{} seconds elapsed waiting for k8s stack...".format(elapsed_time))
-
-                        except Failure as e:
-                                msg = "Failed while trying to wait to kubernetes stack!: {}".format(str(e))
-                                log_debug(msg)
-                                raise RancherAgentsError(msg) from e
-
-                if stack_health != "healthy" and elapsed_time > timeout:
-                        msg = "Timed out waiting for k8s stack to become active!"
+                try:
+                        _, elapsed = poll_with_backoff(k8s_healthy, timeout=timeout, initial=1, max_step=15,
+                                                       description='a healthy kubernetes environment')
+
+                except (RancherAPIError, RancherServerError) as e:
+                        msg = "Failed while trying to wait to kubernetes stack!: {}".format(str(e))
                         log_debug(msg)
-                        raise RancherAgentsError(msg)
+                        raise RancherAgentsError(msg) from e
+
+                except RuntimeError as e:
+                        msg = "Timed out waiting for k8s stack to become active!: {}".format(str(e))
+                        log_debug(msg)
+                        raise RancherAgentsError(msg) from e
+
+                return elapsed
+
+        #
+        def __ensure_agent_volumes(self, agent_names):
+                # an extra data volume per agent, all created and attached in one go
+                size = self.config.agent_volume_size
+                if not size:
+                        return None
+
+                region = self.config.region
+                try:
+                        index = node_index(region)
+                        nodes = [index.get(name) for name in agent_names]
+                        return VolumeManager(region).provision([node for node in nodes if node is not None], size=size)
+
+                except (InventoryError, VolumeError) as e:
+                        msg = "Failed while provisioning agent volumes!: {}".format(str(e))
+                        log_debug(msg)
+                        raise RancherAgentsError(msg) from e
+
+        #
+        def __bootstrap_commands(self):
+                # with user-data bootstrap the agents register themselves once Docker is up
+                if 'userdata' != bootstrap_mode():
+                        return None
+
+                # standalone agents register with whatever RANCHER_REGISTRATION_COMMAND points at, if anything
+                if self.__standalone:
+                        reg_command = self.config.registration_command
+                        return [reg_command] if reg_command else None
+
+                return [self.__server().reg_command()]
+
+        #
+        def __ensure_rancher_agents_fleet(self):
+                agent_count = self.config.agent_count
+                fleet_name = self.__agent_name_prefix()
+
+                try:
+                        keyname = ec2_ensure_ssh_keypair(self.config.region)
+                        fleet = Fleet(fleet_name,
+                                      PlacementScheduler.from_environ(self.config.region),
+                                      self.config.agent_instance_type,
+                                      capacity=self.config.agent_capacity,
+                                      config=self.config)
+                        os_settings = self.config.agent_os_settings()
+                        userdata = None
+                        if 'userdata' == bootstrap_mode():
+                                userdata = ec2_bootstrap_userdata(ec2_compute_tags(fleet_name, self.config), os_settings, self.__bootstrap_commands())
+                        fleet.launch(self.__get_agent_names(agent_count), os_settings, keyname, userdata)
+
+                except (FleetError, RancherServerError, RuntimeError) as e:
+                        msg = "Failed while provisioning agent fleet '{}'!: {}".format(fleet_name, str(e))
+                        log_debug(msg)
+                        raise RancherAgentsError(msg) from e
+
+                return True
 
         #
         def __ensure_rancher_agents(self):
-                agent_count = int(str(os.environ['RANCHER_AGENTS_COUNT']).rstrip())
+                if self.__fleet_mode():
+                        return self.__ensure_rancher_agents_fleet()
+
+                agent_count = self.config.agent_count
                 max_attempts = 10
                 attempts = 0
                 agents = 0
                 agent_name_prefix = self.__agent_name_prefix()
 
+                # one scheduler for the whole fleet so agents spread across zones and
+                # zones out of capacity are skipped for the remaining agents
+                scheduler = PlacementScheduler.from_environ(self.config.region)
+
+                try:
+                        bootstrap_commands = self.__bootstrap_commands()
+                except RancherServerError as e:
+                        msg = "Failed while preparing agent bootstrap!: {}".format(str(e))
+                        log_debug(msg)
+                        raise RancherAgentsError(msg) from e
+
                 while attempts < max_attempts:
                         result = False
                         agent_name = agent_name_prefix + str(agents)
@@ -162,7 +213,12 @@ class RancherAgents(object):
 
                         try:
                                 log_info("Provisioning agent '{}'...".format(agent_name))
-                                if True is ec2_node_ensure(agent_name, instance_type=os.environ.get('RANCHER_AGENT_AWS_INSTANCE_TYPE')):
+                                if None is not ec2_node_ensure(agent_name,
+                                                               instance_type=self.config.agent_instance_type,
+                                                               scheduler=scheduler,
+                                                               bootstrap_commands=bootstrap_commands,
+                                                               config=self.config,
+                                                               role='agent'):
                                         agents += 1
 
                         except RuntimeError as e:
@@ -172,6 +228,8 @@ class RancherAgents(object):
                         if agents >= agent_count or attempts >= max_attempts:
                                 break
 
+                log_info("Agent placement by zone: {}".format(scheduler.summary()))
+
                 if agents >= agent_count:
                         return True
                 else:
@@ -181,16 +239,14 @@ class RancherAgents(object):
 
         #
         def __install_docker(self, agentname):
-                region = str(os.environ['AWS_DEFAULT_REGION']).rstrip()
-                agent_os = str(os.environ['RANCHER_AGENT_OPERATINGSYSTEM']).rstrip()
-                os_settings = os_to_settings(agent_os)
-                ssh_user = os_settings['ssh_username']
+                region = self.config.region
+                ssh_user = self.config.agent_os_settings()['ssh_username']
 
                 try:
                         addr = ec2_node_public_ip(agentname, region=region)
 
-                        SCP(agentname, addr, ssh_user, './lib/bash/*.sh', '/tmp/')
-                        SSH(agentname, addr, ssh_user, 'chmod +x /tmp/*.sh && /tmp/rancher_ci_bootstrap.sh')
+                        # the bundle has already been distributed by __ensure_agents_docker()
+                        SSH(run_keypair().name, addr, ssh_user, '/tmp/rancher_ci_bootstrap.sh')
 
                 except SSHError as e:
                         msg = "Failed while Dockerizing Rancher Agent '{}'!: {}".format(agentname, str(e))
@@ -201,42 +257,61 @@ class RancherAgents(object):
 
         #
         def __ensure_agents_docker(self):
-                agent_prefix = self.__agent_name_prefix()
-                agent_count = int(str(os.environ['RANCHER_AGENTS_COUNT']).rstrip())
+                region = self.config.region
+                ssh_user = self.config.agent_os_settings()['ssh_username']
+                agent_names = self.__get_agent_names(self.config.agent_count)
 
                 try:
-                        for agent in range(0, agent_count):
-                                agent_name = agent_prefix + str(agent)
+                        addrs = ec2_nodes_public_ips(agent_names, region=region)
+                        hosts = [(run_keypair().name, addrs[name], ssh_user) for name in agent_names]
+                        bootstrap_bundle().distribute(hosts)
+
+                        for agent_name in agent_names:
                                 log_info("Installing Docker on Rancher Agent '{}'...".format(agent_name))
                                 self.__install_docker(agent_name)
 
-                except RancherAgentsError as e:
+                except (RancherAgentsError, ArtifactsError, RuntimeError) as e:
                         msg = "Failed while Dockerizing Rancher Agents!: {}".format(str(e))
                         log_debug(msg)
                         raise RancherAgentsError(msg) from e
 
                 return True
 
+        #
+        def __wait_on_agents_bootstrap(self, count):
+                try:
+                        ec2_wait_for_bootstrap(self.__get_agent_names(count), region=self.config.region)
+                except RuntimeError as e:
+                        msg = "Failed while bootstrapping Rancher Agents!: {}".format(str(e))
+                        log_debug(msg)
+                        raise RancherAgentsError(msg) from e
+
+                return True
+
+        #
+        def __agent_hosts(self, agent_names):
+                region = self.config.region
+                ssh_user = self.config.agent_os_settings()['ssh_username']
+
+                addrs = ec2_nodes_public_ips(agent_names, region=region)
+                return [(run_keypair().name, addrs[name], ssh_user) for name in agent_names]
+
+        #
+        def __broadcast(self, agent_names, cmd, max_workers=16, progress=None):
+                hosts = self.__agent_hosts(agent_names)
+                return SSHBroadcast(hosts, cmd, max_workers=max_workers, progress=progress).run()
+
         #
         def __ensure_rancher_agents_container(self):
                 log_info("Deploying Rancher Agent container...")
 
-                agent_count = int(str(os.environ['RANCHER_AGENTS_COUNT']).rstrip())
-                region = str(os.environ['AWS_DEFAULT_REGION']).rstrip()
-                agent_os = str(os.environ['RANCHER_AGENT_OPERATINGSYSTEM']).rstrip()
-                os_settings = os_to_settings(agent_os)
-                ssh_user = os_settings['ssh_username']
-                agent_prefix = self.__agent_name_prefix()
+                agent_count = self.config.agent_count
 
                 try:
-                        reg_command = RancherServer().reg_command()
+                        reg_command = self.__server().reg_command()
+                        self.__broadcast(self.__get_agent_names(agent_count), reg_command)
 
-                        for agent in range(0, agent_count):
-                                agent_name = agent_prefix + str(agent)
-                                addr = ec2_node_public_ip(agent_name, region=region)
-                                SSH(agent_name, addr, ssh_user, reg_command)
-
-                except (RancherServerError, SSHError) as e:
+                except (RancherServerError, SSHError, RuntimeError) as e:
                         msg = "Failed while launcing Rancher Agent container!: {}".format(str(e))
                         log_debug(msg)
                         raise RancherAgentsError(msg) from e
@@ -245,12 +320,15 @@ class RancherAgents(object):
 
         #
         def provision(self):
-                agent_count = int(str(os.environ['RANCHER_AGENTS_COUNT']).rstrip())
+                agent_count = self.config.agent_count
                 try:
-                        rancher_orch = str(os.environ['RANCHER_ORCHESTRATION']).rstrip()
                         self.__ensure_rancher_agents()
-                        self.__ensure_agents_docker()
-                        self.__ensure_rancher_agents_container()
+                        self.__ensure_agent_volumes(self.__get_agent_names(agent_count))
+                        if 'userdata' == bootstrap_mode():
+                                self.__wait_on_agents_bootstrap(agent_count)
+                        else:
+                                self.__ensure_agents_docker()
+                                self.__ensure_rancher_agents_container()
                         self.__wait_on_active_agents(agent_count)
                 except RancherAgentsError as e:
                         msg = "Failed while provisioning Rancher Agents!: {}".format(str(e))
@@ -259,31 +337,79 @@ class RancherAgents(object):
 
                 return True
 
+        #
+        def provision_scale(self):
+                """
+                Provision RANCHER_AGENTS_COUNT agents for scale testing, meant for counts
+                in the hundreds.
+
+                Nodes are launched RANCHER_SCALE_BATCH_SIZE at a time with rate limited EC2
+                calls, and bootstrap and registration fan out over at most
+                RANCHER_SCALE_SSH_WORKERS concurrent ssh sessions.
+                """
+                agent_count = self.config.agent_count
+                ssh_workers = int(os.environ.get('RANCHER_SCALE_SSH_WORKERS', 32))
+                name = self.__agent_name_prefix()
+                agent_names = self.__get_agent_names(agent_count)
+
+                try:
+                        os_settings = self.config.agent_os_settings()
+                        userdata = None
+                        if 'userdata' == bootstrap_mode():
+                                userdata = ec2_bootstrap_userdata(ec2_compute_tags(name, self.config), os_settings, self.__bootstrap_commands())
+
+                        keyname = ec2_ensure_ssh_keypair(self.config.region)
+                        launcher = ScaleLauncher(name, PlacementScheduler.from_environ(self.config.region), self.config.agent_instance_type,
+                                                 config=self.config)
+                        launcher.launch(agent_names, os_settings, keyname, userdata)
+                        self.__ensure_agent_volumes(agent_names)
+
+                        if userdata is not None:
+                                self.__wait_on_agents_bootstrap(agent_count)
+                        else:
+                                bootstrap_bundle().distribute(self.__agent_hosts(agent_names))
+                                self.__broadcast(agent_names, '/tmp/rancher_ci_bootstrap.sh', max_workers=ssh_workers,
+                                                 progress=Progress('Bootstrapped agents', agent_count))
+                                self.__broadcast(agent_names, self.__server().reg_command(), max_workers=ssh_workers,
+                                                 progress=Progress('Registered agents', agent_count))
+
+                        self.__wait_on_active_agents(agent_count)
+
+                except (ScaleError, ArtifactsError, SSHError, RancherServerError, RuntimeError) as e:
+                        msg = "Failed while provisioning {} agents for scale testing!: {}".format(agent_count, str(e))
+                        log_debug(msg)
+                        raise RancherAgentsError(msg) from e
+
+                return True
+
         #
         def provision_standalone(self):
-                agent_count = int(str(os.environ['RANCHER_AGENTS_COUNT']).rstrip())
-                agent_prefix = self.__agent_name_prefix()
-                region = str(os.environ['AWS_DEFAULT_REGION']).rstrip()
-                reg_command = str(os.environ.get('RANCHER_REGISTRATION_COMMAND', False)).rstrip()
-                agent_os = str(os.environ['RANCHER_AGENT_OPERATINGSYSTEM']).rstrip()
-                os_settings = os_to_settings(agent_os)
-                ssh_user = os_settings['ssh_username']
+                agent_count = self.config.agent_count
+                region = self.config.region
+                reg_command = self.config.registration_command
+
+                self.__standalone = True
+                userdata = 'userdata' == bootstrap_mode()
 
                 try:
                         self.__ensure_rancher_agents()
-                        self.__ensure_agents_docker()
+                        if userdata:
+                                self.__wait_on_agents_bootstrap(agent_count)
+                        else:
+                                self.__ensure_agents_docker()
 
                 except RancherAgentsError as e:
                         msg = "Failed while provisioning Rancher Agents!: {}".format(str(e))
                         log_debug(msg)
                         raise RancherAgentsError(msg) from e
 
-                for agent in range(0, agent_count):
-                    agent_name = agent_prefix + str(agent)
-                    addr = ec2_node_public_ip(agent_name, region=region)
-                    log_success("Standalone Agent {}: {}".format(agent_name, addr))
-                    if reg_command is not 'False':
-                        SSH(agent_name, addr, ssh_user, reg_command)
+                agent_names = self.__get_agent_names(agent_count)
+                addrs = ec2_nodes_public_ips(agent_names, region=region)
+                for agent_name in agent_names:
+                    log_success("Standalone Agent {}: {}".format(agent_name, addrs[agent_name]))
+
+                if reg_command and not userdata:
+                    self.__broadcast(agent_names, reg_command)
 
                 return True
 
@@ -291,15 +417,14 @@ class RancherAgents(object):
         def deprovision(self):
                 log_info("Deprovisioning Rancher Agents...")
 
-                region = str(os.environ['AWS_DEFAULT_REGION']).rstrip()
-                agent_count = int(str(os.environ['RANCHER_AGENTS_COUNT']).rstrip())
+                region = self.config.region
+                agent_count = self.config.agent_count
                 try:
-                        for agent in range(0, agent_count):
-                                agent_name = self.__agent_name_prefix() + str(agent)
-                                ec2_node_terminate(agent_name, region=region)
-                                # nuke_aws_keypair(agent_name)
+                        # one paginated describe and batched terminate calls, whatever the count
+                        terminated = terminate_nodes(self.__get_agent_names(agent_count), region, label=self.__agent_name_prefix())
+                        log_info("Terminated {} agent instances.".format(terminated))
 
-                except (RancherAgentsError, RuntimeError) as e:
+                except (ScaleError, RuntimeError) as e:
                         msg = "Failed with deprovisioning agent!: {}".format(str(e))
                         log_info(msg)
                         log_info("Proceeding to name agent...")
@@ -1,15 +1,27 @@
-import os, boto3
+import os
 
-from invoke import run, Failure
-from requests import ConnectionError, HTTPError
-from time import sleep
-from boto3.exceptions import Boto3Error
-from botocore.exceptions import ClientError
+from .. import boto3_exceptions, botocore_exceptions, requests, aws_client, http_session
+from .. import log_debug, log_info, log_warn, poll_with_backoff, load_json_cache, save_json_cache
+from .. import ec2_tag_value, ec2_node_ensure, ec2_wait_for_state
+from .. import bootstrap_mode, ec2_wait_for_bootstrap
 
-from .. import log_debug, log_info, log_warn, request_with_retries, os_to_settings
-from .. import ec2_tag_value, aws_get_region, ec2_node_ensure, ec2_node_public_ip
+from ..SSH import SSH, SSHError
+from ..Artifacts import ArtifactsError, bootstrap_bundle
+from ..History import HistoryError, run_history
+from ..Inventory import InventoryError, iter_instances, node_index
+from ..KeyPair import run_keypair
+from ..Lease import GROUP_TAG, VERSION_TAG, InstanceLease, lease_mode, lease_tags
+from ..Lock import LockError, named_lock
+from ..RancherAPI import DEFAULT_PROJECT, RancherAPIError, rancher_api
+from ..RunConfig import RunConfig
+from ..Snapshots import HOST_DATA_DIR, SERVER_CONTAINER, SnapshotError, server_snapshots, snapshot_mode
 
-from ..SSH import SSH, SSHError, SCP
+
+# seconds rancher/server gets to come up, from starting the container to a usable API
+READY_TIMEOUT = 3600
+
+# environment k8s clusters are created in
+K8S_ENVIRONMENT = 'kubetest'
 
 
 class RancherServerError(RuntimeError):
@@ -23,7 +35,7 @@ class RancherServerError(RuntimeError):
 class RancherServer(object):
 
         #
-        def __validate_envvars(self):
+        def __validate_config(self):
                 required_envvars = ['AWS_ACCESS_KEY_ID',
                                     'AWS_SECRET_ACCESS_KEY',
                                     'AWS_DEFAULT_REGION',
@@ -40,52 +52,38 @@ class RancherServer(object):
                                     'RANCHER_SERVER_AWS_INSTANCE_TYPE',
                                     'RANCHER_DOCKER_VERSION']
 
-                result = True
-                missing = []
-                for envvar in required_envvars:
-                        if envvar not in os.environ:
-                                log_debug("Missing envvar \'{}\'!".format(envvar))
-                                missing.append(envvar)
-                                result = False
-                if False is result:
+                missing = self.config.missing(required_envvars)
+                for envvar in missing:
+                        log_debug("Missing envvar \'{}\'!".format(envvar))
+                if 0 != len(missing):
                         raise RancherServerError("The following environment variables are required: {}".format(', '.join(missing)))
 
         #
-        def __init__(self):
-                self.__validate_envvars()
+        def __init__(self, config=None):
+                """
+                Args:
+                  config (RunConfig): the cluster to manage, read from the environment when omitted
+                """
+                self.config = config or RunConfig.from_environ()
+                self.__validate_config()
 
         #
         def name(self):
-                n = ''
-                prefix = os.environ.get('AWS_PREFIX')
-                rancher_version = os.environ['RANCHER_VERSION'].replace('.', '')
-                docker_version = os.environ['RANCHER_DOCKER_VERSION'].replace('.', '').replace('~', '')
-                rancher_server_os = os.environ['RANCHER_SERVER_OPERATINGSYSTEM']
-                rancher_orch = os.environ['RANCHER_ORCHESTRATION']
-
-                if None is not prefix:
-                        prefix = prefix.replace('.', '-')
-                        n = "{}-".format(prefix)
+                # a leased server outlives builds, so it is not named after one
+                return self.config.server_name(shared='on' == lease_mode() and not self.__private())
 
-                n += "{}-{}-d{}-{}-server0".format(rancher_version, rancher_orch, docker_version, rancher_server_os)
-
-                return n.rstrip()
+        #
+        def base_url(self):
+                return "http://{}:8080".format(self.IP())
 
         #
         def IP(self):
                 log_debug("Getting IP address for node '{}'...".format(self.name()))
 
                 try:
-                        node_filter = [
-                                {'Name': 'tag:Name', 'Values': [self.name()]},
-                                {'Name': 'instance-state-name', 'Values': ['running']}
-                        ]
-
-                        ec2 = boto3.client('ec2', region_name=aws_get_region())
-                        rez = ec2.describe_instances(Filters=node_filter)['Reservations']
-                        ipaddr = str(rez[0]['Instances'][0]['NetworkInterfaces'][0]['Association']['PublicIp'])
+                        ipaddr = node_index(self.config.region).public_ip(self.name())
 
-                except (ClientError, Boto3Error) as e:
+                except InventoryError as e:
                         msg = "Failed to resolve IP addr for '{}'!: {}".format(self.name(), str(e))
                         log_debug(msg)
                         raise RancherServerError(msg) from e
@@ -118,71 +116,121 @@ class RancherServer(object):
 
         #
         def deprovision(self):
+                if 'on' == lease_mode() and not self.__private():
+                        return self.__release_lease()
+
                 log_info("Deprovisioning Rancher Server '{}'...".format(self.name()))
-                region = str(os.environ['AWS_DEFAULT_REGION']).rstrip()
+                region = self.config.region
 
                 try:
-                        node_filter = [
-                                {'Name': 'tag:Name', 'Values': [self.name()]},
-                                {'Name': 'instance-state-name', 'Values': ['running']}
-                        ]
-
-                        ec2 = boto3.client('ec2', region_name=region)
-                        reservations = ec2.describe_instances(Filters=node_filter)['Reservations']
-                        log_debug("reservation info: {}".format(reservations))
+                        index = node_index(region)
+                        records = index.find(self.name(), states=['running'])
 
-                        if len(reservations) < 1:
+                        if len(records) < 1:
                                 log_info("No nodes matching name '{}' to deprovision.".format(self.name()))
 
-                        elif len(reservations) > 1:
+                        elif len(records) > 1:
                                 msg = "Found more than one instance matching name '{}'. That's very strange!"
                                 log_warn(msg)
                                 log_warn("Halting deprovisioning. Please resolve naming conflict manually.")
                                 raise RancherServerError(msg)
 
                         else:
-                                instance_id = reservations[0]['Instances'][0]['InstanceId']
+                                instance_id = records[0].id
                                 log_info("Deprovisioning '{}'...".format(instance_id))
-                                ec2.terminate_instances(InstanceIds=[instance_id])
-                                # ec2.delete_key_pair(KeyName=self.name())
+                                aws_client('ec2', region).terminate_instances(InstanceIds=[instance_id])
+                                index.discard(self.name())
 
-                except (Boto3Error, ClientError) as e:
+                except (InventoryError, boto3_exceptions.Boto3Error, botocore_exceptions.ClientError) as e:
                         msg = "Failed while deprovisioning Rancher Server node!: {}".format(str(e))
                         log_debug(msg)
                         raise RancherServerError(msg)
 
+                if os.path.exists(self.__lease_file()):
+                        os.remove(self.__lease_file())
+                return True
+
+        #
+        def __api_ready(self, api_url):
+                # the API root answers well before cattle has loaded its schemas, so only
+                # call the server ready once settings can be written through the API
+                try:
+                        response = http_session().get(api_url, timeout=5)
+                        if 200 != response.status_code:
+                                log_debug("API root answered HTTP {}.".format(response.status_code))
+                                return False
+
+                        response = http_session().get("{}/schemas".format(api_url), timeout=5)
+                        if 200 != response.status_code:
+                                log_debug("API schemas answered HTTP {}.".format(response.status_code))
+                                return False
+                        schemas = dict((schema.get('id'), schema) for schema in response.json().get('data', []))
+
+                except (requests.RequestException, ValueError) as e:
+                        log_debug("API provider not available yet: {}".format(str(e)))
+                        return False
+
+                setting = schemas.get('setting') or {}
+                if 'PUT' not in setting.get('resourceMethods', []):
+                        log_debug("API provider is up with {} schemas, settings are not writable yet.".format(len(schemas)))
+                        return False
                 return True
 
         #
-        def __wait_for_api_provider(self):
-                rancher_version = str(os.environ['RANCHER_VERSION']).rstrip()
-                if "v2" in rancher_version:
-                    api_url = "http://{}:8080/v3".format(self.IP())
-                else:
-                    api_url = "http://{}:8080/v2-beta".format(self.IP())
+        def __wait_for_api_provider(self, timeout=READY_TIMEOUT):
+                """
+                Returns:
+                  float: seconds until the API provider was ready
+                """
+                api_url = "{}/{}".format(self.base_url(), self.config.api_version())
                 log_info("Polling \'{}\' for active API provider...".format(api_url))
 
                 try:
-                        request_with_retries('GET', api_url, step=60, attempts=60)
-                except (ConnectionError, HTTPError) as e:
-                        msg = "Timed out waiting for API provider to become available!: {}".format(e.message)
+                        _, elapsed = poll_with_backoff(lambda: self.__api_ready(api_url), timeout=timeout,
+                                                       description="API provider at '{}'".format(api_url))
+                except RuntimeError as e:
+                        msg = "Timed out waiting for API provider to become available!: {}".format(str(e))
                         log_debug(msg)
                         raise RancherServerError(msg) from e
-                return True
+
+                log_info("API provider at '{}' ready after {:.1f} seconds.".format(api_url, elapsed))
+                return elapsed
+
+        #
+        def __snapshot_file(self):
+                return self.config.workspace_file('server_snapshot')
+
+        #
+        def __restore_snapshot(self, host):
+                # what was restored is kept for configure(), which runs as a separate task
+                snapshots = server_snapshots()
+                image_id = snapshots.image_id(host, self.config.rancher_version)
+                entry = snapshots.lookup(self.config, image_id)
+                if entry is not None:
+                        snapshots.restore(entry, host)
+
+                save_json_cache(self.__snapshot_file(), {'image': image_id, 'restored': entry is not None})
 
         #
         def __install_server_container(self):
-                rancher_version = str(os.environ['RANCHER_VERSION']).rstrip()
-                server_os = str(os.environ['RANCHER_SERVER_OPERATINGSYSTEM']).rstrip()
-                os_settings = os_to_settings(server_os)
+                rancher_version = self.config.rancher_version
+                os_settings = self.config.server_os_settings()
+                host = (run_keypair().name, self.IP(), os_settings['ssh_username'])
 
                 log_info('Deploying rancher/server:{}...'.format(rancher_version))
 
                 try:
-                         sshcmd = 'sudo docker run -e CATTLE_PROCESS_INSTANCE_PURGE_AFTER_SECONDS=172800 -d -p 8080:8080 --restart=always rancher/server:{}'.format(rancher_version)
-                         SSH(self.name(), self.IP(), os_settings['ssh_username'], sshcmd)
+                         options = ''
+                         if 'on' == snapshot_mode():
+                                 self.__restore_snapshot(host)
+                                 options = '--name {} -v {}/mysql:/var/lib/mysql '.format(SERVER_CONTAINER, HOST_DATA_DIR)
+                         elif os.path.isfile(self.__snapshot_file()):
+                                 os.remove(self.__snapshot_file())
+
+                         sshcmd = 'sudo docker run -e CATTLE_PROCESS_INSTANCE_PURGE_AFTER_SECONDS=172800 -d -p 8080:8080 --restart=always {}rancher/server:{}'.format(options, rancher_version)
+                         SSH(host[0], host[1], host[2], sshcmd)
 
-                except SSHError as e:
+                except (SSHError, SnapshotError) as e:
                          msg = "Failed while deploying rancher/server container!: {}".format(str(e))
                          log_debug(msg)
                          raise RancherServerError(msg)
@@ -194,75 +242,246 @@ class RancherServer(object):
                 log_info("Installing Docker version '{}'...".format(docker_version))
 
                 try:
-                        server_os = str(os.environ['RANCHER_SERVER_OPERATINGSYSTEM']).rstrip()
-                        os_settings = os_to_settings(server_os)
+                        os_settings = self.config.server_os_settings()
 
-                        SCP(self.name(),
-                            self.IP(),
-                            os_settings['ssh_username'],
-                            './lib/bash/*.sh',
-                            '/tmp/')
+                        bootstrap_bundle().distribute([(run_keypair().name, self.IP(), os_settings['ssh_username'])])
 
-                        sshcmd = 'chmod +x /tmp/*.sh && /tmp/rancher_ci_bootstrap.sh'
-                        SSH(self.name(), self.IP(), os_settings['ssh_username'], sshcmd, max_attempts=1)
+                        sshcmd = '/tmp/rancher_ci_bootstrap.sh'
+                        SSH(run_keypair().name, self.IP(), os_settings['ssh_username'], sshcmd, max_attempts=1)
 
                         sshcmd = 'sudo usermod -aG docker $USER'
-                        SSH(self.name(), self.IP(), os_settings['ssh_username'], sshcmd, max_attempts=2)
+                        SSH(run_keypair().name, self.IP(), os_settings['ssh_username'], sshcmd, max_attempts=2)
 
-                except SSHError as e:
+                except (SSHError, ArtifactsError) as e:
                         msg = "Failed while installing Docker version {}!: {}".format(docker_version, str(e))
                         log_debug(msg)
                         raise RuntimeError(msg) from e
 
                 return True
 
+        #
+        def __lease_file(self):
+                return self.config.workspace_file('server_lease')
+
+        #
+        def __private(self):
+                # set when the shared server was leased to another build and this one runs its own
+                return load_json_cache(self.__lease_file()).get('private', False)
+
+        #
+        def __lease_group(self):
+                # leased servers which only differ in their Rancher version
+                return '|'.join([self.config.prefix or '', self.config.orchestration, self.config.docker_version, self.config.server_os])
+
+        #
+        def __retire_outdated_servers(self):
+                # servers of this group running another Rancher version are only in the way now
+                region = self.config.region
+                node_filter = [
+                        {'Name': 'tag:{}'.format(GROUP_TAG), 'Values': [self.__lease_group()]},
+                        {'Name': 'instance-state-name', 'Values': ['running', 'pending']}
+                ]
+
+                for record in iter_instances(node_filter, region):
+                        if self.config.rancher_version == record.tags.get(VERSION_TAG):
+                                continue
+                        lease = InstanceLease(record.id, region)
+                        if lease.try_acquire():
+                                log_info("Retiring leased server '{}' of Rancher '{}'...".format(record.name, record.tags.get(VERSION_TAG)))
+                                aws_client('ec2', region).terminate_instances(InstanceIds=[record.id])
+                                node_index(region).discard(record.name)
+                        else:
+                                log_info("Outdated server '{}' is still leased, leaving it.".format(record.name))
+
+        #
+        def __provision_shared(self):
+                # one build provisions the shared server while the others wait, then lease it from it.
+                # The server is launched already leased to us, so no build which finds it
+                # running in the meantime can take it from under the one paying for its boot.
+                region = self.config.region
+                index = node_index(region)
+
+                with named_lock("rancher-server {}".format(self.name()), region):
+                        index.refresh(self.name())
+                        if index.get(self.name(), states=['running', 'pending']) is not None:
+                                log_info("Another build provisioned '{}' meanwhile.".format(self.name()))
+                                return False
+
+                        try:
+                                node = self.__provision_node(extra_tags=[{'Key': GROUP_TAG, 'Value': self.__lease_group()},
+                                                                         {'Key': VERSION_TAG, 'Value': self.config.rancher_version}] + lease_tags())
+                        except RancherServerError:
+                                self.__release_failed_launch()
+                                raise
+
+                save_json_cache(self.__lease_file(), {'instance': node.id, 'reused': False})
+                return True
+
+        #
+        def __release_failed_launch(self):
+                # a server which never came up must not stay leased to us for the lease's whole
+                # TTL; the next build finds it unhealthy and replaces it
+                region = self.config.region
+                index = node_index(region)
+                index.discard(self.name())
+                try:
+                        node = index.get(self.name(), states=['running', 'pending'])
+                        if node is not None:
+                                InstanceLease(node.id, region).release()
+                except (InventoryError, LockError) as e:
+                        log_warn("Could not release the lease on '{}'!: {}".format(self.name(), e.message))
+
+        #
+        def __shared_server(self):
+                # a shared server another build is still booting is waited for, not provisioned twice
+                index = node_index(self.config.region)
+                node = index.get(self.name(), states=['running', 'pending'])
+                if node is not None and 'pending' == node.state:
+                        log_info("Waiting for shared Rancher Server '{}' being provisioned by another build...".format(self.name()))
+                        ec2_wait_for_state(node.id, 'running')
+                        node = index.get(self.name(), states=['running'])
+                return node
+
+        #
+        def __provision_private(self):
+                # the shared server is busy, and builds hold their lease for their whole run, so
+                # rather than waiting on it this run gets a server of its own, named after the run
+                # and reaped with it should teardown never run
+                log_warn("Shared Rancher Server '{}' is leased to another build, provisioning a private one...".format(self.name()))
+                save_json_cache(self.__lease_file(), {'private': True})
+                self.__provision_node()
+                return True
+
+        #
+        def __provision_leased(self):
+                region = self.config.region
+                index = node_index(region)
+
+                self.__retire_outdated_servers()
+
+                for _ in range(2):
+                        node = self.__shared_server()
+                        if node is None:
+                                if self.__provision_shared():
+                                        return True
+                                continue
+
+                        if not InstanceLease(node.id, region).try_acquire():
+                                return self.__provision_private()
+
+                        try:
+                                self.__wait_for_api_provider(timeout=120)
+                                save_json_cache(self.__lease_file(), {'instance': node.id, 'reused': True})
+                                self.__write_cattle_test_url()
+                                log_info("Reusing leased Rancher Server '{}' at '{}'.".format(self.name(), self.base_url()))
+                                return True
+
+                        except RancherServerError as e:
+                                log_warn("Leased server '{}' is not healthy, replacing it!: {}".format(self.name(), e.message))
+                                aws_client('ec2', region).terminate_instances(InstanceIds=[node.id])
+                                index.discard(self.name())
+                                ec2_wait_for_state(node.id, 'terminated')
+
+                raise RancherServerError("Could neither lease nor provision shared Rancher Server '{}'!".format(self.name()))
+
+        #
+        def __release_lease(self):
+                lease = load_json_cache(self.__lease_file())
+                if 'instance' not in lease:
+                        log_info("No leased Rancher Server to release.")
+                        return True
+
+                try:
+                        InstanceLease(lease['instance'], self.config.region).release()
+                except LockError as e:
+                        msg = "Failed while releasing leased Rancher Server!: {}".format(e.message)
+                        log_debug(msg)
+                        raise RancherServerError(msg) from e
+
+                os.remove(self.__lease_file())
+                return True
+
+        #
+        def __write_cattle_test_url(self):
+                cattle_test_url_filename = self.config.workspace_file('cattle_test_url')
+                log_debug("CATTLE_TEST_URL is set in '{}'...".format(cattle_test_url_filename))
+
+                with open(cattle_test_url_filename, 'w+') as f:
+                        f.write(self.base_url())
+                        f.close()
+
         #
         def provision(self):
+                """
+                In lease mode (RANCHER_SERVER_LEASE=on) a running server of the same
+                version, OS and orchestration is leased and reused, and only provisioned
+                when there is none. A build finding it leased to another provisions a
+                private server of its own instead of waiting.
+                """
+                if 'on' != lease_mode():
+                        return self.__provision_node()
+
                 try:
-                        server_os = str(os.environ['RANCHER_SERVER_OPERATINGSYSTEM']).rstrip()
-                        os_settings = os_to_settings(server_os)
-                        region = str(os.environ['AWS_DEFAULT_REGION']).rstrip()
+                        return self.__provision_leased()
+                except RancherServerError:
+                        raise
+                except (LockError, InventoryError, botocore_exceptions.ClientError, boto3_exceptions.Boto3Error, RuntimeError) as e:
+                        msg = "Failed while provisioning leased Rancher Server!: {}".format(str(e))
+                        log_debug(msg)
+                        raise RancherServerError(msg) from e
+
+        #
+        def __provision_node(self, extra_tags=None):
+                """
+                Returns:
+                  NodeRecord: the server's node
+                """
+                try:
+                        os_settings = self.config.server_os_settings()
+                        region = self.config.region
                         ssh_user = os_settings['ssh_username']
 
-                        ec2_node_ensure(self.name(), instance_type=os.environ.get('RANCHER_SERVER_AWS_INSTANCE_TYPE'))
-                        node_addr = ec2_node_public_ip(self.name(), region=region)
+                        node = ec2_node_ensure(self.name(), instance_type=self.config.server_instance_type, config=self.config, extra_tags=extra_tags)
+                        node_addr = node.public_ip
 
-                        SCP(self.name(), node_addr, ssh_user, './lib/bash/*.sh', '/tmp/')
-                        SSH(self.name(), node_addr, ssh_user, 'chmod +x /tmp/*.sh && /tmp/rancher_ci_bootstrap.sh')
+                        if 'userdata' == bootstrap_mode():
+                                ec2_wait_for_bootstrap([self.name()], region=region)
+                        else:
+                                bootstrap_bundle().distribute([(run_keypair().name, node_addr, ssh_user)])
+                                SSH(run_keypair().name, node_addr, ssh_user, '/tmp/rancher_ci_bootstrap.sh')
 
 #                        # CoreOS and RancherOS ship w/ vendored Docker engine
 #                        if 'rancher' not in server_os and 'core' not in server_os:
 #                               self.__docker_install()
 
                         self.__install_server_container()
-                        pwd = str(os.environ['WORKSPACE_DIR']).rstrip()
-                        cattle_test_url_filename = pwd + '/cattle_test_url'
-                        log_debug("Current working directory: {}".format(pwd))
-                        if os.environ.get('BUILD_NUMBER'):
-                                cattle_test_url_filename = "{}/cattle_test_url.{}".format(pwd, os.environ.get('BUILD_NUMBER'))
-                                log_debug("Found BUILD_NUMBER so CATTLE_TEST_URL set in '{}'...".format(cattle_test_url_filename))
-                        else:
-                                log_debug("Did not find BUILD_NUMBER so CATTLE_TEST_URL is set in default of 'cattle_test_url'...")
-
-                        with open(cattle_test_url_filename, 'w+') as f:
-                                f.write("http://{}:8080".format(self.IP()))
-                                f.close()
+                        self.__write_cattle_test_url()
 
-                        public_ip = ec2_node_public_ip(self.name())
-                        log_info("Rancher Server will be available at 'http://{}:8080' shortly...".format(public_ip))
+                        log_info("Rancher Server will be available at 'http://{}:8080' shortly...".format(node.public_ip))
 
                 except RuntimeError as e:
                         msg = "Failed while provisining Rancher Server!: {}".format(str(e))
                         log_debug(msg)
                         raise RancherServerError(msg) from e
 
+                return node
+
+        #
+        def api(self):
+                return rancher_api(self.base_url(), self.config.api_version())
+
+        #
+        def project_id(self):
+                if 'k8s' != self.config.orchestration:
+                        return DEFAULT_PROJECT
+                return self.api().environment_id(K8S_ENVIRONMENT)
+
         #
         def __set_reg_token(self, project_id):
                 log_info("Setting the initial agent reg token...")
-                reg_url = "http://{}:8080/v2-beta/projects/{}/registrationtokens".format(self.IP(), project_id)
                 try:
-                        response = request_with_retries('POST', reg_url, step=20, attempts=20)
-                except RancherServerError as e:
+                        response = self.api().create_registration_token(project_id)
+                except RancherAPIError as e:
                         msg = "Failed creating initial agent registration token! : {}".format(e.message)
                         log_debug(msg)
                         raise RancherServerError(msg) from e
@@ -274,23 +493,10 @@ class RancherServer(object):
         #
         def reg_command(self):
                 try:
-                        rancher_version = str(os.environ['RANCHER_VERSION']).rstrip()
-                        rancher_orch = str(os.environ['RANCHER_ORCHESTRATION']).rstrip()
-                        project_id = '1a5'
-                        if rancher_orch == 'k8s':
-                            project_id = run('rancher --url http://{}:8080 env ls --quiet | grep -v 1a5'.format(self.IP())).stdout.rstrip('\n\r')
-                        if "v2" in rancher_version:
-                            query_url = "http://{}:8080/v3/clusters/1c1/".format(self.IP())
-                            response = request_with_retries('GET', query_url)
-                            reg_command = response.json()['registrationToken']['hostCommand']
-                        else:
-                            query_url = "http://{}:8080/v2-beta/projects/{}/registrationtokens?state=active&limit=-1&sort=name".format(self.IP(), project_id)
-                            response = request_with_retries('GET', query_url)
-                            reg_command = response.json()['data'][0]['command']
-
+                        reg_command = self.api().registration_command(self.project_id())
                         log_debug("reg command: {}".format(reg_command))
 
-                except (IndexError, KeyError, RancherServerError) as e:
+                except (RancherAPIError, RancherServerError) as e:
                         msg = "Failed while retrieving registration command!: {}".format(str(e))
                         log_debug(msg)
                         raise RancherServerError(msg) from e
@@ -298,64 +504,82 @@ class RancherServer(object):
                 return reg_command
 
         #
-        def __set_reg_url(self):
-                log_info("Setting the agent registration URL...")
-                rancher_version = str(os.environ['RANCHER_VERSION']).rstrip()
-                if "v2" in rancher_version:
-                    reg_url = "http://{}:8080/v3/settings/api.host".format(self.IP())
-                else:
-                    reg_url = "http://{}:8080/v2-beta/settings/api.host".format(self.IP())
+        def __apply_settings(self):
+                log_info("Applying Rancher Server settings...")
                 try:
-                        request_data = {
-                                "type": "activeSetting",
-                                "name": "api.host",
-                                "activeValue": "",
-                                "inDb": False,
-                                "source": "",
-                                "value": "http://{}:8080".format(self.IP())
-                        }
-
-                        response = request_with_retries('PUT', reg_url, request_data)
-
-                except Failure as e:
-                        msg = "Failed setting the agent registration URL! : {}".format(str(e))
+                        # api.host is the URL agents register with
+                        changed = self.api().apply_settings({'api.host': self.base_url()})
+
+                except RancherAPIError as e:
+                        msg = "Failed applying Rancher Server settings! : {}".format(e.message)
                         log_debug(msg)
                         raise RancherServerError(msg) from e
 
-                log_debug("reg url response: {}".format(response))
-                log_info('Successfully set the agent registration URL.')
+                log_info("Successfully applied Rancher Server settings, {} changed.".format(len(changed)))
                 return True
 
+        #
+        def __record_time_to_ready(self, elapsed):
+                try:
+                        history = run_history(self.config.workspace)
+                        history.record_stages(history.record_run(self.config),
+                                              {'rancher_server.ready': {'exit_code': 0, 'elapsed': elapsed}})
+                except HistoryError as e:
+                        log_warn("Could not record time to ready!: {}".format(e.message))
+
+        #
+        def __capture_snapshot(self, image_id):
+                # a failed capture costs the next build its head start, not this one its server
+                try:
+                        host = (run_keypair().name, self.IP(), self.config.server_os_settings()['ssh_username'])
+                        server_snapshots().capture(self.config, image_id, host)
+                except SnapshotError as e:
+                        log_warn("Could not capture a server snapshot!: {}".format(e.message))
+
+                self.__wait_for_api_provider()
+
         #
         def configure(self):
+                """
+                A server started from a snapshot already holds its environment and
+                registration token, so only its settings are applied. A server started
+                empty in snapshot mode is captured once configured. A reused leased
+                server has the hosts, stacks and environments of its last build
+                removed first.
+
+                Returns:
+                  float: seconds the API provider took to become ready
+                """
+                snapshot = load_json_cache(self.__snapshot_file())
+                reused = 'on' == lease_mode() and load_json_cache(self.__lease_file()).get('reused', False)
+                restored = snapshot.get('restored', False)
+
                 try:
-                        rancher_orch = str(os.environ['RANCHER_ORCHESTRATION']).rstrip()
-                        self.__wait_for_api_provider()
-                        log_info("Though the API provider is available, experience suggests sleeping for a bit is a good idea...")
-                        sleep(30)
-                        project_id = '1a5'
-                        if rancher_orch == 'k8s':
-                            project_id = run('rancher --url http://{}:8080 env create -t kubernetes kubetest'.format(self.IP())).stdout.rstrip('\r\n')
-                        pwd = str(os.environ['WORKSPACE_DIR']).rstrip()
-                        project_id_filename = pwd + '/project_id'
-                        log_debug("Current working directory: {}".format(pwd))
-                        if os.environ.get('BUILD_NUMBER'):
-                                project_id_filename = "{}/project_id.{}".format(pwd, os.environ.get('BUILD_NUMBER'))
-                                log_debug("Found BUILD_NUMBER so PROJECT_ID set in '{}'...".format(project_id_filename))
-                        else:
-                                log_debug("Did not find BUILD_NUMBER so PROJECT_ID is set in default of 'project_id'...")
+                        time_to_ready = self.__wait_for_api_provider()
+                        self.__record_time_to_ready(time_to_ready)
+
+                        if reused:
+                                self.api().reset()
+
+                        project_id = DEFAULT_PROJECT
+                        if 'k8s' == self.config.orchestration:
+                                project_id = self.api().create_environment(K8S_ENVIRONMENT, 'kubernetes')
+                        project_id_filename = self.config.workspace_file('project_id')
+                        log_debug("PROJECT_ID is set in '{}'...".format(project_id_filename))
 
                         with open(project_id_filename, 'w+') as f:
                                 f.write("{}".format(project_id))
                                 f.close()
-                        rancher_version = str(os.environ['RANCHER_VERSION']).rstrip()
-                        if "v2" not in rancher_version:
+                        if 'v3' != self.config.api_version() and not restored:
                             self.__set_reg_token(project_id)
-                        self.__set_reg_url()
+                        self.__apply_settings()
+
+                        if snapshot and not restored and not reused:
+                                self.__capture_snapshot(snapshot['image'])
 
-                except RancherServerError as e:
-                        msg = "Failed while configuring Rancher server \'{}\'!: {}".format(self.__name(), e.message)
+                except (RancherServerError, RancherAPIError) as e:
+                        msg = "Failed while configuring Rancher server \'{}\'!: {}".format(self.name(), e.message)
                         log_debug(msg)
-                        raise RancherServer(msg) from e
+                        raise RancherServerError(msg) from e
 
-                return True
+                return time_to_ready
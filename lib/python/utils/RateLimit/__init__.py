@@ -0,0 +1,208 @@
+import os, time, threading
+
+from .. import log_debug, aws_client, botocore, botocore_waiter
+
+
+# Requests per second and burst per EC2 API action, kept well below the account
+# wide EC2 request limits so a large run does not starve other jobs in the account.
+DEFAULT_LIMITS = {
+    'RunInstances': (2.0, 5),
+    'TerminateInstances': (5.0, 20),
+    'CreateTags': (10.0, 50),
+    'CreateFleet': (1.0, 2),
+}
+
+# anything not listed above, mostly Describe* calls
+DEFAULT_RATE = 20.0
+DEFAULT_BURST = 50
+
+
+#
+class RateLimitError(RuntimeError):
+    message = None
+
+    def __init__(self, message):
+        self.message = message
+        super(RateLimitError, self).__init__(self.message)
+
+
+#
+class TokenBucket(object):
+    """
+    Classic token bucket: holds up to 'burst' tokens and refills at 'rate' per second.
+    """
+
+    #
+    def __init__(self, rate, burst, clock=time.monotonic, sleep=time.sleep):
+        if rate <= 0 or burst < 1:
+            raise RateLimitError("Token bucket needs a positive rate and a burst of at least 1, got {}/{}!".format(rate, burst))
+
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.clock = clock
+        self.sleep = sleep
+
+        self.__tokens = self.burst
+        self.__updated = clock()
+        self.__lock = threading.Lock()
+
+    #
+    def __refill(self):
+        now = self.clock()
+        self.__tokens = min(self.burst, self.__tokens + (now - self.__updated) * self.rate)
+        self.__updated = now
+
+    #
+    def acquire(self, tokens=1):
+        """
+        Block until 'tokens' are available and take them.
+
+        Returns:
+          float: seconds spent waiting
+        """
+        if tokens > self.burst:
+            raise RateLimitError("Cannot take {} tokens from a bucket holding at most {}!".format(tokens, self.burst))
+
+        waited = 0.0
+        while True:
+            with self.__lock:
+                self.__refill()
+                if self.__tokens >= tokens:
+                    self.__tokens -= tokens
+                    return waited
+                delay = (tokens - self.__tokens) / self.rate
+
+            self.sleep(delay)
+            waited += delay
+
+
+#
+class RateLimiter(object):
+    """
+    One token bucket per API action, created on first use.
+    """
+
+    #
+    def __init__(self, limits=None, rate=DEFAULT_RATE, burst=DEFAULT_BURST, clock=time.monotonic, sleep=time.sleep):
+        """
+        Args:
+          limits (dict): (rate, burst) per action name, defaults to DEFAULT_LIMITS
+          rate (float): rate of actions without an explicit limit
+          burst (int): burst of actions without an explicit limit
+        """
+        self.limits = dict(DEFAULT_LIMITS if limits is None else limits)
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+        self.waited = {}
+
+        self.__buckets = {}
+        self.__lock = threading.Lock()
+
+    #
+    def bucket(self, action):
+        with self.__lock:
+            if action not in self.__buckets:
+                rate, burst = self.limits.get(action, (self.rate, self.burst))
+                self.__buckets[action] = TokenBucket(rate, burst, clock=self.clock, sleep=self.sleep)
+            return self.__buckets[action]
+
+    #
+    def acquire(self, action, tokens=1):
+        waited = self.bucket(action).acquire(tokens)
+        if waited > 0:
+            with self.__lock:
+                self.waited[action] = self.waited.get(action, 0.0) + waited
+        return waited
+
+
+#
+class ThrottledPaginator(object):
+    """
+    Wraps a boto3 paginator so every page takes a token for the paginated action.
+    Only iterating over the pages is supported, and only EC2 style NextToken
+    pagination, which tells whether another page, and so another call, follows.
+    """
+
+    #
+    def __init__(self, paginator, throttle, action):
+        self.paginator = paginator
+        self.throttle = throttle
+        self.action = action
+
+    #
+    def paginate(self, **kwargs):
+        self.throttle(self.action)
+        for page in self.paginator.paginate(**kwargs):
+            if page.get('NextToken'):
+                self.throttle(self.action)
+            yield page
+
+
+#
+class ThrottledClient(object):
+    """
+    Wraps a boto3 client so every API call first takes a token for its action.
+    Paginators take a token per page and waiters one per poll. Everything else
+    (meta, exceptions) passes through.
+    """
+
+    #
+    def __init__(self, client, limiter):
+        self.client = client
+        self.limiter = limiter
+
+    #
+    def throttle(self, action):
+        waited = self.limiter.acquire(action)
+        if waited > 0:
+            log_debug("Throttled '{}' for {:.2f}s.".format(action, waited))
+        return waited
+
+    #
+    def get_paginator(self, operation_name):
+        action = self.client.meta.method_to_api_mapping[operation_name]
+        return ThrottledPaginator(self.client.get_paginator(operation_name), self.throttle, action)
+
+    #
+    def get_waiter(self, waiter_name):
+        # the same waiter, polling through this client instead of the raw one
+        waiter = self.client.get_waiter(waiter_name)
+        poll = getattr(self, botocore.xform_name(waiter.config.operation))
+        return botocore_waiter.Waiter(waiter.name, waiter.config, botocore_waiter.NormalizedOperationMethod(poll))
+
+    #
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        action = self.client.meta.method_to_api_mapping.get(name)
+        if action is None or not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            self.throttle(action)
+            return attr(*args, **kwargs)
+
+        return call
+
+
+# limiter shared by every throttled client in this process, so concurrent stages
+# draw from the same per-action budgets
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+#
+def rate_limiter():
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            scale = float(os.environ.get('RANCHER_API_RATE_SCALE', 1.0))
+            limits = dict((action, (rate * scale, burst)) for action, (rate, burst) in DEFAULT_LIMITS.items())
+            _limiter = RateLimiter(limits, rate=DEFAULT_RATE * scale)
+        return _limiter
+
+
+#
+def throttled_client(service, region=None):
+    return ThrottledClient(aws_client(service, region), rate_limiter())
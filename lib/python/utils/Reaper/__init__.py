@@ -0,0 +1,146 @@
+import time
+
+from .. import log_debug, log_info, log_warn, aws_get_region
+from .. import boto3_exceptions, botocore_exceptions
+from ..Inventory import INDEXED_STATES, iter_instances, node_index
+from ..Lease import GROUP_TAG
+from ..Namespace import RUN_TAG, RUN_EXPIRES_TAG, run_ttl
+from ..RateLimit import throttled_client
+from ..Scale import EC2_MAX_IDS, chunks
+
+
+#
+class ReaperError(RuntimeError):
+    message = None
+
+    def __init__(self, message):
+        self.message = message
+        super(ReaperError, self).__init__(self.message)
+
+
+#
+def node_expiry(record, ttl):
+    """
+    Returns:
+      float: when 'record' may be reaped, from its RUN_EXPIRES_TAG or else its launch time
+    """
+    try:
+        return float(record.tags.get(RUN_EXPIRES_TAG))
+    except (TypeError, ValueError):
+        pass
+    if record.launched is not None:
+        return record.launched + ttl
+    return None
+
+
+#
+def expired_runs(region=None, keep=None, now=None):
+    """
+    Runs none of whose nodes is live any more, that is every node is past its expiry.
+
+    Leased servers outlive the run which launched them and are retired through
+    their lease group instead, so they are never considered.
+
+    Args:
+      keep (str): run id to leave alone whatever its nodes say, usually our own
+
+    Returns:
+      dict: node records per expired run id
+    """
+    now = time.time() if now is None else now
+    ttl = run_ttl()
+    node_filter = [
+        {'Name': 'tag-key', 'Values': [RUN_TAG]},
+        {'Name': 'instance-state-name', 'Values': INDEXED_STATES}
+    ]
+
+    runs = {}
+    live = set()
+    for record in iter_instances(node_filter, region):
+        run = record.tags.get(RUN_TAG)
+        if keep == run or GROUP_TAG in record.tags:
+            continue
+
+        expiry = node_expiry(record, ttl)
+        if expiry is None or expiry > now:
+            live.add(run)
+        runs.setdefault(run, []).append(record)
+
+    return dict((run, records) for run, records in runs.items() if run not in live)
+
+
+#
+def expire_run(run, region=None):
+    """
+    Mark every node of run 'run' as expired right away, e.g. after its provisioning
+    failed, so the next reap removes them rather than waiting out RANCHER_CI_RUN_TTL.
+
+    Returns:
+      int: number of nodes marked
+    """
+    region = region or aws_get_region()
+    ec2 = throttled_client('ec2', region)
+    node_filter = [
+        {'Name': 'tag:{}'.format(RUN_TAG), 'Values': [run]},
+        {'Name': 'instance-state-name', 'Values': INDEXED_STATES}
+    ]
+
+    try:
+        ids = [record.id for record in iter_instances(node_filter, region) if GROUP_TAG not in record.tags]
+        for batch in chunks(ids, EC2_MAX_IDS):
+            ec2.create_tags(Resources=batch, Tags=[{'Key': RUN_EXPIRES_TAG, 'Value': "{:.0f}".format(time.time())}])
+
+    except (botocore_exceptions.ClientError, boto3_exceptions.Boto3Error) as e:
+        msg = "Failed while expiring the nodes of run '{}'!: {}".format(run, str(e))
+        log_debug(msg)
+        raise ReaperError(msg) from e
+
+    log_warn("Marked {} nodes of run '{}' as expired.".format(len(ids), run))
+    return len(ids)
+
+
+#
+def reap_expired_runs(region=None, keep=None):
+    """
+    Terminate the nodes of every expired run and delete the runs' key pairs.
+
+    This is how the nodes of a crashed or aborted build, or of one which stopped
+    after provisioning, go away once no later build knows their run id.
+
+    Returns:
+      dict: number of 'runs', 'nodes' and 'keypairs' reaped
+    """
+    region = region or aws_get_region()
+    ec2 = throttled_client('ec2', region)
+    reaped = {'runs': 0, 'nodes': 0, 'keypairs': 0}
+
+    try:
+        runs = expired_runs(region, keep)
+        for run, records in sorted(runs.items()):
+            log_info("Reaping {} nodes of expired run '{}': {}".format(len(records), run, ', '.join(str(r.name) for r in records)))
+            for batch in chunks([r.id for r in records], EC2_MAX_IDS):
+                ec2.terminate_instances(InstanceIds=batch)
+            for record in records:
+                if record.name is not None:
+                    node_index(region).discard(record.name)
+
+            # the run's key pair is '<prefix><run id>-rancher-ci', whatever prefix the run had
+            keypairs = ec2.describe_key_pairs(Filters=[{'Name': 'key-name', 'Values': ["*{}-rancher-ci".format(run)]}])['KeyPairs']
+            for keypair in keypairs:
+                log_debug("Removing key pair '{}' of expired run '{}'...".format(keypair['KeyName'], run))
+                ec2.delete_key_pair(KeyName=keypair['KeyName'])
+
+            reaped['runs'] += 1
+            reaped['nodes'] += len(records)
+            reaped['keypairs'] += len(keypairs)
+
+    except (botocore_exceptions.ClientError, boto3_exceptions.Boto3Error) as e:
+        msg = "Failed while reaping expired runs in '{}'!: {}".format(region, str(e))
+        log_debug(msg)
+        raise ReaperError(msg) from e
+
+    if 0 == reaped['runs']:
+        log_info("No expired runs to reap in '{}'.".format(region))
+    else:
+        log_warn("Reaped {nodes} nodes and {keypairs} key pairs of {runs} expired runs.".format(**reaped))
+    return reaped
@@ -0,0 +1,191 @@
+import os
+
+from collections import namedtuple
+
+from .. import os_to_settings
+
+
+# (attribute, environment variable, default) of every setting which describes one
+# Rancher cluster. Process wide knobs such as credentials, placement, bootstrap mode
+# and rate limits stay in the environment.
+FIELDS = [
+    ('prefix', 'AWS_PREFIX', None),
+    ('region', 'AWS_DEFAULT_REGION', None),
+    ('aws_tags', 'AWS_TAGS', None),
+    ('rancher_version', 'RANCHER_VERSION', None),
+    ('docker_version', 'RANCHER_DOCKER_VERSION', None),
+    ('docker_native', 'RANCHER_DOCKER_NATIVE', 'false'),
+    ('rhel_selinux', 'RANCHER_DOCKER_RHEL_SELINUX', 'false'),
+    ('orchestration', 'RANCHER_ORCHESTRATION', None),
+    ('server_os', 'RANCHER_SERVER_OPERATINGSYSTEM', None),
+    ('server_instance_type', 'RANCHER_SERVER_AWS_INSTANCE_TYPE', None),
+    ('agent_os', 'RANCHER_AGENT_OPERATINGSYSTEM', None),
+    ('agent_instance_type', 'RANCHER_AGENT_AWS_INSTANCE_TYPE', None),
+    ('agent_count', 'RANCHER_AGENTS_COUNT', None),
+    ('agent_capacity', 'RANCHER_AGENT_CAPACITY', 'on-demand'),
+    ('agent_fleet', 'RANCHER_AGENT_FLEET', 'false'),
+    ('agent_volume_size', 'RANCHER_AGENT_VOLUME_SIZE', None),
+    ('registration_command', 'RANCHER_REGISTRATION_COMMAND', None),
+    ('workspace', 'WORKSPACE_DIR', None),
+    ('build_number', 'BUILD_NUMBER', None),
+    ('run_id', 'RANCHER_CI_RUN_ID', None),
+]
+
+ENVVARS = dict((envvar, attr) for attr, envvar, default in FIELDS)
+
+INT_FIELDS = ['agent_count', 'agent_volume_size']
+BOOL_FIELDS = ['agent_fleet']
+
+
+#
+class RunConfigError(RuntimeError):
+    message = None
+
+    def __init__(self, message):
+        self.message = message
+        super(RunConfigError, self).__init__(self.message)
+
+
+#
+def _parse(attr, value):
+    if value is None:
+        return None
+
+    value = str(value).rstrip()
+    if attr in INT_FIELDS:
+        if '' == value:
+            return None
+        try:
+            return int(value)
+        except ValueError as e:
+            raise RunConfigError("Setting '{}' must be an integer, got '{}'!".format(attr, value)) from e
+    if attr in BOOL_FIELDS:
+        return 'true' == value.lower()
+    return value
+
+
+#
+class RunConfig(namedtuple('RunConfig', [attr for attr, envvar, default in FIELDS] + ['label'])):
+    """
+    Everything which describes one Rancher cluster, read and validated once.
+
+    A RunConfig is immutable. Matrix runs derive one config per combination with
+    replace(), so any number of clusters can be provisioned side by side in one
+    process without touching os.environ.
+    """
+
+    __slots__ = ()
+
+    #
+    @classmethod
+    def from_environ(cls, environ=None, **overrides):
+        """
+        Args:
+          environ (dict): where to read the settings from, defaults to os.environ
+          overrides: attribute values taking precedence over the environment
+        """
+        environ = os.environ if environ is None else environ
+
+        values = {'label': None}
+        for attr, envvar, default in FIELDS:
+            values[attr] = _parse(attr, environ.get(envvar, default))
+
+        for attr, value in overrides.items():
+            if attr not in values:
+                raise RunConfigError("Unknown run setting '{}'!".format(attr))
+            values[attr] = value if 'label' == attr else _parse(attr, value)
+
+        if values['run_id'] is None:
+            from ..Namespace import run_id
+            values['run_id'] = run_id(values['workspace'], values['build_number'])
+
+        return cls(**values)
+
+    #
+    def replace(self, **overrides):
+        unknown = [attr for attr in overrides if attr not in self._fields]
+        if 0 != len(unknown):
+            raise RunConfigError("Unknown run settings: {}".format(', '.join(sorted(unknown))))
+        return self._replace(**dict((attr, value if 'label' == attr else _parse(attr, value)) for attr, value in overrides.items()))
+
+    #
+    def missing(self, envvars):
+        """
+        Returns:
+          list: those of 'envvars' which are neither set on this config nor, for
+                process wide settings, in the environment
+        """
+        missing = []
+        for envvar in envvars:
+            if envvar in ENVVARS:
+                if getattr(self, ENVVARS[envvar]) in [None, '']:
+                    missing.append(envvar)
+            elif envvar not in os.environ:
+                missing.append(envvar)
+        return missing
+
+    #
+    def __name_prefix(self):
+        if self.prefix is None:
+            return ''
+        return "{}-".format(self.prefix.replace('.', '-'))
+
+    #
+    def __name(self, node_os, role, shared=False):
+        # nodes shared between builds are named by what they run only, all others by their build too
+        prefix = self.__name_prefix()
+        if self.run_id and not shared:
+            prefix = "{}{}-".format(prefix, self.run_id)
+        return "{}{}-{}-d{}-{}-{}".format(prefix,
+                                          self.rancher_version.replace('.', ''),
+                                          self.orchestration,
+                                          self.docker_version.replace('.', '').replace('~', ''),
+                                          node_os,
+                                          role).rstrip()
+
+    #
+    def server_name(self, shared=False):
+        """
+        Args:
+          shared (bool): name of a server leased across builds, without the run id
+        """
+        return "{}0".format(self.__name(self.server_os, 'server', shared))
+
+    #
+    def agent_prefix(self):
+        return self.__name(self.agent_os, 'agent')
+
+    #
+    def agent_names(self, count=None):
+        count = self.agent_count if count is None else count
+        return ["{}{}".format(self.agent_prefix(), i) for i in range(count)]
+
+    #
+    def server_os_settings(self):
+        return os_to_settings(self.server_os, self.region)
+
+    #
+    def agent_os_settings(self):
+        return os_to_settings(self.agent_os, self.region)
+
+    #
+    def api_version(self):
+        return 'v3' if 'v2' in self.rancher_version else 'v2-beta'
+
+    #
+    def workspace_file(self, basename):
+        """
+        Path of a per-run file under WORKSPACE_DIR, suffixed by BUILD_NUMBER and the
+        matrix label when set so concurrent clusters do not overwrite each other.
+        """
+        path = os.path.join(self.workspace or os.getcwd(), basename)
+        if self.build_number:
+            path = "{}.{}".format(path, self.build_number)
+        if self.label:
+            path = "{}.{}".format(path, self.label)
+        return path
+
+    #
+    def describe(self):
+        return self.label or "{} {} docker {} server {} agents {}".format(
+            self.rancher_version, self.orchestration, self.docker_version, self.server_os, self.agent_os)
@@ -1,7 +1,10 @@
 import time
+from concurrent.futures import ThreadPoolExecutor
 from invoke import run, Failure
 
-from .. import log_debug, log_info
+from .. import log_debug, log_info, log_warn
+from ..KeyPair import key_path
+from ..Deadline import DeadlineError, run_deadline
 
 
 #
@@ -13,6 +16,14 @@ class SSHError(RuntimeError):
         super(SSHError, self).__init__(self.message)
 
 
+#
+def ssh_options(key, timeout=10, tty=False):
+    options = '-o StrictHostKeyChecking=no -o ConnectTimeout={} -i {}'.format(timeout, key_path(key))
+    if tty:
+        options = '-o StrictHostKeyChecking=no -o ConnectTimeout={} -tt -i {}'.format(timeout, key_path(key))
+    return options
+
+
 #
 class SSH(object):
 
@@ -36,7 +47,7 @@ class SSH(object):
             except Failure as e:
                 msg = "ssh command failed!: {} :: {}".format(e.result.return_code, e.result.stderr)
                 log_info(msg)
-                time.sleep(30)
+                run_deadline().sleep(30, "ssh to '{}'".format(addr))
 
         if attempts >= max_attempts and not result:
             msg = "SSH command exceeded max attempts!"
@@ -47,7 +58,7 @@ class SSH(object):
 
     #
     def __init__(self, key, addr, user, cmd, timeout=10, max_attempts=10):
-        self.default_ssh_options = '-o StrictHostKeyChecking=no -o ConnectTimeout={} -tt -i .ssh/{}'.format(timeout, key)
+        self.default_ssh_options = ssh_options(key, timeout, tty=True)
         self.__cmd(key, addr, user, cmd, max_attempts)
 
 
@@ -74,7 +85,7 @@ class SCP(object):
             except Failure as e:
                 msg = "scp command failed!: {} :: {}".format(e.result.return_code, e.result.stderr)
                 log_debug(msg)
-                time.sleep(30)
+                run_deadline().sleep(30, "scp to '{}'".format(addr))
 
         if attempts >= max_attempts and not result:
             msg = "SCP command exceeded max attempts!"
@@ -86,5 +97,101 @@ class SCP(object):
 
     #
     def __init__(self, key, addr, user, src, dest, timeout=10, max_attempts=10):
-        self.default_ssh_options = '-o StrictHostKeyChecking=no -o ConnectTimeout={} -i .ssh/{}'.format(timeout, key)
+        self.default_ssh_options = ssh_options(key, timeout)
         self.__cp(key, addr, user, src, dest, timeout, max_attempts)
+
+
+#
+class SSHBroadcast(object):
+    """
+    Run one command on many hosts concurrently and record how long each took.
+
+    Hosts taking more than straggler_factor times the median are reported as
+    stragglers once every host has finished.
+    """
+
+    #
+    def __init__(self, hosts, cmd, max_workers=16, straggler_factor=2.0, timeout=10, max_attempts=10, progress=None):
+        """
+        Args:
+          hosts (list): (ssh key name, address, ssh user) tuples
+          cmd (str): command run on every host
+          max_workers (int): number of concurrent ssh sessions
+          straggler_factor (float): multiple of the median latency making a host a straggler
+          progress (Progress): updated as each host finishes
+        """
+        self.hosts = list(hosts)
+        self.cmd = cmd
+        self.max_workers = max_workers
+        self.progress = progress
+        self.straggler_factor = straggler_factor
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.latencies = {}
+
+    #
+    def __run_one(self, key, addr, user):
+        start_time = time.time()
+        SSH(key, addr, user, self.cmd, timeout=self.timeout, max_attempts=self.max_attempts)
+        return time.time() - start_time
+
+    #
+    def run(self):
+        """
+        Returns:
+          dict: seconds taken per address
+        """
+        if 0 == len(self.hosts):
+            return {}
+
+        log_info("Running command on {} hosts...".format(len(self.hosts)))
+        errors = []
+        exceeded = False
+
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(self.hosts)))) as pool:
+            futures = dict((pool.submit(self.__run_one, key, addr, user), addr) for key, addr, user in self.hosts)
+            if self.progress is not None:
+                for future in futures:
+                    future.add_done_callback(lambda f: self.progress.update())
+
+            for future, addr in futures.items():
+                try:
+                    self.latencies[addr] = future.result()
+                except SSHError as e:
+                    errors.append("{}: {}".format(addr, e.message))
+                except DeadlineError as e:
+                    errors.append("{}: {}".format(addr, e.message))
+                    exceeded = True
+
+        if exceeded:
+            run_deadline().log_report()
+        if 0 != len(errors):
+            msg = "Command failed on {} of {} hosts!: {}".format(len(errors), len(self.hosts), ' :: '.join(errors))
+            log_debug(msg)
+            raise SSHError(msg)
+
+        self.report()
+        return self.latencies
+
+    #
+    def stragglers(self):
+        """
+        Returns:
+          list: (address, seconds) of hosts much slower than the median, slowest first
+        """
+        if 0 == len(self.latencies):
+            return []
+
+        ordered = sorted(self.latencies.values())
+        median = ordered[len(ordered) // 2]
+        slow = [(addr, t) for addr, t in self.latencies.items() if t > median * self.straggler_factor]
+        return sorted(slow, key=lambda item: item[1], reverse=True)
+
+    #
+    def report(self):
+        ordered = sorted(self.latencies.values())
+        log_info("Command finished on {} hosts: min {:.1f}s, median {:.1f}s, max {:.1f}s.".format(
+            len(ordered), ordered[0], ordered[len(ordered) // 2], ordered[-1]))
+
+        for addr, elapsed in self.stragglers():
+            log_warn("Straggler '{}' took {:.1f}s.".format(addr, elapsed))
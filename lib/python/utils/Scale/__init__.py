@@ -0,0 +1,186 @@
+import os, time, threading
+
+from .. import log_debug, log_info, ec2_compute_tags, ec2_launch_spec
+from .. import boto3_exceptions, botocore_exceptions
+from ..Deadline import run_deadline, waiter_config
+from ..Inventory import InventoryError, node_index
+from ..Placement import parse_instance_types
+from ..RateLimit import throttled_client
+
+
+# EC2 accepts at most 1000 instance ids per terminate / describe call
+EC2_MAX_IDS = 1000
+
+
+#
+class ScaleError(RuntimeError):
+    message = None
+
+    def __init__(self, message):
+        self.message = message
+        super(ScaleError, self).__init__(self.message)
+
+
+#
+def chunks(items, size):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+#
+class Progress(object):
+    """
+    Thread safe counter which logs how far a long running step got, at most
+    every 'interval' seconds and once when it completes.
+    """
+
+    #
+    def __init__(self, label, total, interval=15):
+        self.label = label
+        self.total = total
+        self.interval = interval
+        self.done = 0
+
+        self.__start = time.time()
+        self.__logged = 0
+        self.__lock = threading.Lock()
+
+    #
+    def update(self, count=1):
+        with self.__lock:
+            self.done += count
+            now = time.time()
+            if self.done < self.total and now - self.__logged < self.interval:
+                return
+            self.__logged = now
+            done, elapsed = self.done, now - self.__start
+
+        log_info("{}: {}/{} ({:.0f}%) after {:.0f}s".format(self.label, done, self.total, 100.0 * done / max(1, self.total), elapsed))
+
+
+#
+class ScaleLauncher(object):
+    """
+    Launch and terminate many identically configured nodes in batches.
+
+    Each batch is a single run_instances call placed through the scheduler, so a
+    batch which does not fit in a zone fails over as a whole. Every EC2 call goes
+    through the process wide rate limiter.
+    """
+
+    #
+    def __init__(self, name, scheduler, instance_types, batch_size=None, config=None):
+        """
+        Args:
+          name (str): common name of the nodes, used for logging and the shared tags
+          scheduler (PlacementScheduler): supplies the subnets and records outcomes
+          instance_types (str|list): ranked instance types, a list or comma separated
+          batch_size (int): nodes per run_instances call, defaults to RANCHER_SCALE_BATCH_SIZE or 50
+          config (RunConfig): cluster the nodes belong to, for their tags
+        """
+        self.name = name
+        self.scheduler = scheduler
+        self.region = scheduler.region
+        self.instance_types = parse_instance_types(instance_types)
+        self.batch_size = int(batch_size or os.environ.get('RANCHER_SCALE_BATCH_SIZE', 50))
+        self.config = config
+        self.ec2 = throttled_client('ec2', self.region)
+
+    #
+    def __launch_batch(self, batch, os_settings, keyname, userdata):
+        launch_spec = ec2_launch_spec(os_settings)
+        extra_args = {}
+        if userdata is not None:
+            extra_args['UserData'] = userdata
+
+        def launch(instance_type, zone, subnet):
+            return self.ec2.run_instances(
+                ImageId=os_settings['ami-id'],
+                MinCount=len(batch),
+                MaxCount=len(batch),
+                KeyName=keyname,
+                InstanceType=instance_type,
+                Placement={'AvailabilityZone': '{}{}'.format(self.region, zone)},
+                NetworkInterfaces=[dict(launch_spec['NetworkInterface'], SubnetId=subnet)],
+                IamInstanceProfile=launch_spec['IamInstanceProfile'],
+                BlockDeviceMappings=launch_spec['BlockDeviceMappings'],
+                TagSpecifications=[{'ResourceType': 'instance', 'Tags': ec2_compute_tags(self.name, self.config)}],
+                **extra_args)
+
+        label = "{}..{}".format(batch[0], batch[-1])
+        response, placement = self.scheduler.launch(label, self.instance_types, launch)
+
+        # the batch shares every tag but the name
+        ids = []
+        for nodename, instance in zip(batch, response['Instances']):
+            self.ec2.create_tags(Resources=[instance['InstanceId']], Tags=[{'Key': 'Name', 'Value': nodename}])
+            node_index(self.region).discard(nodename)
+            ids.append(instance['InstanceId'])
+        return ids
+
+    #
+    def launch(self, nodenames, os_settings, keyname, userdata=None):
+        """
+        Launch one instance per name in batches and wait for all of them to run.
+
+        Returns:
+          list: instance ids, in the order of nodenames
+        """
+        progress = Progress("Launched '{}' nodes".format(self.name), len(nodenames))
+        ids = []
+
+        try:
+            for batch in chunks(nodenames, self.batch_size):
+                ids += self.__launch_batch(batch, os_settings, keyname, userdata)
+                progress.update(len(batch))
+
+            waiter = self.ec2.get_waiter('instance_running')
+            running = Progress("Running '{}' nodes".format(self.name), len(ids))
+            for batch in chunks(ids, 100):
+                with run_deadline().span("'{}' nodes to run".format(self.name)) as remaining:
+                    waiter.wait(InstanceIds=batch, WaiterConfig=waiter_config(remaining))
+                running.update(len(batch))
+
+        except (botocore_exceptions.ClientError, botocore_exceptions.WaiterError, boto3_exceptions.Boto3Error) as e:
+            msg = "Failed while launching '{}' nodes after {} of {}!: {}".format(self.name, len(ids), len(nodenames), str(e))
+            log_debug(msg)
+            raise ScaleError(msg) from e
+
+        log_info("Placement of '{}' batches: {}".format(self.name, self.scheduler.summary()))
+        return ids
+
+    #
+    def terminate(self, nodenames):
+        return terminate_nodes(nodenames, self.region, label=self.name)
+
+
+#
+def terminate_nodes(nodenames, region, label='agent'):
+    """
+    Terminate every running or pending node with one of the given names, looked
+    up in the node index and terminated in batches.
+
+    Returns:
+      int: number of instances terminated
+    """
+    ec2 = throttled_client('ec2', region)
+    index = node_index(region)
+    ids = []
+
+    try:
+        for name in nodenames:
+            ids += [record.id for record in index.find(name)]
+            index.discard(name)
+
+        progress = Progress("Terminated '{}' nodes".format(label), len(ids))
+        for batch in chunks(ids, EC2_MAX_IDS):
+            ec2.terminate_instances(InstanceIds=batch)
+            progress.update(len(batch))
+
+    except (InventoryError, botocore_exceptions.ClientError, boto3_exceptions.Boto3Error) as e:
+        msg = "Failed while terminating '{}' nodes!: {}".format(label, str(e))
+        log_debug(msg)
+        raise ScaleError(msg) from e
+
+    return len(ids)
@@ -0,0 +1,256 @@
+import os, time, heapq, threading
+
+from concurrent.futures import ThreadPoolExecutor
+from invoke import run, Failure
+from xml.etree import ElementTree
+
+from .. import log_debug, log_info, log_warn
+
+
+# earlier runs a module's median duration is taken over
+TIMING_RUNS = 5
+
+# assumed duration of a module nothing is known about yet, when there is nothing to take the median of
+DEFAULT_DURATION = 60.0
+
+COUNTERS = ['tests', 'errors', 'failures', 'skips']
+
+
+#
+class ShardsError(RuntimeError):
+    message = None
+
+    def __init__(self, message):
+        self.message = message
+        super(ShardsError, self).__init__(self.message)
+
+
+#
+def find_test_modules(path):
+    """
+    Returns:
+      list: every test_*.py below 'path', sorted, or 'path' itself when it is a file
+    """
+    if os.path.isfile(path):
+        return [path]
+
+    modules = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith('.') and '__pycache__' != d)
+        modules += [os.path.join(dirpath, f) for f in sorted(filenames) if f.startswith('test') and f.endswith('.py')]
+    return modules
+
+
+#
+def module_key(name):
+    """
+    Key timings are stored under: the module name of a test file path, or of a
+    JUnit classname such as 'tests.core.test_foo.TestBar'.
+    """
+    if name.endswith('.py'):
+        return os.path.basename(name)[:-3]
+
+    parts = name.split('.')
+    for i in reversed(range(len(parts))):
+        if parts[i].startswith('test'):
+            return parts[i]
+    return parts[-1]
+
+
+#
+def _suites(root):
+    # py.test writes either a bare <testsuite> or one wrapped in <testsuites>
+    if 'testsuite' == root.tag:
+        return [root]
+    return root.findall('testsuite')
+
+
+#
+def parse_junit(filename):
+    """
+    Returns:
+      list: (classname, name, seconds, outcome) per test case, outcome being one of
+            'passed', 'failure', 'error' or 'skipped'
+    """
+    try:
+        root = ElementTree.parse(filename).getroot()
+    except (IOError, OSError, ElementTree.ParseError) as e:
+        msg = "Failed while reading JUnit results '{}'!: {}".format(filename, str(e))
+        log_debug(msg)
+        raise ShardsError(msg) from e
+
+    cases = []
+    for suite in _suites(root):
+        for case in suite.iter('testcase'):
+            outcome = 'passed'
+            for tag in ['failure', 'error', 'skipped']:
+                if case.find(tag) is not None:
+                    outcome = tag
+                    break
+            cases.append((case.get('classname', ''), case.get('name', ''), float(case.get('time', 0) or 0), outcome))
+    return cases
+
+
+#
+def balance(items, weights, shards):
+    """
+    Longest processing time first: hand the longest remaining item to the least
+    loaded shard. The longest shard is at most 4/3 of the optimum.
+
+    Returns:
+      list: (estimated seconds, items) per non-empty shard
+    """
+    loads = [(0.0, i) for i in range(max(1, shards))]
+    buckets = [[] for i in range(len(loads))]
+
+    for item in sorted(items, key=lambda item: (-weights[item], item)):
+        load, i = heapq.heappop(loads)
+        buckets[i].append(item)
+        heapq.heappush(loads, (load + weights[item], i))
+
+    totals = dict((i, load) for load, i in loads)
+    return [(totals[i], bucket) for i, bucket in enumerate(buckets) if 0 != len(bucket)]
+
+
+#
+def merge_junit(filenames, output, elapsed=None):
+    """
+    Merge the results of every shard into one <testsuite>. A shard without results
+    shows up as an errored test case so a crashed worker can not go unnoticed.
+
+    Returns:
+      dict: total 'tests', 'errors', 'failures' and 'skips'
+    """
+    merged = ElementTree.Element('testsuite', name='pytest')
+    totals = dict((counter, 0) for counter in COUNTERS)
+
+    for filename in filenames:
+        try:
+            suites = _suites(ElementTree.parse(filename).getroot())
+        except (IOError, OSError, ElementTree.ParseError) as e:
+            log_warn("No usable results from shard '{}': {}".format(filename, str(e)))
+            case = ElementTree.SubElement(merged, 'testcase', classname='shards', name=os.path.basename(filename), time='0')
+            ElementTree.SubElement(case, 'error', message='shard produced no results').text = str(e)
+            totals['tests'] += 1
+            totals['errors'] += 1
+            continue
+
+        for suite in suites:
+            for counter in COUNTERS:
+                value = suite.get(counter, suite.get('skipped', 0) if 'skips' == counter else 0)
+                totals[counter] += int(value or 0)
+            for case in suite.findall('testcase'):
+                merged.append(case)
+
+    for counter in COUNTERS:
+        merged.set(counter, str(totals[counter]))
+    if elapsed is not None:
+        merged.set('time', "{:.3f}".format(elapsed))
+
+    ElementTree.ElementTree(merged).write(output, encoding='utf-8', xml_declaration=True)
+    return totals
+
+
+#
+class ShardRunner(object):
+    """
+    Run a py.test suite as parallel shards of whole test modules.
+
+    Modules are spread over the shards by their durations in previous runs so all
+    shards finish at about the same time; whole modules keep their module scoped
+    fixtures together. Each shard writes its own JUnit file and log, and the JUnit
+    files are merged into one afterwards.
+    """
+
+    #
+    def __init__(self, path, shards=4, pytest_args='-s', output='results.xml', history=None, run_id=None):
+        """
+        Args:
+          path (str): test directory or module to shard
+          shards (int): py.test processes to run at once
+          pytest_args (str): extra arguments for every py.test process
+          output (str): merged JUnit file
+          history (History): where module durations are read from, defaults to the workspace history
+          run_id (int): history run the results are recorded under, not recorded when omitted
+        """
+        self.path = path
+        self.shards = int(shards)
+        self.pytest_args = pytest_args
+        self.output = output
+        self.run_id = run_id
+        self.results = {}
+
+        if history is None:
+            from ..History import run_history
+            history = run_history()
+        self.history = history
+
+        self.__lock = threading.Lock()
+
+    #
+    def plan(self):
+        """
+        Returns:
+          list: (estimated seconds, test modules) per shard
+        """
+        modules = find_test_modules(self.path)
+        if 0 == len(modules):
+            raise ShardsError("No test modules found in '{}'!".format(self.path))
+
+        timings = self.history.module_durations(TIMING_RUNS)
+        known = sorted(timings[module_key(m)] for m in modules if module_key(m) in timings)
+        default = known[len(known) // 2] if known else DEFAULT_DURATION
+        log_info("{} of {} test modules have timings, assuming {:.0f}s for the others.".format(len(known), len(modules), default))
+
+        weights = dict((m, timings.get(module_key(m), default)) for m in modules)
+        return balance(modules, weights, self.shards)
+
+    #
+    def __shard_files(self, index):
+        base, ext = os.path.splitext(self.output)
+        return "{}.shard{}{}".format(base, index, ext), "{}.shard{}.log".format(base, index)
+
+    #
+    def __run_shard(self, index, modules):
+        junit, logfile = self.__shard_files(index)
+        if os.path.isfile(junit):
+            os.remove(junit)
+
+        cmd = "py.test {} --junit-xml={} {} > {} 2>&1".format(self.pytest_args, junit, ' '.join(modules), logfile)
+        log_debug("Running shard {}: {}".format(index, cmd))
+
+        start_time = time.time()
+        try:
+            result = run(cmd, warn=True, hide=True)
+            exit_code = result.return_code
+        except Failure as e:
+            exit_code = e.result.return_code
+        elapsed = time.time() - start_time
+
+        log_info("Shard {} finished {} modules with exit code {} after {:.0f}s (log in '{}').".format(index, len(modules), exit_code, elapsed, logfile))
+        with self.__lock:
+            self.results[index] = {'exit_code': exit_code, 'elapsed': elapsed, 'modules': len(modules), 'junit': junit}
+        return junit
+
+    #
+    def run(self):
+        """
+        Returns:
+          dict: the merged 'tests', 'errors', 'failures' and 'skips' counts
+        """
+        plan = self.plan()
+        for index, (estimate, modules) in enumerate(plan):
+            log_info("Shard {}: {} modules, estimated {:.0f}s".format(index, len(modules), estimate))
+
+        start_time = time.time()
+        with ThreadPoolExecutor(max_workers=len(plan)) as pool:
+            junits = list(pool.map(lambda item: self.__run_shard(item[0], item[1][1]), enumerate(plan)))
+        elapsed = time.time() - start_time
+
+        totals = merge_junit(junits, self.output, elapsed)
+        if self.run_id is not None:
+            self.history.record_tests(self.run_id, [case for case in parse_junit(self.output) if 'shards' != case[0]])
+
+        serial = sum(result['elapsed'] for result in self.results.values())
+        log_info("{} tests in {} shards took {:.0f}s, {:.0f}s of shard time.".format(totals['tests'], len(plan), elapsed, serial))
+        return totals
@@ -0,0 +1,193 @@
+import os, time, threading
+
+from invoke import run, Failure
+
+from .. import log_debug, log_info, log_warn, cache_path, load_json_cache, save_json_cache
+from ..SSH import ssh_options
+
+
+# directory under the CI cache holding the tarballs and their index
+SNAPSHOT_DIR = 'server-snapshots'
+INDEX_FILE = 'index.json'
+
+# host directory whose mysql/ is mounted as the server container's /var/lib/mysql
+HOST_DATA_DIR = '/var/lib/rancher-ci'
+
+SERVER_CONTAINER = 'rancher-server'
+
+
+#
+class SnapshotError(RuntimeError):
+    message = None
+
+    def __init__(self, message):
+        self.message = message
+        super(SnapshotError, self).__init__(self.message)
+
+
+#
+def snapshot_mode():
+    mode = str(os.environ.get('RANCHER_SERVER_SNAPSHOT', 'off')).rstrip().lower()
+    if mode not in ['off', 'on']:
+        raise RuntimeError("Unsupported RANCHER_SERVER_SNAPSHOT '{}'! Choose one of: off, on".format(mode))
+    return mode
+
+
+#
+def snapshot_key(config):
+    return "{}-{}".format(config.rancher_version, config.orchestration)
+
+
+#
+def _ssh(host, cmd, stdin=None, stdout=None, timeout=10):
+    key, addr, user = host
+    sshcmd = "ssh {} {}@{} '{}'".format(ssh_options(key, timeout), user, addr, cmd)
+    if stdin is not None:
+        sshcmd = "{} < {}".format(sshcmd, stdin)
+    if stdout is not None:
+        sshcmd = "{} > {}".format(sshcmd, stdout)
+
+    log_debug("Running ssh cmd  '{}'...".format(sshcmd))
+    try:
+        return run(sshcmd, hide=True).stdout.strip()
+    except Failure as e:
+        msg = "ssh command failed on '{}'!: {} :: {}".format(addr, e.result.return_code, e.result.stderr)
+        log_debug(msg)
+        raise SnapshotError(msg) from e
+
+
+#
+class ServerSnapshots(object):
+    """
+    Database snapshots of configured rancher/server containers, one per Rancher
+    version and orchestration.
+
+    A snapshot is a gzipped tarball of the server's MySQL directory, taken with the
+    container stopped once its environment, registration token and settings are
+    in place. The index remembers the rancher/server image each was taken from,
+    so a snapshot of a moving tag such as 'stable' is dropped when the tag moves.
+    """
+
+    #
+    def __init__(self, directory=None):
+        self.directory = directory or cache_path(SNAPSHOT_DIR)
+        self.index_file = os.path.join(self.directory, INDEX_FILE)
+        self.__lock = threading.Lock()
+
+        os.makedirs(self.directory, exist_ok=True)
+
+    #
+    def index(self):
+        return load_json_cache(self.index_file)
+
+    #
+    def image_id(self, host, rancher_version):
+        """
+        Pull rancher/server:'rancher_version' on 'host'.
+
+        Returns:
+          str: id of the pulled image
+        """
+        image = "rancher/server:{}".format(rancher_version)
+        log_info("Pulling '{}'...".format(image))
+        _ssh(host, "sudo docker pull {} > /dev/null".format(image))
+        return _ssh(host, 'sudo docker inspect --format "{{.Id}}" ' + image)
+
+    #
+    def lookup(self, config, image_id):
+        """
+        Returns:
+          dict: index entry of a usable snapshot for 'config' and 'image_id', or None
+        """
+        key = snapshot_key(config)
+        with self.__lock:
+            entry = self.index().get(key)
+
+        if entry is None:
+            log_info("No server snapshot for '{}' yet.".format(key))
+            return None
+
+        if image_id != entry.get('image') or not os.path.isfile(entry.get('file', '')):
+            log_info("Server snapshot for '{}' is stale or missing, dropping it.".format(key))
+            self.invalidate(key)
+            return None
+
+        return entry
+
+    #
+    def restore(self, entry, host):
+        """
+        Unpack a snapshot into HOST_DATA_DIR on 'host', before the server container starts.
+        """
+        log_info("Restoring server snapshot '{}' taken {}...".format(
+            entry['key'], time.strftime('%Y-%m-%d %H:%M', time.gmtime(entry['created']))))
+        _ssh(host, "sudo rm -rf {0}/mysql && sudo mkdir -p {0} && sudo tar -xzf - -C {0}".format(HOST_DATA_DIR),
+             stdin=entry['file'])
+        return True
+
+    #
+    def capture(self, config, image_id, host):
+        """
+        Stop the server container on 'host', pack its database and start it again.
+
+        Returns:
+          dict: the new index entry
+        """
+        key = snapshot_key(config)
+        filename = os.path.join(self.directory, "{}.tar.gz".format(key))
+        tmpfile = "{}.{}.{}.tmp".format(filename, os.getpid(), threading.get_ident())
+
+        log_info("Capturing server snapshot '{}'...".format(key))
+        try:
+            _ssh(host, "sudo docker stop {0} > /dev/null && sudo tar -czf - -C {1} mysql; rc=$?; "
+                       "sudo docker start {0} > /dev/null; exit $rc".format(SERVER_CONTAINER, HOST_DATA_DIR),
+                 stdout=tmpfile)
+            os.replace(tmpfile, filename)
+        finally:
+            if os.path.isfile(tmpfile):
+                os.remove(tmpfile)
+
+        entry = {'key': key, 'image': image_id, 'file': filename, 'created': time.time(),
+                 'size': os.path.getsize(filename)}
+        with self.__lock:
+            index = self.index()
+            index[key] = entry
+            save_json_cache(self.index_file, index)
+
+        log_info("Server snapshot '{}' captured, {:.1f} MB.".format(key, entry['size'] / 1048576.0))
+        return entry
+
+    #
+    def invalidate(self, key=None):
+        """
+        Drop the snapshot stored under 'key', or every snapshot.
+
+        Returns:
+          int: number of snapshots dropped
+        """
+        with self.__lock:
+            index = self.index()
+            keys = [k for k in index if key is None or k == key]
+            for k in keys:
+                filename = index.pop(k).get('file')
+                if filename and os.path.isfile(filename):
+                    os.remove(filename)
+            save_json_cache(self.index_file, index)
+
+        if 0 != len(keys):
+            log_warn("Dropped server snapshots: {}".format(', '.join(sorted(keys))))
+        return len(keys)
+
+
+# snapshots shared by every stage and thread of this process
+_snapshots = None
+_snapshots_lock = threading.Lock()
+
+
+#
+def server_snapshots():
+    global _snapshots
+    with _snapshots_lock:
+        if _snapshots is None:
+            _snapshots = ServerSnapshots()
+        return _snapshots
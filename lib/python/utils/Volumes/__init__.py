@@ -0,0 +1,159 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from .. import log_debug, log_info, log_warn
+from .. import boto3_exceptions, botocore_exceptions
+from ..Deadline import run_deadline, waiter_config
+from ..Inventory import MAX_FILTER_VALUES, iter_volumes
+from ..RateLimit import throttled_client
+from ..Scale import chunks
+
+
+# EC2 tag on an instance naming the extra volume attached to it
+VOLUME_TAG = 'rancherlabs.ci.addtl_volume'
+
+# volume ids per describe call of the shared waiters
+WAIT_BATCH = 200
+
+
+#
+class VolumeError(RuntimeError):
+    message = None
+
+    def __init__(self, message):
+        self.message = message
+        super(VolumeError, self).__init__(self.message)
+
+
+#
+class VolumeManager(object):
+    """
+    Create, attach and delete EBS volumes for many nodes at once.
+
+    Volumes are created and tagged in one call each, creates and attaches for
+    all nodes run concurrently, and a single waiter per batch of volumes covers
+    every node instead of one wait per volume.
+    """
+
+    #
+    def __init__(self, region, max_workers=8):
+        self.region = region
+        self.max_workers = max_workers
+        self.ec2 = throttled_client('ec2', region)
+
+    #
+    def __map(self, fn, items):
+        if 0 == len(items):
+            return []
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(items)))) as pool:
+            return list(pool.map(fn, items))
+
+    #
+    def create(self, name, zone, size=20, voltype='gp2', tags=None):
+        """
+        Returns:
+          str: id of the new volume, created with its tags and Name in one call
+        """
+        tags = list(tags or []) + [{'Key': 'Name', 'Value': name}]
+        volume = self.ec2.create_volume(Size=size,
+                                        VolumeType=voltype,
+                                        AvailabilityZone=zone,
+                                        TagSpecifications=[{'ResourceType': 'volume', 'Tags': tags}])
+        log_debug("Created volume '{}' for '{}' in '{}'.".format(volume['VolumeId'], name, zone))
+        return volume['VolumeId']
+
+    #
+    def wait(self, volids, state='available'):
+        """
+        Wait for every volume to reach 'available' or 'in-use', WAIT_BATCH volumes per describe call.
+        """
+        waiter = self.ec2.get_waiter('volume_available' if 'available' == state else 'volume_in_use')
+        for batch in chunks(volids, WAIT_BATCH):
+            with run_deadline().span("volumes to become '{}'".format(state)) as remaining:
+                waiter.wait(VolumeIds=batch, WaiterConfig=waiter_config(remaining))
+
+    #
+    def provision(self, nodes, device='/dev/sdf', size=20, voltype='gp2', tags=None, delete_on_termination=True):
+        """
+        Create a volume in the zone of every node, attach it and record it on the
+        node's rancherlabs.ci.addtl_volume tag.
+
+        Args:
+          nodes (list): NodeRecords to give a volume each
+          device (str): device name the volume is attached as
+          delete_on_termination (bool): let terminating the node delete its volume too
+
+        Returns:
+          dict: volume id per node name
+        """
+        nodes = list(nodes)
+        log_info("Provisioning {} volumes of {} GB...".format(len(nodes), size))
+
+        try:
+            volids = self.__map(lambda node: self.create("{}-vol".format(node.name), node.zone, size, voltype, tags), nodes)
+            self.wait(volids, 'available')
+
+            def attach(item):
+                node, volid = item
+                self.ec2.attach_volume(VolumeId=volid, InstanceId=node.id, Device=device)
+                self.ec2.create_tags(Resources=[node.id], Tags=[{'Key': VOLUME_TAG, 'Value': volid}])
+
+            self.__map(attach, list(zip(nodes, volids)))
+            self.wait(volids, 'in-use')
+
+            if delete_on_termination:
+                self.__map(lambda node: self.ec2.modify_instance_attribute(
+                    InstanceId=node.id,
+                    BlockDeviceMappings=[{'DeviceName': device, 'Ebs': {'DeleteOnTermination': True}}]), nodes)
+
+        except (botocore_exceptions.ClientError, botocore_exceptions.WaiterError, boto3_exceptions.Boto3Error) as e:
+            msg = "Failed while provisioning volumes for {} nodes!: {}".format(len(nodes), str(e))
+            log_debug(msg)
+            raise VolumeError(msg) from e
+
+        log_info("Attached {} volumes.".format(len(volids)))
+        return dict((node.name, volid) for node, volid in zip(nodes, volids))
+
+    #
+    def delete(self, volids):
+        """
+        Delete volumes concurrently. Volumes still attached are skipped with a warning.
+
+        Returns:
+          int: number of volumes deleted
+        """
+        def delete_one(volid):
+            try:
+                self.ec2.delete_volume(VolumeId=volid)
+                return True
+            except botocore_exceptions.ClientError as e:
+                if 'VolumeInUse' != e.response.get('Error', {}).get('Code'):
+                    raise
+                log_warn("Volume '{}' is still attached, not deleting it.".format(volid))
+                return False
+
+        try:
+            deleted = len([ok for ok in self.__map(delete_one, list(volids)) if ok])
+        except (botocore_exceptions.ClientError, boto3_exceptions.Boto3Error) as e:
+            msg = "Failed while deleting volumes!: {}".format(str(e))
+            log_debug(msg)
+            raise VolumeError(msg) from e
+
+        log_debug("Deleted {} volumes.".format(deleted))
+        return deleted
+
+    #
+    def delete_named(self, names):
+        """
+        Delete every volume whose Name tag is one of 'names'.
+        """
+        volids = []
+        try:
+            for batch in chunks(names, MAX_FILTER_VALUES):
+                volids += [vol['id'] for vol in iter_volumes([{'Name': 'tag:Name', 'Values': batch}], self.region)]
+        except (botocore_exceptions.ClientError, boto3_exceptions.Boto3Error) as e:
+            msg = "Failed while looking up volumes to delete!: {}".format(str(e))
+            log_debug(msg)
+            raise VolumeError(msg) from e
+
+        log_debug("{} volumes to delete.".format(len(volids)))
+        return self.delete(volids)
@@ -1,12 +1,38 @@
-import os, sys, fnmatch, numpy, logging, yaml, inspect, requests, boto3, time
+import os, sys, fnmatch, logging, inspect, time, json, hashlib, importlib, threading
 
 from plumbum import colors
 from invoke import run, Failure
-from os import walk
-from requests import ConnectionError, HTTPError
-from time import sleep
-from boto3.exceptions import Boto3Error
-from botocore.exceptions import ClientError
+
+
+#
+class LazyModule(object):
+    """
+    Stand-in for a module which is only imported on first attribute access.
+
+    boto3, requests and yaml are expensive to import and most tasks never touch
+    at least one of them, so they are bound through this instead of imported
+    eagerly. Exception classes are looked up the same way, e.g.
+    'except boto3_exceptions.Boto3Error', which only resolves when an exception
+    actually reaches the except clause.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+boto3 = LazyModule('boto3')
+boto3_exceptions = LazyModule('boto3.exceptions')
+botocore = LazyModule('botocore')
+botocore_exceptions = LazyModule('botocore.exceptions')
+botocore_waiter = LazyModule('botocore.waiter')
+requests = LazyModule('requests')
+yaml = LazyModule('yaml')
 
 
 # This might be bad...assuming that wherever this is running its always going to be
@@ -15,17 +41,25 @@ colors.use_color = 3
 
 
 #
-def ec2_compute_tags(nodename):
+def ec2_compute_tags(nodename, config=None):
+    from .Namespace import RUN_TAG, RUN_EXPIRES_TAG, run_expiry
+    from .RunConfig import RunConfig
+
     # in addition to AWS_TAGS, include a tag for Docker version which will be
     # referenced by later provisining scripts.
-    docker_version = str(os.environ['RANCHER_DOCKER_VERSION']).rstrip()
-    docker_native = str(os.environ.get('RANCHER_DOCKER_NATIVE', 'false')).rstrip()
-    rhel_selinux = str(os.environ.get('RANCHER_DOCKER_RHEL_SELINUX', 'false')).rstrip()
-    tags = str(os.environ['AWS_TAGS']).rstrip()
-    tags += ',rancher.docker.version,{}'.format(docker_version)
-    tags += ',rancher.docker.native,{}'.format(docker_native)
-    tags += ',rancher.docker.rhel.selinux,{}'.format(rhel_selinux)
+    config = config or RunConfig.from_environ()
+    missing = config.missing(['AWS_TAGS', 'RANCHER_DOCKER_VERSION'])
+    if 0 != len(missing):
+        raise RuntimeError("Cannot tag node '{}' without: {}".format(nodename, ', '.join(missing)))
+
+    tags = config.aws_tags
+    tags += ',rancher.docker.version,{}'.format(config.docker_version)
+    tags += ',rancher.docker.native,{}'.format(config.docker_native)
+    tags += ',rancher.docker.rhel.selinux,{}'.format(config.rhel_selinux)
     tags += ',Name,{}'.format(nodename)
+    if config.run_id:
+        tags += ',{},{}'.format(RUN_TAG, config.run_id)
+        tags += ',{},{}'.format(RUN_EXPIRES_TAG, run_expiry())
     return tag_csv_to_array(tags)
 
 
@@ -34,11 +68,53 @@ def aws_get_region():
     return str(os.environ['AWS_DEFAULT_REGION']).rstrip()
 
 
+# boto3 clients and resources shared by every stage of a run, keyed by (kind, service, region).
+# Clients are thread safe and keep their HTTP connections pooled.
+_aws_handles = {}
+_aws_handles_lock = threading.Lock()
+
+
+#
+def _aws_handle(kind, service, region):
+    if region is None:
+        region = str(os.environ.get('AWS_DEFAULT_REGION', '')).rstrip() or None
+
+    key = (kind, service, region)
+    with _aws_handles_lock:
+        if key not in _aws_handles:
+            log_debug("Creating boto3 {} for '{}' in region '{}'...".format(kind, service, region))
+            factory = boto3.client if 'client' == kind else boto3.resource
+            _aws_handles[key] = factory(service, region_name=region)
+        return _aws_handles[key]
+
+
+#
+def aws_client(service, region=None):
+    return _aws_handle('client', service, region)
+
+
+#
+def aws_resource(service, region=None):
+    return _aws_handle('resource', service, region)
+
+
+# requests.Session shared by every stage of a run so API calls reuse pooled connections.
+_http_session = None
+
+
+#
+def http_session():
+    global _http_session
+    if _http_session is None:
+        _http_session = requests.Session()
+    return _http_session
+
+
 #
 def sts_decode_auth_msg(codedmsg):
     try:
-        decoded = boto3.client('sts').decode_authorization_message(EncodedMessage=codedmsg)
-    except Boto3Error as e:
+        decoded = aws_client('sts').decode_authorization_message(EncodedMessage=codedmsg)
+    except boto3_exceptions.Boto3Error as e:
         msg = 'Failed while decoding STS auth msg!: {} :: {}'.format(codedmsg, str(e))
         log_debug(msg)
         raise RuntimeError(msg)
@@ -47,14 +123,14 @@ def sts_decode_auth_msg(codedmsg):
 
 
 #
-def nuke_aws_keypair(name):
+def nuke_aws_keypair(name, region=None):
     log_debug("Removing AWS key pair '{}'...".format(name))
 
     try:
-        boto3.resource('ec2', region_name='us-east-2').KeyPair(name).delete()
-    except Boto3Error as e:
-        log_debug(str(e.message))
-        raise RuntimeError(e.message) from e
+        aws_client('ec2', region).delete_key_pair(KeyName=name)
+    except (botocore_exceptions.ClientError, boto3_exceptions.Boto3Error) as e:
+        log_debug(str(e))
+        raise RuntimeError(str(e)) from e
 
     return True
 
@@ -94,7 +170,9 @@ log.addHandler(stream)
 
 
 #
-def run_with_retries(cmd, echo=False, sleep=10, attempts=10):
+def run_with_retries(cmd, echo=False, step=10, attempts=10):
+    from .Deadline import run_deadline
+
     current_attempts = 0
     result = None
 
@@ -105,9 +183,9 @@ def run_with_retries(cmd, echo=False, sleep=10, attempts=10):
             break
         except Failure as e:
             if current_attempts < attempts:
-                msg = "Attempt {}/{} of {} failed. Sleeping for {}...".format(current_attempts, attempts, cmd)
+                msg = "Attempt {}/{} of {} failed. Sleeping for {}...".format(current_attempts, attempts, cmd, step)
                 log_info(msg)
-                sleep(sleep)
+                run_deadline().sleep(step, "retrying '{}'".format(cmd))
             else:
                 msg = "Exceeded max attempts {} for {}!".format(attempts, cmd)
                 log_debug(msg)
@@ -118,8 +196,10 @@ def run_with_retries(cmd, echo=False, sleep=10, attempts=10):
 
 #
 def request_with_retries(method, url, data={}, step=10, attempts=10):
+    from .Deadline import run_deadline
 
-    timeout = 5
+    deadline = run_deadline()
+    what = "{} '{}'".format(method, url)
     response = None
     current_attempts = 0
 
@@ -129,12 +209,13 @@ def request_with_retries(method, url, data={}, step=10, attempts=10):
     while True:
         try:
             current_attempts += 1
+            timeout = deadline.clamp(5, what)
             if 'PUT' == method:
-                response = requests.put(url, timeout=timeout, json=data)
+                response = http_session().put(url, timeout=timeout, json=data)
             elif 'GET' == method:
-                response = requests.get(url, timeout=timeout)
+                response = http_session().get(url, timeout=timeout)
             elif 'POST' == method:
-                response = requests.post(url, timeout=timeout, json=data)
+                response = http_session().post(url, timeout=timeout, json=data)
             else:
                 log_error("Unsupported method \'{}\' specified!".format(method))
                 return False
@@ -148,18 +229,89 @@ def request_with_retries(method, url, data={}, step=10, attempts=10):
             else:
                 return response
 
-        except (ConnectionError, HTTPError) as e:
+        except (requests.ConnectionError, requests.HTTPError) as e:
             if current_attempts >= attempts:
                 msg = "Exceeded max attempts. Giving up!: {}".format(str(e))
                 log_debug(msg)
                 raise Failure(msg) from e
             else:
                 log_info("Request did not succeeed. Sleeping and trying again... : {}".format(str(e)))
-                sleep(step)
+                deadline.sleep(step, what)
 
     return response
 
 
+#
+def poll_with_backoff(probe, timeout=600, initial=0.25, factor=1.5, max_step=10, description='condition'):
+    """
+    Call 'probe' until it returns something truthy, sleeping 'initial' seconds after
+    the first miss and 'factor' times longer after every further one, at most
+    'max_step'. Exceptions raised by 'probe' are not retried. The wait ends early,
+    with a DeadlineError, when the run's deadline comes first.
+
+    Returns:
+      tuple: (what 'probe' returned, seconds it took)
+    """
+    from .Deadline import run_deadline
+
+    deadline = run_deadline()
+    step = initial
+    attempts = 0
+    starttime = time.time()
+
+    while True:
+        attempts += 1
+        result = probe()
+        elapsed = time.time() - starttime
+        if result:
+            log_debug("Done waiting for {} after {} attempts and {:.1f} seconds.".format(description, attempts, elapsed))
+            return result, elapsed
+
+        if elapsed + step > timeout:
+            raise RuntimeError("Timed out after {:.0f} seconds and {} attempts waiting for {}!".format(elapsed, attempts, description))
+
+        deadline.sleep(step, description)
+        step = min(step * factor, max_step)
+
+
+#
+def import_time_profile(statement, cwd='.', top=10):
+    """
+    Measure the import cost of statement in a fresh interpreter.
+
+    Uses 'python -X importtime' where available (Python >= 3.7) and falls back
+    to the wall clock time of the whole statement on older interpreters.
+
+    Args:
+      statement (str): Python statement to profile, e.g. 'import tasks'
+      cwd (str): directory to run the interpreter in
+      top (int): number of most expensive top-level imports to report
+
+    Returns:
+      dict: 'total_us' and 'top', a list of [cumulative_us, module] pairs
+    """
+    if sys.version_info < (3, 7):
+        timed = "import time; t = time.time(); {}; print(int((time.time() - t) * 1000000))".format(statement)
+        result = run("cd {} && {} -c '{}'".format(cwd, sys.executable, timed), hide=True)
+        return {'total_us': int(result.stdout.strip().splitlines()[-1]), 'top': []}
+
+    result = run("cd {} && {} -X importtime -c '{}'".format(cwd, sys.executable, statement), hide=True)
+
+    toplevel = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if 3 != len(fields) or not fields[1].strip().isdigit():
+            continue
+        # nested imports are indented below the module which pulled them in
+        if not fields[2][1:].startswith(' '):
+            toplevel.append([int(fields[1]), fields[2].strip()])
+
+    toplevel.sort(reverse=True)
+    return {'total_us': sum(cumulative for cumulative, module in toplevel), 'top': toplevel[:top]}
+
+
 #
 def get_parent_frame_metadata(frame):
     parent_frame = inspect.getouterframes(frame, 2)
@@ -217,139 +369,50 @@ def err_and_exit(msg):
     sys.exit(-1)
 
 
-# Given the OS, return a dictionary of OS-specific setting values
-# FIXME: Have this reference a config file for easy addtl platform support.
-def os_to_settings(os):
-    # Fix me. Currently we support amis for only 1 region which is ohio.
-    # We would need to have the ability to look up amis for a given region.
-    """
-    os_ami_dict = {'ubuntu-1604': {"ami": 'ami-a9d276c9',
-                                  "ssh_username": 'ubuntu'},
-                   'ubuntu-1404': {"ami": 'ami-01f05461',
-                                   "ssh_username": 'ubuntu'},
-                   'centos-7': {"ami": 'ami-d2c924b2',
-                                "ssh_username": 'centos'},
-                   'rhel-7.5': {"ami": 'ami-206e0e58',
-                                "ssh_username": 'ec2-user'},
-                   'rhel-7.4': {"ami": 'ami-9fa343e7',
-                                "ssh_username": 'ec2-user'},
-                   'rhel-7.2': {"ami": 'ami-5dd3743d',
-                                "ssh_username": 'ec2-user'},
-                   'rhel-7.3': {"ami": 'ami-6f68cf0f',
-                                "ssh_username": 'ec2-user'},
-                   'rancheros-v1.4.1': {"ami": 'ami-08ca2e89d91d17cfe',
-                                "ssh_username": 'rancher'},
-                   'rancheros-v1.4.2': {"ami": 'ami-03c3efd1e21bb4c6d',
-                                        "ssh_username": 'rancher'},
-                   'rancheros-v1.1.3': {"ami": 'ami-e316a39b',
-                                        "ssh_username": 'rancher'},
-                   'rancheros-v1.3.0': {"ami": 'ami-c60c94be',
-                                        "ssh_username": 'rancher'},
-                   'coreos-stable': {"ami": 'ami-06af7f66',
-                                        "ssh_username": 'core'}
-                   }
-    """
-    os_ami_dict = {'ubuntu-1604': {"ami": 'ami-0782e9ee97725263d',
-                                   "ssh_username": 'ubuntu'},
-                   'ubuntu-1404': {"ami": 'ami-019abc64',
-                                   "ssh_username": 'ubuntu'},
-                   'rhel-7.5': {"ami": 'ami-03291866',
-                                "ssh_username": 'ec2-user'},
-                   'rhel-7.6': {"ami": 'ami-0b500ef59d8335eee',
-                                "ssh_username": 'ec2-user'},
-                   'rhel-7.7': {"ami": 'ami-03cfe750d5ea278f5',
-                                "ssh_username": 'ec2-user'},
-                   'rancheros-v1.4.2': {"ami": 'ami-02529740975197e75',
-                                        "ssh_username": 'rancher'},
-                   'rancheros-v1.5.0': {"ami": 'ami-0be73aeb7d3076a36',
-                                        "ssh_username": 'rancher'}
-                   }
-    """
-    if 'ubuntu-1604' in os:
-        ami = 'ami-a9d276c9'
-        ssh_username = 'ubuntu'
-
-    elif 'ubuntu-1404' in os:
-        ami = 'ami-01f05461'
-        ssh_username = 'ubuntu'
-
-    elif 'centos-7' in os:
-        ami = 'ami-d2c924b2'
-        ssh_username = 'centos'
-
-    elif 'rhel-7.5' in os:
-        ami = 'ami-206e0e58'
-        ssh_username = 'ec2-user'
-
-    elif 'rhel-7.4' in os:
-        ami = 'ami-9fa343e7'
-        ssh_username = 'ec2-user'
-
-    elif 'rhel-7.2' in os:
-        ami = 'ami-5dd3743d'
-        ssh_username = 'ec2-user'
-    elif 'rhel-7.3' in os:
-        ami = 'ami-6f68cf0f'
-        ssh_username = 'ec2-user'
-
-    elif 'rancheros-v1.4.1' in os:
-        ami = 'ami-08ca2e89d91d17cfe'
-        ssh_username = 'rancher'
-
-    elif 'rancheros-v1.4.2' in os:
-        ami = 'ami-03c3efd1e21bb4c6d'
-        ssh_username = 'rancher'
-
-    elif 'rancheros-v1.1.3' in os:
-        ami = 'ami-e316a39b'
-        ssh_username = 'rancher'
-
-    elif 'rancheros-v1.3.0' in os:
-        ami = 'ami-c60c94be'
-        ssh_username = 'rancher'
-
-    elif 'coreos-stable' in os:
-        ami = 'ami-06af7f66'
-        ssh_username = 'core'
-    """
-    if os in os_ami_dict.keys():
-        ami = os_ami_dict[os]["ami"]
-        ssh_username = os_ami_dict[os]["ssh_username"]
-    else:
-        raise RuntimeError("Unsupported OS specified '{}'!".format(os))
+# Given the OS, return a dictionary of OS-specific setting values.
+# See AMICatalog/catalog.yaml for the supported OSes and how their AMIs are resolved per region.
+def os_to_settings(os_name, region=None):
+    from .AMICatalog import ami_catalog
 
-    return {'ami-id': ami, 'ssh_username': ssh_username}
+    if region is None:
+        region = aws_get_region()
+
+    return ami_catalog().settings(os_name, region)
 
 
 #
 def ec2_wait_for_state(instance, desired_state, timeout=300):
+    from .Deadline import run_deadline
+    from .Inventory import iter_instances
+
     log_info("Waiting for node '{}' to enter state '{}'...".format(instance, desired_state))
 
+    deadline = run_deadline()
+    what = "node '{}' to enter state '{}'".format(instance, desired_state)
+    timeout = deadline.clamp(timeout, what)
     steptime = 5
     actual_state = None
     nodefilter = [{'Name': 'instance-id', 'Values': [instance]}]
-    ec2 = boto3.client('ec2', region_name=aws_get_region())
 
     starttime = time.time()
     while time.time() - starttime < timeout:
         try:
-            rez = ec2.describe_instances(Filters=nodefilter)['Reservations']
-            log_debug("rez: {}".format(rez))
+            records = list(iter_instances(nodefilter, aws_get_region()))
 
-            if 0 < len(rez):
-                actual_state = rez[0]['Instances'][0]['State']['Name']
+            if 0 < len(records):
+                actual_state = records[0].state
                 log_debug("desired state: {} ; actual state: {}".format(desired_state, actual_state))
 
                 if actual_state == desired_state:
                     log_info("Node '{}' has entered state '{}'.".format(instance, desired_state))
                     break
                 else:
-                    sleep(steptime)
+                    deadline.sleep(steptime, what)
             else:
                 log_debug("Not yet able to query instance state...")
-                sleep(steptime)
+                deadline.sleep(steptime, what)
 
-        except Boto3Error as e:
+        except (botocore_exceptions.ClientError, boto3_exceptions.Boto3Error) as e:
             msg = "Failed while querying instance '{}' state!: {}".format(instance, str(e))
             log_debug(msg)
             raise RuntimeError(msg)
@@ -357,50 +420,41 @@ def ec2_wait_for_state(instance, desired_state, timeout=300):
 
 #
 def ec2_tag_value(nodename, tagname):
-    log_debug("Looking up tag '{}' for instance '{}'...".format(tagname, nodename))
+    from .Inventory import InventoryError, node_index
 
-    tagvalue = None
+    log_debug("Looking up tag '{}' for instance '{}'...".format(tagname, nodename))
 
+    # nodename may also be a NodeRecord, which needs no lookup
     try:
-        ec2_filter = [{'Name': 'tag:Name', 'Values': [nodename]}]
-        log_debug("tag filter: {}".format(ec2_filter))
-
-        ec2 = boto3.client('ec2')
-        node_metadata = ec2.describe_instances(Filters=ec2_filter)
-        log_debug("node metadata: {}".format(node_metadata))
-
-        tags = node_metadata['Reservations'][0]['Instances'][0]['Tags']
-        log_debug("tags: {}".format(tags))
-
-        for tag in tags:
-            if tagname == tag['Key']:
-                tagvalue = tag['Value']
-                break
-
-    except (IndexError, KeyError, Boto3Error) as e:
+        record = node_index().resolve(nodename)
+    except InventoryError as e:
         msg = "Failed while looking up tag '{}'!: {}".format(tagname, str(e))
         log_debug(msg)
         raise RuntimeError(msg) from e
 
-    return tagvalue
+    if record is None:
+        raise RuntimeError("Failed while looking up tag '{}'!: no node named '{}'".format(tagname, nodename))
+
+    return record.tags.get(tagname)
 
 
 #
 def ec2_instance_id_from_name(name):
-    log_debug("Getting metadata for '{}'...".format(name))
+    from .Inventory import InventoryError, node_index
 
-    iid = None
-    name_filter = [{'Name': 'tag:Name', 'Values': name}]
-    ec2 = boto3.client('ec2')
+    log_debug("Getting metadata for '{}'...".format(name))
 
     try:
-        iid = ec2.describe_instances(Filters=name_filter)['Reservations'][0]['Instances'][0]['InstanceId']
-    except Boto3Error as e:
-        msg = "Failed while querying instance-id for name '{}'! :: {}".format(name, e.message)
+        record = node_index().get(name)
+    except InventoryError as e:
+        msg = "Failed while querying instance-id for name '{}'! :: {}".format(name, str(e))
         log_debug(msg)
         raise RuntimeError(msg) from e
 
-    return iid
+    if record is None:
+        raise RuntimeError("Failed while querying instance-id for name '{}'! :: no such node".format(name))
+
+    return record.id
 
 
 #
@@ -421,22 +475,13 @@ def aws_volid_from_tag(name):
 
 #
 def ebs_deprovision_volume(name, region='us-east-2', zone='a'):
+    from .Volumes import VolumeError, VolumeManager
+
     log_info("Removing volume '{}' if  it exists...".format(name))
 
     try:
-        vol_filter = [{'Name': 'tag:Name', 'Values': [name]}]
-        log_debug("vol filter: {}".format(vol_filter))
-        ec2 = boto3.client('ec2')
-        vols = ec2.describe_volumes(Filters=vol_filter)
-        log_debug("Volumes to delete: {}".format(vols))
-
-        if 0 != len(vols['Volumes']):
-            for vol in range(0, len(vols['Volumes'])):
-                volid = vols['Volumes'][vol]['VolumeId']
-                log_debug("Deleteting vol [{}] : id '{}'...".format(vol, volid))
-                ec2.delete_volume(VolumeId=volid)
-
-    except Boto3Error as e:
+        VolumeManager(region).delete_named([name])
+    except VolumeError as e:
         msg = "Failed deprovisioning EBS volume..."
         log_debug(msg)
         raise RuntimeError(msg) from e
@@ -466,24 +511,21 @@ def tag_csv_to_array(tagcsv):
 
 #
 def ebs_provision_volume(name, region='us-east-2', zone='a', size=20, voltype='gp2', tags='is_ci,true'):
+    from .Volumes import VolumeError, VolumeManager
+
     log_info("Creating EBS volume...")
 
     try:
-        ec2 = boto3.resource('ec2', region_name=region)
         log_debug("Creating EBS volume '{}'...".format(name))
-        vol = ec2.create_volume(Size=size, VolumeType=voltype, AvailabilityZone="{}{}".format(region, zone))
-        log_info("EBS volume '{}' created...".format(str(vol.id)))
+        volid = VolumeManager(region).create(name, "{}{}".format(region, zone), size, voltype, tag_csv_to_array(tags))
+        log_info("EBS volume '{}' created...".format(volid))
 
-        tags = tag_csv_to_array(tags)
-        log_info("Tagging volume '{}' : '{}'...".format(str(vol.id), tags))
-        ec2.create_tags(Resources=[vol.id], Tags=tags)
-
-    except (RuntimeError, Boto3Error) as e:
-        msg = "Failed while provisioning EBS volme!: {}".format(e.message)
+    except (RuntimeError, VolumeError, botocore_exceptions.ClientError, boto3_exceptions.Boto3Error) as e:
+        msg = "Failed while provisioning EBS volme!: {}".format(str(e))
         log_debug(msg)
         raise RuntimeError(msg) from e
 
-    return vol.id
+    return volid
 
 
 #
@@ -509,45 +551,186 @@ def aws_to_dm_env():
     return True
 
 
+# Directories find_files() never descends into, in addition to any excludes.
+FIND_FILES_PRUNE = ['.git', '.cache', '__pycache__']
+
+
 #
-def find_files(rootdir, pattern, excludes=[]):
+def find_files(rootdir, patterns, excludes=[]):
     """
-    Recursive find of files matching pattern starting at location of this script.
+    Single pass recursive find of files matching any of patterns starting at rootdir.
+
+    Directories are pruned before descending when their path contains one of
+    excludes or their name is in FIND_FILES_PRUNE.
 
     Args:
-      rootdir (str): where to scart file name matching
-      pattern (str): filename pattern to match
-      excludes: array of patterns for to exclude from find
+      rootdir (str): where to start file name matching
+      patterns (str|list): filename pattern(s) to match
+      excludes: array of path substrings to exclude from find
+
+    Yields:
+      tuple: (pattern, path) for each matching file, pattern being the first one it matched
+    """
+    if not isinstance(patterns, list):
+        patterns = [patterns]
+
+    log_debug("Search for patterns \'{}\' from root of \'{}\'...".format(patterns, rootdir))
+
+    pending = [rootdir]
+    while 0 != len(pending):
+        dirpath = pending.pop()
+        try:
+            entries = list(os.scandir(dirpath))
+        except OSError as e:
+            log_debug("Skipping unreadable directory \'{}\': {}".format(dirpath, e.strerror))
+            continue
+
+        for entry in entries:
+            if any(exclude in entry.path for exclude in excludes):
+                continue
+
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name not in FIND_FILES_PRUNE:
+                    pending.append(entry.path)
+                continue
+
+            for pattern in patterns:
+                if fnmatch.fnmatch(entry.name, pattern):
+                    yield pattern, entry.path
+                    break
+
+
+#
+def group_files(rootdir, patterns, excludes=[]):
+    """
+    Collect the results of a single find_files() pass keyed by pattern.
 
     Returns:
-      array: list of matching files
+      dict: pattern -> sorted list of matching files, False if rootdir does not exist
     """
-    matches = []
-    DEBUG = False
+    if not os.path.isdir(rootdir):
+        log_error("Failed to search \'{}\': no such directory!".format(rootdir))
+        return False
+
+    grouped = {pattern: [] for pattern in patterns}
+    for pattern, path in find_files(rootdir, patterns, excludes):
+        grouped[pattern].append(path)
+
+    for pattern in grouped:
+        grouped[pattern].sort()
+        log_debug("Matches for \'{}\' are : {}".format(pattern, grouped[pattern]))
+
+    return grouped
+
 
+# flake8 settings used by lint_check(). Part of the lint cache key so that changing
+# them invalidates previously cached clean results.
+FLAKE8_OPTIONS = {
+    'max_line_length': 160,
+    'ignore': ['E111', 'E114', 'E122', 'E401', 'E402', 'E266', 'F841', 'E126', 'E501'],
+    'show_source': True,
+}
+
+
+#
+def cache_path(*parts):
+    """
+    Path of a file in the on-disk cache shared between task invocations.
+
+    The cache lives in CI_CACHE_DIR when set, otherwise in '.cache' under the
+    current working directory (the Jenkins workspace for pipeline runs).
+    """
+    cachedir = str(os.environ.get('CI_CACHE_DIR', os.path.join(os.getcwd(), '.cache'))).rstrip()
+    os.makedirs(cachedir, exist_ok=True)
+    return os.path.join(cachedir, *parts)
+
+
+#
+def load_json_cache(filename, default=None):
     try:
-        log_debug("Search for pattern \'{}\' from root of '{}\'...".format(pattern, rootdir))
+        with open(filename, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError) as e:
+        log_debug("No usable cache in '{}': {}".format(filename, str(e)))
+        return {} if default is None else default
+
+
+#
+def save_json_cache(filename, data):
+    # write to a temp file and rename so a killed run never leaves a truncated cache
+    tmpfile = "{}.{}.tmp".format(filename, os.getpid())
+    with open(tmpfile, 'w') as f:
+        json.dump(data, f, sort_keys=True)
+    os.replace(tmpfile, filename)
+
 
-        for root, dirnames, filenames in walk(rootdir):
-            for filename in fnmatch.filter(filenames, pattern):
-                matches.append(os.path.join(root, filename))
+#
+def file_digest(filename):
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+#
+def flake8_check(rootdir, files, incremental=True, jobs=None):
+    """
+    Lint check Python files in-process via the flake8 API.
+
+    When incremental, only files whose content changed since the last clean run
+    are checked. Files are recorded as clean only when the whole checked set passes.
+
+    Args:
+      rootdir (str): root the file paths are cached relative to
+      files (list): Python files to check
+      incremental (bool): skip files which were clean on the last run
+      jobs (str): flake8 '--jobs' value, defaults to flake8's 'auto' (one worker per CPU)
 
-        # Oh, lcomp sytnax...
-        for exclude in excludes:
-            matches = numpy.asarray(
-                [match for match in matches if exclude not in match])
+    Returns:
+      bool: True if no lint errors were found
+    """
+    from flake8 import __version__ as flake8_version
+    from flake8.api import legacy as flake8_api
+
+    cache_file = cache_path('lint.json')
+    cache_key = hashlib.sha1(json.dumps([flake8_version, FLAKE8_OPTIONS], sort_keys=True).encode('utf-8')).hexdigest()
+
+    cache = load_json_cache(cache_file) if incremental else {}
+    if cache_key != cache.get('key'):
+        cache = {'key': cache_key, 'files': {}}
+
+    digests = {}
+    stale = []
+    for filename in files:
+        relpath = os.path.relpath(filename, rootdir)
+        digests[relpath] = file_digest(filename)
+        if cache['files'].get(relpath) != digests[relpath]:
+            stale.append(filename)
+    if 0 == len(stale):
+        log_info("All {} files unchanged since last clean lint run.".format(len(files)))
+        return True
 
-        log_debug("Matches in find_files is : {}".format(str(matches)))
+    log_info("Lint checking {} of {} files...".format(len(stale), len(files)))
+    log_debug("Lint checking \'{}\'...".format(' '.join(stale)))
 
-    except FileNotFoundError as e:
-        log_error("Failed to chdir to \'{}\': {} :: {}".format(e.errno, e.strerror))
+    options = dict(FLAKE8_OPTIONS)
+    if jobs is not None:
+        options['jobs'] = str(jobs)
+    report = flake8_api.get_style_guide(**options).check_files(stale)
+    if 0 != report.total_errors:
+        log_error("flake8 found {} error(s)!".format(report.total_errors))
         return False
 
-    return matches
+    # everything in this set is now known clean; files removed from the tree drop out
+    cache['files'] = digests
+    save_json_cache(cache_file, cache)
+
+    return True
 
 
 #
-def lint_check(rootdir, filetypes=[], excludes=[]):
+def lint_check(rootdir, filetypes=[], excludes=[], incremental=True):
 
     default_filetypes = ['py', 'pp', 'rb']
     result = True
@@ -568,32 +751,20 @@ def lint_check(rootdir, filetypes=[], excludes=[]):
         if False is result:
             return False
 
-    for filetype in filetypes:
-        filetype = '*.' + filetype
-
-        found_files = find_files(rootdir, filetype, excludes)
-        if False is found_files:
-            log_error("Error during lint check for files matching \'{}\'!")
-            return False
-
-        else:
-            if len(found_files) > 0:
+    patterns = ['*.' + filetype for filetype in filetypes]
+    grouped_files = group_files(rootdir, patterns, excludes)
+    if False is grouped_files:
+        log_error("Error during lint check for files matching \'{}\'!".format(patterns))
+        return False
 
-                # figure out which command we need to run to do a lint check
-                cmd = ''
-                if '*.py' == filetype:
-                    cmd = "flake8 --statistics --show-source --max-line-length=160 --ignore={} {}".format(
-                        'E111,E114,E122,E401,E402,E266,F841,E126,E501',
-                        ' '.join(found_files))
-
-#                cmd = cmd.format(' '.join(found_files))
-                log_debug("Lint checking \'{}\'...".format(' '.join(found_files)))
-                if is_debug_enabled():
-                    run(cmd, echo=True)
-                else:
-                    run(cmd)
+    for filetype in patterns:
+        found_files = grouped_files[filetype]
+        if len(found_files) > 0:
+            if '*.py' == filetype:
+                if not flake8_check(rootdir, found_files, incremental=incremental):
+                    result = False
 
-    return True
+    return result
 
 
 #
@@ -618,37 +789,36 @@ def syntax_check(rootdir, filetypes=[], excludes=[]):
         if False is result:
             return False
 
+    patterns = ['*.' + filetype for filetype in filetypes]
+    grouped_files = group_files(rootdir, patterns, excludes)
+    if False is grouped_files:
+        log_error("Error during syntax check for files matching \'{}\'!".format(patterns))
+        return False
+
     try:
-        for filetype in filetypes:
-            filetype = '*.' + filetype
+        for filetype in patterns:
+            found_files = grouped_files[filetype]
+            if len(found_files) > 0:
+                # figure out which command we need to run to do a syntax check
+                cmd = ''
+                if '*.sh' == filetype:
+                    cmd = "bash -n {}"
 
-            found_files = find_files(rootdir, filetype, excludes)
-            if False is found_files:
-                log_error("Error during syntax check for files matching \'{}\'!")
-                return False
+                elif '*.py' == filetype:
+                    cmd = "python -m py_compile {}"
 
-            else:
-                if len(found_files) > 0:
-                    # figure out which command we need to run to do a syntax check
-                    cmd = ''
-                    if '*.sh' == filetype:
-                        cmd = "bash -n {}"
-
-                    elif '*.py' == filetype:
-                        cmd = "python -m py_compile {}"
-
-                    # do the syntax check
-                    if '*.yaml' == filetype or '*.yaml' == filetype:
-                        for found_file in found_files:
-                            log_debug("Syntax checking \'{}\' via Python yaml.load()...".format(found_file))
-                            yaml.load(found_file)
+                # do the syntax check
+                if '*.yaml' == filetype or '*.yaml' == filetype:
+                    for found_file in found_files:
+                        log_debug("Syntax checking \'{}\' via Python yaml.load()...".format(found_file))
+                        yaml.load(found_file)
+                else:
+                    cmd = cmd.format(' '.join(found_files))
+                    log_debug("Syntax checking \'{}\'...".format(' '.join(found_files)))
+                    if is_debug_enabled():
+                        run(cmd, echo=True)
                     else:
-                        cmd = cmd.format(' '.join(found_files))
-                        log_debug("Syntax checking \'{}\'...".format(' '.join(found_files)))
-                        if is_debug_enabled():
-                            run(cmd, echo=True)
-                        else:
-                            run(cmd)
+                        run(cmd)
 
     except (yaml.YAMLError, Failure) as e:
         err_and_exit(str(e))
@@ -657,61 +827,77 @@ def syntax_check(rootdir, filetypes=[], excludes=[]):
 
 
 #
-def ec2_ensure_ssh_keypair(nodename):
-    log_debug('Ensuring a ssh keypair exists...')
+def ec2_ensure_ssh_keypair(region=None):
+    """
+    Returns:
+      str: name of the run's keypair, imported into 'region' if it is not there yet
+    """
+    from .KeyPair import KeyPairError, run_keypair
 
     try:
-        # create a key pair in the filesystem if one does not already exist
-        if not os.path.isfile('.ssh/{}'.format(nodename)):
-            run('mkdir -p .ssh && rm -rf .ssh/{}'.format(nodename), echo=True)
-            run("ssh-keygen -N '' -C '{}' -f .ssh/{}".format(nodename, nodename), echo=True)
-            run("chmod 0600 .ssh/{}".format(nodename), echo=True)
-
-        # update the key pair in AWS - Yes, Terraform has a Provider for this and Pupupet does not...
-        log_info("Uploading ssh pub key '{}' to AWS...".format(nodename))
-        ec2 = boto3.client('ec2', region_name=str(os.environ['AWS_DEFAULT_REGION']).rstrip())
-        ec2.delete_key_pair(KeyName=nodename)
-
-        pubkey = open('.ssh/{}.pub'.format(nodename), 'r').read()
-        log_debug("pub key: '{}'".format(pubkey))
-
-        #                        WTF??!? Docs say this has to b64 encoded!?!?
-        #                        b64pubkey = base64.b64encode(bytes(pubkey, 'utf-8').ascii())
-        #                        log_debug("base64 pub key: '{}'".format(b64pubkey))
-
-        ec2.import_key_pair(
-            KeyName=nodename,
-            PublicKeyMaterial=pubkey)
-
-    except (Failure, Boto3Error) as e:
-        msg = "Failed while ensuring ssh keypair!: {}".format(str(e))
+        return run_keypair().ensure(region)
+    except KeyPairError as e:
+        msg = "Failed while ensuring ssh keypair!: {}".format(e.message)
         log_debug(msg)
         raise RuntimeError(msg) from e
 
-    return nodename
+
+#
+def ec2_launch_spec(os_settings):
+    """
+    Launch parameters shared by every node regardless of how it is launched.
+
+    Returns:
+      dict: 'IamInstanceProfile', 'BlockDeviceMappings' and a 'NetworkInterface'
+            template which still needs its 'SubnetId'
+    """
+    # yuck
+    iam_profile = aws_resource('iam').InstanceProfile(str(os.environ['AWS_INSTANCE_PROFILE']))
+
+    # resize the root volume to 30 GB
+    custom_vols = [{'DeviceName': '/dev/sda1', 'Ebs': {'VolumeSize': 30}}]
+
+    # RHEL osfamily needs a second LVM volume for thinpool config
+    if 'redhat' == os_settings['family']:
+        custom_vols.append({
+            'DeviceName': '/dev/sdb',
+            'Ebs': {'VolumeSize': 30, 'DeleteOnTermination': True}})
+        log_info("Creating second volume to host thinpool config for RHEL osfamily: {}".format(custom_vols))
+
+    return {
+        'IamInstanceProfile': {'Name': iam_profile.name},
+        'BlockDeviceMappings': custom_vols,
+        'NetworkInterface': {
+            'DeviceIndex': 0,
+            'AssociatePublicIpAddress': True,
+            'Groups': [str(os.environ['AWS_SECURITY_GROUP_ID']).rstrip()],
+        },
+    }
 
 
 #
-def ec2_node_ensure(nodename, instance_type='m4.large'):
-    log_info("Ensuring node '{}'...".format(nodename))
+def ec2_node_ensure(nodename, instance_type='m4.large', scheduler=None, bootstrap_commands=None, config=None, role='server', extra_tags=None):
+    """
+    Launch the node 'nodename' unless it already runs.
 
-    server_os = str(os.environ['RANCHER_SERVER_OPERATINGSYSTEM']).rstrip()
-    os_settings = os_to_settings(server_os)
-    sgids = [str(os.environ['AWS_SECURITY_GROUP_ID']).rstrip()]
-    zone = str(os.environ['AWS_ZONE']).rstrip()
-    region = str(os.environ['AWS_DEFAULT_REGION']).rstrip()
-    placement = {'AvailabilityZone': '{}{}'.format(region, zone)}
-    subnetid = str(os.environ['AWS_SUBNET_ID']).rstrip()
-    region = str(os.environ['AWS_DEFAULT_REGION']).rstrip()
+    Args:
+      config (RunConfig): cluster the node belongs to, read from the environment when omitted
+      role (str): 'server' or 'agent', picks the operating system out of 'config'
+      extra_tags (list): tags the node carries from launch on, in addition to ec2_compute_tags()
+    """
+    from .Inventory import InventoryError, iter_instances, node_index
+    from .Placement import PlacementScheduler
+    from .RunConfig import RunConfig
 
-    custom_vols = None
+    log_info("Ensuring node '{}'...".format(nodename))
+
+    config = config or RunConfig.from_environ()
+    region = config.region
+    os_settings = config.agent_os_settings() if 'agent' == role else config.server_os_settings()
 
-    network_ifs = [{
-        'DeviceIndex': 0,
-        'SubnetId': subnetid,
-        'AssociatePublicIpAddress': True,
-        'Groups': sgids,
-    }]
+    # without a fleet-wide scheduler the node goes to AWS_SUBNETS / AWS_ZONE
+    if scheduler is None:
+        scheduler = PlacementScheduler.from_environ(region)
 
     # only intersted in nodes which might have same name and which are running or pending
     node_filter = [
@@ -720,75 +906,64 @@ def ec2_node_ensure(nodename, instance_type='m4.large'):
     ]
 
     try:
-        ec2 = boto3.client('ec2', region_name=region)
-        instances = ec2.describe_instances(Filters=node_filter)
-        log_debug("instance: {}".format(instances))
+        ec2 = aws_client('ec2', region)
+        existing = [record.id for record in iter_instances(node_filter, region)]
+        log_debug("{} instances named '{}' already running: {}".format(len(existing), nodename, existing))
 
         # first check if server(s) by our specified name already exists
-        if 0 != len(instances['Reservations']):
+        if 0 != len(existing):
             msg = "Detected already running instance by name of '{}'...".format(nodename)
             log_debug(msg)
             raise RuntimeError(msg)
 
         # nope, let's go ahead and create one
         else:
-            keyname = ec2_ensure_ssh_keypair(nodename)
-
-            # yuck
-            iam_profile = boto3.resource('iam').InstanceProfile(str(os.environ['AWS_INSTANCE_PROFILE']))
-            iam_profile = {'Name': iam_profile.name}
-
-            # resize the root volume to 30 GB
-            custom_vols = [{'DeviceName': '/dev/sda1', 'Ebs': {'VolumeSize': 30}}]
-
-            # RHEL osfamily needs a second LVM volume for thinpool config
-            if 'rhel' in server_os or 'centos' in server_os:
-                custom_vols.append({
-                    'DeviceName': '/dev/sdb',
-                    'Ebs': {'VolumeSize': 30, 'DeleteOnTermination': True}})
-                log_info("Creating second volume to host thinpool config for RHEL osfamily: {}".format(custom_vols))
+            keyname = ec2_ensure_ssh_keypair(region)
 
+            launch_spec = ec2_launch_spec(os_settings)
             log_info("Creating Rancher Server '{}'...".format(nodename))
 
-            # have to include block device mapping configs for these OSes and setting
-            # the parameter to None makes the boto3 API unhappy. :\
-
-            instance = ec2.run_instances(
-                ImageId=os_settings['ami-id'],
-                MinCount=1,
-                MaxCount=1,
-                KeyName=keyname,
-                InstanceType=instance_type,
-                Placement=placement,
-                NetworkInterfaces=network_ifs,
-                IamInstanceProfile=iam_profile,
-                BlockDeviceMappings=custom_vols)
-
-            log_debug("run request response for '{}'...".format(instance))
-            log_debug("instance info: {}".format(instance['Instances']))
+            # tag at launch so the tags are there before anything on the node looks for them
+            tags = ec2_compute_tags(nodename, config) + list(extra_tags or [])
+            log_info("Tagging instance '{}' with tags: {}".format(nodename, tags))
+
+            extra_args = {}
+            if 'userdata' == bootstrap_mode():
+                extra_args['UserData'] = ec2_bootstrap_userdata(tags, os_settings, bootstrap_commands)
+
+            def launch(candidate_type, zone, subnetid):
+                return ec2.run_instances(
+                    ImageId=os_settings['ami-id'],
+                    MinCount=1,
+                    MaxCount=1,
+                    KeyName=keyname,
+                    InstanceType=candidate_type,
+                    Placement={'AvailabilityZone': '{}{}'.format(region, zone)},
+                    NetworkInterfaces=[dict(launch_spec['NetworkInterface'], SubnetId=subnetid)],
+                    IamInstanceProfile=launch_spec['IamInstanceProfile'],
+                    BlockDeviceMappings=launch_spec['BlockDeviceMappings'],
+                    TagSpecifications=[{'ResourceType': 'instance', 'Tags': tags}],
+                    **extra_args)
+
+            # capacity shortfalls fail over to the next zone, then down the ranked instance types
+            instance, placement = scheduler.launch(nodename, instance_type, launch)
+
+            log_debug("Launched {} as '{}' from '{}'.".format(
+                [i['InstanceId'] for i in instance['Instances']], instance['Instances'][0]['InstanceType'], instance['Instances'][0]['ImageId']))
 
             instance_id = instance['Instances'][0]['InstanceId']
             log_info("instance-id of Rancher Server node: {}".format(instance_id))
-
-            # we have to sleep for a bit before we start asking for node metadata
-            time.sleep(20)
-
-            tags = ec2_compute_tags(nodename)
-            log_info("Tagging instance '{}' with tags: {}".format(instance_id, tags))
-
-            # give our instance time to enter 'pending' before we try to tag it
-            ec2.create_tags(
-                Resources=[instance_id],
-                Tags=tags)
+            node_index(region).discard(nodename)
 
         # waiting for 'running' is the easiest way to eliminate race conditions later
         log_info("Waiting for node to enter state 'running'...")
         ec2_wait_for_state(instance_id, 'running')
 
-        public_ip = ec2_node_public_ip(nodename, region)
+        public_ip = node_index(region).public_ip(nodename)
+        node = node_index(region).get(nodename)
         log_info("Node '{}' is available at address '{}'.".format(nodename, public_ip))
 
-    except (ClientError, Boto3Error) as e:
+    except (InventoryError, botocore_exceptions.ClientError, boto3_exceptions.Boto3Error) as e:
         addtl_msg = str(e)
         if 'ClientError' == e.__class__.__name__:
             errmsg = e.response['Error']['Message']
@@ -800,56 +975,131 @@ def ec2_node_ensure(nodename, instance_type='m4.large'):
         log_debug(msg)
         raise RuntimeError(msg) from e
 
-    nuke_aws_keypair(keyname)
-    return True
+    return node
 
 
 #
-def ec2_node_public_ip(nodename, region='us-east-2'):
+def bootstrap_mode():
+    mode = str(os.environ.get('RANCHER_BOOTSTRAP_MODE', 'ssh')).rstrip().lower()
+    if mode not in ['ssh', 'userdata']:
+        raise RuntimeError("Unsupported RANCHER_BOOTSTRAP_MODE '{}'! Choose one of: ssh, userdata".format(mode))
+    return mode
 
-    node_filter = [
-        {'Name': 'tag:Name', 'Values': [nodename]},
-        {'Name': 'instance-state-name', 'Values': ['running', 'pending']}
-    ]
+
+#
+def ec2_bootstrap_userdata(tags, os_settings, commands=None):
+    from .Artifacts import ArtifactsError, bootstrap_userdata
 
     try:
-        ec2 = boto3.client('ec2', region_name=region)
-        instances = ec2.describe_instances(Filters=node_filter)
-        rez = instances['Reservations']
-        log_debug("reservations: {}".format(rez))
+        return bootstrap_userdata(tags, os_settings['ssh_username'], commands)
+    except ArtifactsError as e:
+        raise RuntimeError(e.message) from e
 
-        if len(rez) > 1:
-            raise RuntimeError("Detected more than one reservation matching the filter. That's a problem!")
-        else:
-            pubip = str(rez[0]['Instances'][0]['PublicIpAddress'])
 
-    except (ClientError, Boto3Error) as e:
-        msg = "Failed while getting public IP address for node '{}'!: {}".format(nodename, str(e))
+#
+def ec2_wait_for_bootstrap(nodenames, region=None, timeout=1800, step=10):
+    """
+    Wait until every node has reported its user-data bootstrap through the
+    rancher.ci.bootstrap tag, polling the pending ones MAX_FILTER_VALUES names
+    per describe call.
+    """
+    from .Artifacts import BOOTSTRAP_TAG
+    from .Deadline import run_deadline
+    from .Inventory import MAX_FILTER_VALUES, iter_instances
+    from .Scale import chunks
+
+    region = region or aws_get_region()
+    log_info("Waiting for {} nodes to finish bootstrapping...".format(len(nodenames)))
+
+    deadline = run_deadline()
+    timeout = deadline.clamp(timeout, 'nodes to bootstrap')
+
+    status = {}
+    pending = list(nodenames)
+    starttime = time.time()
+    while time.time() - starttime < timeout:
+        try:
+            for batch in chunks(pending, MAX_FILTER_VALUES):
+                node_filter = [
+                    {'Name': 'tag:Name', 'Values': batch},
+                    {'Name': 'instance-state-name', 'Values': ['running', 'pending']}
+                ]
+                for record in iter_instances(node_filter, region):
+                    status[record.name] = record.tags.get(BOOTSTRAP_TAG)
+
+        except (botocore_exceptions.ClientError, boto3_exceptions.Boto3Error) as e:
+            msg = "Failed while querying bootstrap status!: {}".format(str(e))
+            log_debug(msg)
+            raise RuntimeError(msg) from e
+
+        failed = [name for name in nodenames if 'failed' == status.get(name)]
+        if 0 != len(failed):
+            raise RuntimeError("Bootstrap failed on nodes: {}!".format(', '.join(failed)))
+
+        pending = [name for name in nodenames if 'done' != status.get(name)]
+        if 0 == len(pending):
+            log_info("All {} nodes bootstrapped after {:.0f} seconds.".format(len(nodenames), time.time() - starttime))
+            return True
+
+        log_debug("{} of {} nodes still bootstrapping: {}".format(len(pending), len(nodenames), ', '.join(pending)))
+        deadline.sleep(step, 'nodes to bootstrap')
+
+    raise RuntimeError("Timed out after {} seconds waiting for nodes to bootstrap!".format(timeout))
+
+
+#
+def ec2_nodes_public_ips(nodenames, region=None):
+    """
+    Public IPs of many nodes, all read from the node index.
+
+    Returns:
+      dict: public IP per node name
+    """
+    from .Inventory import InventoryError, node_index
+
+    try:
+        index = node_index(region)
+        return dict((name, index.public_ip(name)) for name in nodenames)
+    except InventoryError as e:
+        msg = "Failed while getting public IP addresses for {} nodes!: {}".format(len(nodenames), str(e))
         log_debug(msg)
         raise RuntimeError(msg) from e
 
-    return pubip
+
+#
+def ec2_node_public_ip(nodename, region='us-east-2'):
+    from .Inventory import InventoryError, node_index
+
+    # nodename may also be a NodeRecord
+    try:
+        return node_index(region).public_ip(nodename)
+    except InventoryError as e:
+        msg = "Failed while getting public IP address for node '{}'!: {}".format(nodename, str(e))
+        log_debug(msg)
+        raise RuntimeError(msg) from e
 
 
 #
 def ec2_node_terminate(nodename, region='us-east-2'):
-    log_info("Terminating instance '{}'..".format(nodename))
+    from .Inventory import InventoryError, NodeRecord, node_index
 
-    node_filter = [
-        {'Name': 'tag:Name', 'Values': [nodename]},
-        {'Name': 'instance-state-name', 'Values': ['running', 'pending']}
-    ]
+    log_info("Terminating instance '{}'..".format(nodename))
 
     try:
-        ec2 = boto3.client('ec2', region_name=region)
-        rez = ec2.describe_instances(Filters=node_filter)['Reservations']
+        index = node_index(region)
+        if isinstance(nodename, NodeRecord):
+            records, nodename = [nodename], nodename.name
+        else:
+            records = index.find(nodename)
+
+        instance_ids = [record.id for record in records]
+        index.discard(nodename)
 
-        for node in range(0, len(rez)):
-            instance_id = rez[0]['Instances'][node]['InstanceId']
-            log_info("Terminated instance-id '{}'...".format(instance_id))
-            ec2.terminate_instances(InstanceIds=[instance_id])
+        if 0 != len(instance_ids):
+            aws_client('ec2', region).terminate_instances(InstanceIds=instance_ids)
+            log_info("Terminated instance-ids '{}'...".format(', '.join(instance_ids)))
 
-    except Boto3Error as e:
+    except (InventoryError, botocore_exceptions.ClientError, boto3_exceptions.Boto3Error) as e:
         msg = "Failed while terminating node '{}'!: {}".format(nodename, str(e))
         log_debug(msg)
         raise RuntimeError(msg) from e
@@ -4,7 +4,8 @@ set -eu
 
 DEBUG="${DEBUG:-false}"
 
-env | egrep '^(RANCHER_|AWS_|DEBUG|DOCKER_|BUILD_NUMBER).*\=.+' | sort > .env
+# RANCHER_CI_RUN_ID, when given, makes this build act on the nodes of an earlier run
+env | egrep '^(RANCHER_|AWS_|DEBUG|DOCKER_|BUILD_NUMBER|BUILD_TAG).*\=.+' | sort > .env
 
 if [ "false" != "${DEBUG}" ]; then
     cat .env
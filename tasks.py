@@ -1,9 +1,20 @@
-import os
+import os, json
+from functools import partial
 from invoke import task, Collection, run, Failure
 
-from lib.python.utils import log_info, log_success, syntax_check, lint_check, err_and_exit
+from lib.python.utils import log_info, log_warn, log_success, syntax_check, lint_check, err_and_exit, import_time_profile
 from lib.python.utils.RancherAgents import RancherAgents, RancherAgentsError
 from lib.python.utils.RancherServer import RancherServer, RancherServerError
+from lib.python.utils.Pipeline import Pipeline
+from lib.python.utils.KeyPair import KeyPairError, run_keypair
+from lib.python.utils.Namespace import allocate_run_id
+from lib.python.utils.Reaper import ReaperError, expire_run, reap_expired_runs
+from lib.python.utils.Matrix import MatrixRunner, MatrixError, load_matrix
+from lib.python.utils.RunConfig import RunConfig, RunConfigError
+from lib.python.utils.History import HistoryError, run_history
+from lib.python.utils.Shards import ShardRunner, ShardsError
+from lib.python.utils.Snapshots import server_snapshots
+from lib.python.utils.Deadline import start_deadline, run_deadline
 
 
 @task
@@ -12,16 +23,8 @@ def syntax(ctx):
     Recursively syntax check various files.
     """
 
-    log_info("Syntax checking of YAML files...")
-    syntax_check(os.path.dirname(__file__), 'yaml')
-    log_success()
-
-    log_info("Syntax checking of Python files...")
-    syntax_check(os.path.dirname(__file__), 'py')
-    log_success()
-
-    log_info("Syntax checking of BASH scripts..")
-    syntax_check(os.path.dirname(__file__), 'sh')
+    log_info("Syntax checking of YAML files, Python files and BASH scripts...")
+    syntax_check(os.path.dirname(__file__), ['yaml', 'py', 'sh'])
     log_success()
 
 
@@ -39,13 +42,30 @@ def reset(ctx):
 
 
 @task(reset)
-def lint(ctx):
+def lint(ctx, full=False):
     """
     Recursively lint check Python files in this project using flake8.
+
+    Only files changed since the last clean run are checked unless --full is given.
     """
 
     log_info("Lint checking Python files...")
-    lint_check(os.path.dirname(__file__), 'py', excludes=['validation-tests'])
+    if not lint_check(os.path.dirname(__file__), 'py', excludes=['validation-tests'], incremental=not full):
+        err_and_exit("Lint check failed!")
+    log_success()
+
+
+@task
+def unit(ctx):
+    """
+    Run the offline unit tests under tests/.
+    """
+
+    log_info("Running unit tests...")
+    try:
+        run('python -m unittest discover -s tests -t .', echo=True)
+    except Failure as e:
+        err_and_exit("Unit tests failed!: {} :: {}".format(e.result.return_code, e.result.stderr))
     log_success()
 
 
@@ -65,7 +85,47 @@ def bootstrap(ctx):
     log_success()
 
 
-@task(reset, syntax, lint)
+# Modules each task imports on first use, on top of what 'import tasks' costs every task.
+IMPORTTIME_TASKS = {
+    'syntax': ['yaml'],
+    'lint': ['flake8.api.legacy'],
+    'rancher_server': ['boto3', 'requests'],
+    'rancher_agents': ['boto3', 'requests'],
+}
+
+
+@task
+def importtime(ctx, output=''):
+    """
+    Benchmark interpreter startup cost per task via 'python -X importtime'.
+
+    Results can be written as JSON with --output so they can be tracked across builds.
+    """
+
+    results = {}
+    rootdir = os.path.dirname(os.path.abspath(__file__))
+    statements = {'startup': 'import tasks'}
+    for taskname, modules in IMPORTTIME_TASKS.items():
+        statements[taskname] = 'import tasks; ' + '; '.join('import ' + module for module in modules)
+
+    for name in sorted(statements):
+        try:
+            results[name] = import_time_profile(statements[name], cwd=rootdir)
+        except Failure as e:
+            err_and_exit("Failed to profile imports for '{}'!: {} :: {}".format(name, e.result.return_code, e.result.stderr))
+
+        log_info("{:<16} {:>9.1f} ms".format(name, results[name]['total_us'] / 1000.0))
+        for cumulative, module in results[name]['top']:
+            log_info("    {:>9.1f} ms  {}".format(cumulative / 1000.0, module))
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    log_success()
+
+
+@task(reset, syntax, lint, unit)
 def ci(ctx):
     """
     Task to be called by CI systems.
@@ -98,6 +158,54 @@ def rancher_server_deprovision(ctx):
 
 
 @task
+def keys_cleanup(ctx):
+    """
+    Remove the run's ssh keypair from AWS and the work directory.
+    """
+    try:
+        if RunConfig.from_environ().run_id is None:
+            log_success("No run id allocated, so no ssh keypair to clean up.")
+            return
+        run_keypair().cleanup()
+    except (KeyPairError, RunConfigError) as e:
+        err_and_exit("Failed to remove the run's ssh keypair! : {}".format(e.message))
+    log_success("SSH keypair cleanup : [OK]")
+
+
+@task
+def run_id_allocate(ctx):
+    """
+    Allocate the run id which names this build's nodes, unless it already has one.
+    """
+    try:
+        log_success("Run id '{}' : [OK]".format(allocate_run_id()))
+    except OSError as e:
+        err_and_exit("Failed to allocate a run id! : {}".format(str(e)))
+
+
+@task
+def reap(ctx):
+    """
+    Terminate the nodes of earlier runs which outlived RANCHER_CI_RUN_TTL, e.g. of crashed or aborted builds.
+    """
+    try:
+        config = RunConfig.from_environ()
+        reaped = reap_expired_runs(config.region, keep=config.run_id)
+    except (ReaperError, RunConfigError) as e:
+        err_and_exit("Failed to reap expired runs! : {}".format(e.message))
+    log_success("Reaped {} expired runs : [OK]".format(reaped['runs']))
+
+
+@task
+def rancher_server_snapshots_clear(ctx, key=''):
+    """
+    Drop the server snapshot stored under --key, e.g. 'v1.6.10-cattle', or all of them.
+    """
+    dropped = server_snapshots().invalidate(key or None)
+    log_success("Dropped {} server snapshots.".format(dropped))
+
+
+@task(run_id_allocate)
 def rancher_server_provision(ctx):
     """
     Provision Rancher Server node.
@@ -129,13 +237,13 @@ def rancher_server_configure(ctx):
     Configure Rancher Server node.
     """
     try:
-        RancherServer().configure()
+        time_to_ready = RancherServer().configure()
     except RancherServerError as e:
         err_and_exit("Failed to configure Rancher Server node! : {}".format(e.message))
-    log_success("Rancher Server configuration: [OK]")
+    log_success("Rancher Server configuration: [OK] API ready after {:.1f}s".format(time_to_ready))
 
 
-@task
+@task(run_id_allocate)
 def rancher_agents_provision(ctx):
     """
     Provision Rancher Agent nodes.
@@ -147,7 +255,19 @@ def rancher_agents_provision(ctx):
     log_success("Rancher Agents provisioning : [OK]")
 
 
-@task
+@task(run_id_allocate)
+def rancher_agents_provision_scale(ctx):
+    """
+    Provision hundreds of Rancher Agent nodes for scale testing.
+    """
+    try:
+        RancherAgents().provision_scale()
+    except RancherAgentsError as e:
+        err_and_exit("Failed to provision Rancher Agent nodes for scale testing! : {}".format(e.message))
+    log_success("Rancher Agents scale provisioning : [OK]")
+
+
+@task(run_id_allocate)
 def rancher_agents_provision_standalone(ctx):
     """
     Provision Rancher Agent nodes.
@@ -159,21 +279,195 @@ def rancher_agents_provision_standalone(ctx):
     log_success("Rancher Agents provisioning : [OK]")
 
 
+# Stages run by 'invoke pipeline' for each phase, in order.
+PIPELINE_PHASES = {
+    'provision': ['reap',
+                  'rancher_agents.deprovision',
+                  'rancher_server.deprovision',
+                  'rancher_server.provision',
+                  'rancher_server.configure',
+                  'rancher_agents.provision'],
+    'teardown': ['rancher_agents.deprovision',
+                 'rancher_server.deprovision',
+                 'keys.cleanup'],
+}
+
+PIPELINE_STAGES = {
+    'reap': reap,
+    'rancher_agents.deprovision': rancher_agents_deprovision,
+    'rancher_server.deprovision': rancher_server_deprovision,
+    'rancher_server.provision': rancher_server_provision,
+    'rancher_server.configure': rancher_server_configure,
+    'rancher_agents.provision': rancher_agents_provision,
+    'keys.cleanup': keys_cleanup,
+}
+
+
+@task
+def pipeline(ctx, phase='provision', resume=False, deadline=''):
+    """
+    Run every stage of a pipeline phase ('provision' or 'teardown') in one process.
+
+    Per-stage exit codes are recorded in pipeline-<phase>[.<BUILD_NUMBER>].json under
+    WORKSPACE_DIR and --resume skips the stages which already succeeded. All waiting
+    shares one budget of --deadline seconds, RANCHER_CI_DEADLINE by default.
+    """
+    if phase not in PIPELINE_PHASES:
+        err_and_exit("Unknown pipeline phase '{}'! Choose one of: {}".format(phase, ', '.join(sorted(PIPELINE_PHASES))))
+
+    statefile = "{}/pipeline-{}".format(str(os.environ.get('WORKSPACE_DIR', os.getcwd())).rstrip(), phase)
+    if os.environ.get('BUILD_NUMBER'):
+        statefile = "{}.{}".format(statefile, os.environ.get('BUILD_NUMBER'))
+    statefile = "{}.json".format(statefile)
+
+    # only provisioning allocates the run id, teardown tears down the one provisioning left
+    if 'provision' == phase:
+        run_id_allocate(ctx)
+
+    stages = [(name, partial(PIPELINE_STAGES[name], ctx)) for name in PIPELINE_PHASES[phase]]
+    runner = Pipeline(phase, stages, statefile)
+    start_deadline(float(deadline) if deadline else None)
+    exit_code = runner.run(resume=resume)
+    runner.report()
+    run_deadline().log_report()
+
+    # timings are nice to have, never a reason to fail the build
+    try:
+        history = run_history()
+        history.record_stages(history.record_run(RunConfig.from_environ()), runner.state['stages'])
+    except (HistoryError, RunConfigError) as e:
+        log_warn("Could not record stage timings! : {}".format(e.message))
+
+    # the nodes of a failed provisioning go with the next build's reap, not after RANCHER_CI_RUN_TTL
+    if 0 != exit_code and 'provision' == phase:
+        try:
+            config = RunConfig.from_environ()
+            expire_run(config.run_id, config.region)
+        except (ReaperError, RunConfigError) as e:
+            log_warn("Could not mark the nodes of the failed run as expired! : {}".format(e.message))
+
+    if 0 != exit_code:
+        err_and_exit("Pipeline phase '{}' failed!".format(phase))
+
+
+@task(run_id_allocate)
+def matrix(ctx, spec='matrix.yaml', max_live=2, validate_cmd='', deadline=''):
+    """
+    Provision, validate and tear down every combination of a matrix file in one process.
+
+    At most --max-live clusters exist at the same time. --validate-cmd runs against each
+    cluster with CATTLE_TEST_URL and MATRIX_LABEL exported; per-cell results are written to
+    matrix[.<BUILD_NUMBER>].json under WORKSPACE_DIR. All cells share one waiting budget
+    of --deadline seconds, RANCHER_CI_DEADLINE by default.
+    """
+    try:
+        cells = load_matrix(spec)
+        statefile = "{}/matrix".format(str(os.environ.get('WORKSPACE_DIR', os.getcwd())).rstrip())
+        if os.environ.get('BUILD_NUMBER'):
+            statefile = "{}.{}".format(statefile, os.environ.get('BUILD_NUMBER'))
+        statefile = "{}.json".format(statefile)
+
+        runner = MatrixRunner(cells, max_live=int(max_live), validate_cmd=validate_cmd or None, statefile=statefile)
+        start_deadline(float(deadline) if deadline else None)
+        failed = runner.run()
+        runner.report()
+        run_deadline().log_report()
+    except (MatrixError, RunConfigError) as e:
+        err_and_exit("Failed to run matrix '{}'! : {}".format(spec, e.message))
+
+    if 0 != failed:
+        err_and_exit("{} of {} matrix cells failed!".format(failed, len(cells)))
+    log_success("Matrix '{}' : [OK]".format(spec))
+
+
+@task
+def validation_tests(ctx, path='validation-tests/tests/v2_validation/cattlevalidationtest/', shards=4, pytest_args='-s', output='results.xml'):
+    """
+    Run the validation tests as --shards parallel py.test processes balanced by earlier timings.
+
+    Shard results are merged into --output and recorded in the workspace history, whose
+    per-module durations balance the next run. Expects CATTLE_TEST_URL and friends in the
+    environment, like a plain py.test run.
+    """
+    log_info("Running validation tests in '{}' over {} shards...".format(path, shards))
+    try:
+        history = run_history()
+        run_id = history.record_run(RunConfig.from_environ())
+        runner = ShardRunner(path, shards=int(shards), pytest_args=pytest_args, output=output, history=history, run_id=run_id)
+        totals = runner.run()
+    except (ShardsError, HistoryError, RunConfigError) as e:
+        err_and_exit("Failed to run validation tests! : {}".format(e.message))
+
+    crashed = [i for i, result in runner.results.items() if result['exit_code'] not in [0, 1, 5]]
+    if 0 != len(crashed) or 0 != totals['failures'] + totals['errors']:
+        err_and_exit("Validation tests had {} failures and {} errors, shards {} crashed!".format(totals['failures'], totals['errors'], crashed))
+    log_success("Validation tests : [OK] {} tests".format(totals['tests']))
+
+
+@task
+def history_ingest(ctx, junit='results.xml'):
+    """
+    Record the test durations of a JUnit file, e.g. of a plain py.test run, in the workspace history.
+    """
+    try:
+        history = run_history()
+        count = history.ingest_junit(history.record_run(RunConfig.from_environ()), junit)
+    except (HistoryError, RunConfigError) as e:
+        err_and_exit("Failed to record test timings from '{}'! : {}".format(junit, e.message))
+    log_success("Recorded {} test timings from '{}'.".format(count, junit))
+
+
+@task
+def history_report(ctx, kind='stage', dimension='docker_version', percentile=90, threshold=40, min_runs=3):
+    """
+    Show the p<--percentile> of stage or test timings per --dimension value, and flag rises of --threshold percent or more.
+    """
+    q = float(percentile) / 100.0
+    try:
+        history = run_history()
+        percentiles = history.percentiles(kind, dimension, q)
+        regressions = history.regressions(kind, dimension, q, float(threshold) / 100.0, int(min_runs))
+    except HistoryError as e:
+        err_and_exit("Failed to query the history! : {}".format(e.message))
+
+    for name in sorted(percentiles):
+        log_info(name)
+        for value, runs, seconds in percentiles[name]:
+            log_info("    {:<32} {:>4} runs  p{} {:>8.1f}s".format(str(value), runs, percentile, seconds))
+
+    for name, before, after, old, new, change in regressions:
+        log_warn("{} p{} up {:.0f}% since {} {} ({:.1f}s under {}, {:.1f}s now)".format(
+            name, percentile, 100 * change, dimension, after, old, before, new))
+    log_success("{} regressions found.".format(len(regressions)))
+
+
 ns = Collection('')
 ns.add_task(reset, 'reset')
 ns.add_task(syntax, 'syntax')
 ns.add_task(lint, 'lint')
+ns.add_task(unit, 'unit')
 ns.add_task(ci, 'ci')
+ns.add_task(importtime, 'importtime')
+ns.add_task(pipeline, 'pipeline')
+ns.add_task(keys_cleanup, 'keys_cleanup')
+ns.add_task(reap, 'reap')
+ns.add_task(run_id_allocate, 'run_id')
+ns.add_task(matrix, 'matrix')
+ns.add_task(validation_tests, 'validation_tests')
+ns.add_task(history_ingest, 'history_ingest')
+ns.add_task(history_report, 'history_report')
 
 rs = Collection('rancher_server')
 rs.add_task(rancher_server_provision, 'provision')
 rs.add_task(rancher_server_deprovision, 'deprovision')
 # rs.add_task(rancher_server_validate, 'validate')
 rs.add_task(rancher_server_configure, 'configure')
+rs.add_task(rancher_server_snapshots_clear, 'snapshots_clear')
 ns.add_collection(rs)
 
 ra = Collection('rancher_agents')
 ra.add_task(rancher_agents_provision, 'provision')
 ra.add_task(rancher_agents_deprovision, 'deprovision')
 ra.add_task(rancher_agents_provision_standalone, 'provisionstandalone')
+ra.add_task(rancher_agents_provision_scale, 'provisionscale')
 ns.add_collection(ra)
@@ -0,0 +1,116 @@
+import os, shutil, tempfile, unittest
+
+import boto3
+from botocore.stub import Stubber
+
+from lib.python.utils import os_to_settings
+from lib.python.utils import AMICatalog as catalog_module
+from lib.python.utils.AMICatalog import AMICatalog, AMICatalogError
+
+
+FIXTURE_CATALOG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'catalog.yaml')
+
+
+#
+def _client(service):
+    return boto3.client(service, region_name='us-east-2', aws_access_key_id='test', aws_secret_access_key='test')
+
+
+#
+def _offline(service, region):
+    raise AssertionError("Unexpected '{}' client for '{}'!".format(service, region))
+
+
+#
+class AMICatalogTest(unittest.TestCase):
+
+    #
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cachefile = os.path.join(self.tmpdir, 'ami.json')
+
+    #
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    #
+    def catalog(self, client_factory=_offline):
+        return AMICatalog(FIXTURE_CATALOG, self.cachefile, ttl=3600, client_factory=client_factory)
+
+    #
+    def test_pinned_region_needs_no_lookup(self):
+        settings = self.catalog().settings('pinned-os', 'us-east-2')
+        self.assertEqual({'ami-id': 'ami-00000000000000001', 'ssh_username': 'ubuntu', 'family': 'debian'}, settings)
+
+    #
+    def test_ssm_lookup_is_cached_on_disk(self):
+        ssm = _client('ssm')
+        stubber = Stubber(ssm)
+        stubber.add_response('get_parameter',
+                             {'Parameter': {'Name': '/test/ssm-os/ami-id', 'Value': 'ami-0000000000000ssm1'}},
+                             {'Name': '/test/ssm-os/ami-id'})
+
+        with stubber:
+            self.assertEqual('ami-0000000000000ssm1', self.catalog(lambda service, region: ssm).ami('ssm-os', 'eu-west-1'))
+            stubber.assert_no_pending_responses()
+
+        # a fresh catalog finds the AMI in the cache file
+        self.assertEqual('ami-0000000000000ssm1', self.catalog().ami('ssm-os', 'eu-west-1'))
+
+    #
+    def test_unpinned_region_of_pinned_os_uses_ssm(self):
+        ssm = _client('ssm')
+        stubber = Stubber(ssm)
+        stubber.add_response('get_parameter',
+                             {'Parameter': {'Name': '/test/pinned-os/ami-id', 'Value': 'ami-0000000000000ssm2'}},
+                             {'Name': '/test/pinned-os/ami-id'})
+
+        with stubber:
+            self.assertEqual('ami-0000000000000ssm2', self.catalog(lambda service, region: ssm).ami('pinned-os', 'us-west-2'))
+
+    #
+    def test_images_lookup_picks_newest(self):
+        ec2 = _client('ec2')
+        stubber = Stubber(ec2)
+        stubber.add_response('describe_images',
+                             {'Images': [{'ImageId': 'ami-000000000000old01', 'CreationDate': '2018-01-01T00:00:00.000Z'},
+                                         {'ImageId': 'ami-000000000000new01', 'CreationDate': '2018-06-01T00:00:00.000Z'}]},
+                             {'Owners': ['605812595337'],
+                              'Filters': [{'Name': 'name', 'Values': ['rancheros-v1.*-hvm-1']},
+                                          {'Name': 'state', 'Values': ['available']}]})
+
+        with stubber:
+            self.assertEqual('ami-000000000000new01', self.catalog(lambda service, region: ec2).ami('images-os', 'us-east-2'))
+
+    #
+    def test_no_matching_image(self):
+        ec2 = _client('ec2')
+        stubber = Stubber(ec2)
+        stubber.add_response('describe_images', {'Images': []})
+
+        with stubber:
+            with self.assertRaises(AMICatalogError):
+                self.catalog(lambda service, region: ec2).ami('images-os', 'us-east-2')
+
+    #
+    def test_unsupported_os(self):
+        with self.assertRaises(AMICatalogError):
+            self.catalog().settings('windows-95', 'us-east-2')
+
+    #
+    def test_os_to_settings_reads_catalog_from_environment(self):
+        saved = os.environ.get('RANCHER_AMI_CATALOG')
+        os.environ['RANCHER_AMI_CATALOG'] = FIXTURE_CATALOG
+        catalog_module._catalog = None
+        try:
+            self.assertEqual('ami-00000000000000001', os_to_settings('pinned-os', 'us-east-2')['ami-id'])
+        finally:
+            catalog_module._catalog = None
+            if saved is None:
+                del os.environ['RANCHER_AMI_CATALOG']
+            else:
+                os.environ['RANCHER_AMI_CATALOG'] = saved
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import os, unittest
+
+from unittest import mock
+
+from lib.python.utils import Deadline as deadlines
+from lib.python.utils.Deadline import Deadline, DeadlineError, run_deadline, start_deadline, waiter_config
+from lib.python.utils.SSH import SSHBroadcast, SSHError
+
+
+#
+class WaiterConfigTest(unittest.TestCase):
+
+    #
+    def test_attempts_fit_the_remaining_budget(self):
+        self.assertEqual({'Delay': 15, 'MaxAttempts': 4}, waiter_config(64.0))
+
+    #
+    def test_at_least_one_attempt(self):
+        self.assertEqual({'Delay': 15, 'MaxAttempts': 1}, waiter_config(3.0))
+
+    #
+    def test_no_limit_keeps_waiter_attempts(self):
+        self.assertEqual({'Delay': 5}, waiter_config(Deadline(0).remaining(), 5))
+
+    #
+    def test_span_yields_remaining_budget(self):
+        deadline = Deadline(120)
+        with deadline.span('nodes') as remaining:
+            config = waiter_config(remaining)
+        self.assertLessEqual(config['MaxAttempts'], 8)
+        self.assertEqual('nodes', deadline.report()[0][0])
+
+    #
+    def test_span_refuses_spent_budget(self):
+        deadline = Deadline(120)
+        deadline.expires = deadline.start
+        with self.assertRaises(DeadlineError):
+            with deadline.span('nodes'):
+                pass
+
+
+#
+class RunDeadlineTest(unittest.TestCase):
+
+    #
+    def setUp(self):
+        self.environ = mock.patch.dict(os.environ, {'RANCHER_CI_DEADLINE': '600'})
+        self.environ.start()
+        self.deadline = mock.patch.object(deadlines, '_deadline', None)
+        self.deadline.start()
+
+    #
+    def tearDown(self):
+        self.deadline.stop()
+        self.environ.stop()
+
+    #
+    def test_standalone_tasks_are_unbounded(self):
+        self.assertEqual(float('inf'), run_deadline().remaining())
+
+    #
+    def test_pipeline_budget_from_environment(self):
+        start_deadline()
+        self.assertEqual(600, run_deadline().budget)
+
+    #
+    def test_broadcast_reports_a_spent_budget(self):
+        start_deadline(1).expires = 0
+        with mock.patch('lib.python.utils.SSH.SSH', side_effect=lambda *args, **kwargs: run_deadline().check('ssh')), \
+                mock.patch.object(Deadline, 'log_report') as log_report:
+            with self.assertRaises(SSHError):
+                SSHBroadcast([('key', '10.0.0.1', 'ubuntu')], 'true').run()
+        log_report.assert_called_once_with()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import os, unittest
+
+from unittest import mock
+from botocore.stub import Stubber
+
+from lib.python.utils import aws_client
+from lib.python.utils.Inventory import NodeIndex
+
+
+ENVIRON = {
+    'AWS_DEFAULT_REGION': 'us-east-2',
+    'AWS_ACCESS_KEY_ID': 'test',
+    'AWS_SECRET_ACCESS_KEY': 'test',
+}
+
+
+#
+def _instance(instance_id, name, state):
+    return {'InstanceId': instance_id,
+            'State': {'Name': state},
+            'Tags': [{'Key': 'Name', 'Value': name}]}
+
+
+#
+class NodeIndexTest(unittest.TestCase):
+
+    #
+    def setUp(self):
+        self.environ = mock.patch.dict(os.environ, ENVIRON)
+        self.environ.start()
+        self.stubber = Stubber(aws_client('ec2', 'us-east-2'))
+        self.index = NodeIndex('us-east-2', 'ci-')
+
+    #
+    def tearDown(self):
+        self.environ.stop()
+
+    #
+    def describe(self, *instances):
+        self.stubber.add_response('describe_instances', {'Reservations': [{'Instances': list(instances)}]})
+
+    #
+    def test_pending_node_is_described_again_once_running_is_wanted(self):
+        self.describe(_instance('i-1', 'ci-server0', 'pending'))
+        self.describe(_instance('i-1', 'ci-server0', 'running'))
+
+        with self.stubber:
+            self.assertEqual('pending', self.index.get('ci-server0').state)
+            self.assertEqual('i-1', self.index.get('ci-server0', states=['running']).id)
+            self.stubber.assert_no_pending_responses()
+
+    #
+    def test_stable_entries_and_misses_are_cached(self):
+        self.describe(_instance('i-1', 'ci-server0', 'running'))
+        # the first miss describes the run again
+        self.describe(_instance('i-1', 'ci-server0', 'running'))
+
+        with self.stubber:
+            self.assertEqual('i-1', self.index.get('ci-server0').id)
+            self.assertEqual('i-1', self.index.get('ci-server0', states=['running']).id)
+            self.assertIsNone(self.index.get('ci-agent0'))
+            self.assertIsNone(self.index.get('ci-agent0'))
+            self.stubber.assert_no_pending_responses()
+
+    #
+    def test_entries_expire(self):
+        self.describe()
+        self.describe(_instance('i-2', 'ci-agent0', 'running'))
+
+        with self.stubber, mock.patch('lib.python.utils.Inventory.time.time') as clock:
+            clock.return_value = 1000.0
+            self.assertIsNone(self.index.get('ci-agent0'))
+            clock.return_value = 1100.0
+            self.assertEqual('i-2', self.index.get('ci-agent0').id)
+            self.stubber.assert_no_pending_responses()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import os, unittest
+
+from unittest import mock
+from botocore.stub import ANY, Stubber
+
+from lib.python.utils import aws_client
+from lib.python.utils.Lock import ExpiringLock, TagLock
+
+
+NOW = 1500000000.0
+
+ENVIRON = {
+    'AWS_DEFAULT_REGION': 'us-east-2',
+    'AWS_ACCESS_KEY_ID': 'test',
+    'AWS_SECRET_ACCESS_KEY': 'test',
+}
+
+
+#
+class TagLockTest(unittest.TestCase):
+
+    #
+    def setUp(self):
+        self.environ = mock.patch.dict(os.environ, ENVIRON)
+        self.environ.start()
+        self.stubber = Stubber(aws_client('ec2', 'us-east-2'))
+        self.lock = TagLock('vpc-1', 'rancher.ci.lock.test', 'us-east-2', holder='build-2', ttl=60)
+
+        self.clock = mock.patch('lib.python.utils.Lock.time')
+        clock = self.clock.start()
+        clock.time.return_value = NOW
+
+    #
+    def tearDown(self):
+        self.clock.stop()
+        self.environ.stop()
+
+    #
+    def tags(self, *values):
+        self.stubber.add_response('describe_tags', {'Tags': [
+            {'ResourceId': 'vpc-1', 'ResourceType': 'vpc', 'Key': 'rancher.ci.lock.test', 'Value': v} for v in values]})
+
+    #
+    def test_base_class_is_abstract(self):
+        with self.assertRaises(TypeError):
+            ExpiringLock('test')
+
+    #
+    def test_takes_over_an_expired_lock(self):
+        self.tags('build-1|{:.0f}'.format(NOW - 10))
+        self.tags('build-1|{:.0f}'.format(NOW - 10))
+        self.stubber.add_response('create_tags', {}, {'Resources': ['vpc-1'], 'Tags': ANY})
+        self.tags('build-2|{:.0f}'.format(NOW + 60))
+
+        with self.stubber:
+            self.assertTrue(self.lock.try_acquire())
+            self.stubber.assert_no_pending_responses()
+
+    #
+    def test_does_not_write_a_lock_taken_meanwhile(self):
+        self.tags('build-1|{:.0f}'.format(NOW - 10))
+        # build-3 took over the expired lock between our two reads
+        self.tags('build-3|{:.0f}'.format(NOW + 60))
+
+        with self.stubber:
+            self.assertFalse(self.lock.try_acquire())
+            self.stubber.assert_no_pending_responses()
+
+
+if __name__ == '__main__':
+    unittest.main()
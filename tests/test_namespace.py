@@ -0,0 +1,46 @@
+import os, shutil, tempfile, unittest
+
+from unittest import mock
+
+from lib.python.utils.Namespace import allocate_run_id, run_id
+from lib.python.utils.RunConfig import RunConfig
+
+
+#
+class RunIdTest(unittest.TestCase):
+
+    #
+    def setUp(self):
+        self.workspace = tempfile.mkdtemp()
+        self.environ = mock.patch.dict(os.environ, {'WORKSPACE_DIR': self.workspace, 'BUILD_NUMBER': '42'})
+        self.environ.start()
+        os.environ.pop('RANCHER_CI_RUN_ID', None)
+
+    #
+    def tearDown(self):
+        self.environ.stop()
+        shutil.rmtree(self.workspace)
+
+    #
+    def test_reading_never_allocates(self):
+        self.assertIsNone(run_id())
+        self.assertIsNone(RunConfig.from_environ().run_id)
+        self.assertEqual([], os.listdir(self.workspace))
+
+    #
+    def test_allocated_once_per_build(self):
+        allocated = allocate_run_id()
+        self.assertEqual(['run_id.42'], os.listdir(self.workspace))
+        self.assertEqual(allocated, allocate_run_id())
+        self.assertEqual(allocated, RunConfig.from_environ().run_id)
+
+    #
+    def test_environment_wins(self):
+        with mock.patch.dict(os.environ, {'RANCHER_CI_RUN_ID': 'abc123'}):
+            self.assertEqual('abc123', allocate_run_id())
+            self.assertEqual('abc123', run_id())
+        self.assertEqual([], os.listdir(self.workspace))
+
+
+if __name__ == '__main__':
+    unittest.main()
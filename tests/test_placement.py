@@ -0,0 +1,103 @@
+import os, shutil, tempfile, unittest
+
+import boto3
+from botocore.stub import Stubber
+
+from lib.python.utils.Placement import PlacementScheduler, PlacementError
+
+
+#
+def _ec2():
+    return boto3.client('ec2', region_name='us-east-2', aws_access_key_id='test', aws_secret_access_key='test')
+
+
+#
+class PlacementSchedulerTest(unittest.TestCase):
+
+    #
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.ec2 = _ec2()
+        self.stubber = Stubber(self.ec2)
+        self.scheduler = PlacementScheduler('us-east-2', [('a', 'subnet-a'), ('b', 'subnet-b'), ('c', 'subnet-c')],
+                                            statsfile=os.path.join(self.tmpdir, 'placement.json'))
+
+    #
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    #
+    def launch(self, instance_type, zone, subnet):
+        return self.ec2.run_instances(ImageId='ami-12345678', InstanceType=instance_type, SubnetId=subnet,
+                                      MinCount=1, MaxCount=1)['Instances'][0]['InstanceId']
+
+    #
+    def expect_capacity_error(self, instance_type, subnet):
+        self.stubber.add_client_error('run_instances', 'InsufficientInstanceCapacity', 'no capacity',
+                                      expected_params={'ImageId': 'ami-12345678', 'InstanceType': instance_type,
+                                                       'SubnetId': subnet, 'MinCount': 1, 'MaxCount': 1})
+
+    #
+    def expect_launch(self, instance_type, subnet, instance_id):
+        self.stubber.add_response('run_instances', {'Instances': [{'InstanceId': instance_id}]},
+                                  {'ImageId': 'ami-12345678', 'InstanceType': instance_type,
+                                   'SubnetId': subnet, 'MinCount': 1, 'MaxCount': 1})
+
+    #
+    def test_fails_over_to_next_zone(self):
+        self.expect_capacity_error('m4.large', 'subnet-a')
+        self.expect_launch('m4.large', 'subnet-b', 'i-b1')
+
+        with self.stubber:
+            result, placement = self.scheduler.launch('agent0', 'm4.large', self.launch)
+            self.stubber.assert_no_pending_responses()
+
+        self.assertEqual(('i-b1', ('b', 'subnet-b')), (result, placement))
+        self.assertEqual({'us-east-2b/m4.large': 1}, self.scheduler.summary())
+
+    #
+    def test_exhausted_zone_is_skipped_and_launches_rotate(self):
+        self.expect_capacity_error('m4.large', 'subnet-a')
+        self.expect_launch('m4.large', 'subnet-b', 'i-b1')
+        self.expect_launch('m4.large', 'subnet-c', 'i-c1')
+        self.expect_launch('m4.large', 'subnet-b', 'i-b2')
+
+        with self.stubber:
+            placed = [self.scheduler.launch("agent{}".format(i), 'm4.large', self.launch)[1][0] for i in range(3)]
+            self.stubber.assert_no_pending_responses()
+
+        self.assertEqual(['b', 'c', 'b'], placed)
+
+    #
+    def test_falls_back_to_next_instance_type(self):
+        for subnet in ['subnet-a', 'subnet-b', 'subnet-c']:
+            self.expect_capacity_error('m5.large', subnet)
+        self.expect_launch('m4.large', 'subnet-a', 'i-a1')
+
+        with self.stubber:
+            result, placement = self.scheduler.launch('agent0', 'm5.large,m4.large', self.launch)
+
+        self.assertEqual(('i-a1', ('a', 'subnet-a')), (result, placement))
+
+    #
+    def test_no_capacity_anywhere(self):
+        for subnet in ['subnet-a', 'subnet-b', 'subnet-c']:
+            self.expect_capacity_error('m4.large', subnet)
+
+        with self.stubber:
+            with self.assertRaises(PlacementError):
+                self.scheduler.launch('agent0', 'm4.large', self.launch)
+
+    #
+    def test_other_errors_are_not_failed_over(self):
+        self.stubber.add_client_error('run_instances', 'InvalidAMIID.NotFound', 'no such image')
+
+        with self.stubber:
+            with self.assertRaises(Exception) as raised:
+                self.scheduler.launch('agent0', 'm4.large', self.launch)
+
+        self.assertEqual('InvalidAMIID.NotFound', raised.exception.response['Error']['Code'])
+
+
+if __name__ == '__main__':
+    unittest.main()
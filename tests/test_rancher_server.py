@@ -0,0 +1,124 @@
+import os, json, time, threading, unittest
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import mock
+
+from lib.python.utils.RancherServer import RancherServer, RancherServerError
+from lib.python.utils.RunConfig import RunConfig
+
+
+ENVIRON = {
+    'AWS_ACCESS_KEY_ID': 'test',
+    'AWS_SECRET_ACCESS_KEY': 'test',
+    'AWS_DEFAULT_REGION': 'us-east-2',
+    'AWS_TAGS': 'is_ci,true',
+    'AWS_VPC_ID': 'vpc-test',
+    'AWS_SUBNET_ID': 'subnet-test',
+    'AWS_SECURITY_GROUP_ID': 'sg-test',
+    'AWS_ZONE': 'a',
+    'AWS_INSTANCE_PROFILE': 'test',
+    'RANCHER_SERVER_OPERATINGSYSTEM': 'ubuntu-1604',
+    'RANCHER_VERSION': 'v1.6.14',
+    'RANCHER_DOCKER_VERSION': '17.03',
+    'RANCHER_ORCHESTRATION': 'cattle',
+    'RANCHER_SERVER_AWS_INSTANCE_TYPE': 'm4.large',
+    'RANCHER_CI_RUN_ID': 'test',
+}
+
+
+#
+class StartingServer(BaseHTTPRequestHandler):
+    """
+    rancher/server as it comes up: HTTP 503 until 'up_at', then an API whose
+    settings only become writable at 'ready_at'.
+    """
+
+    up_at = None
+    ready_at = None
+
+    def do_GET(self):
+        now = time.time()
+        if now < self.up_at:
+            return self.answer(503, {'message': 'starting'})
+
+        methods = ['GET', 'PUT'] if now >= self.ready_at else ['GET']
+        if self.path.endswith('/schemas'):
+            return self.answer(200, {'data': [{'id': 'setting', 'resourceMethods': methods}]})
+        return self.answer(200, {'type': 'apiRoot'})
+
+    def answer(self, status, body):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+#
+class LocalRancherServer(RancherServer):
+
+    base = None
+
+    def base_url(self):
+        return self.base
+
+
+#
+class ReadinessProbeTest(unittest.TestCase):
+
+    #
+    def setUp(self):
+        self.environ = mock.patch.dict(os.environ, ENVIRON)
+        self.environ.start()
+
+        self.httpd = HTTPServer(('127.0.0.1', 0), StartingServer)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+        self.server = LocalRancherServer(RunConfig.from_environ())
+        self.server.base = "http://127.0.0.1:{}".format(self.httpd.server_port)
+
+    #
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.environ.stop()
+
+    #
+    def starts(self, up_after, ready_after):
+        now = time.time()
+        StartingServer.up_at = now + up_after
+        StartingServer.ready_at = now + ready_after
+
+    #
+    def wait(self, timeout):
+        return self.server._RancherServer__wait_for_api_provider(timeout=timeout)
+
+    #
+    def test_ready_once_settings_are_writable(self):
+        self.starts(up_after=1.0, ready_after=2.0)
+
+        time_to_ready = self.wait(timeout=30)
+
+        self.assertGreaterEqual(time_to_ready, 2.0)
+        self.assertLess(time_to_ready, 5.0)
+
+    #
+    def test_ready_server_answers_at_once(self):
+        self.starts(up_after=0, ready_after=0)
+
+        self.assertLess(self.wait(timeout=30), 0.5)
+
+    #
+    def test_times_out_while_unavailable(self):
+        self.starts(up_after=60, ready_after=60)
+
+        with self.assertRaises(RancherServerError):
+            self.wait(timeout=1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,217 @@
+import os, shutil, tempfile, unittest
+
+import boto3
+from botocore.awsrequest import AWSResponse
+from botocore.exceptions import ClientError
+from botocore.stub import Stubber
+
+from lib.python.utils.Placement import PlacementScheduler
+from lib.python.utils.RateLimit import TokenBucket, RateLimiter, RateLimitError, ThrottledClient
+
+
+#
+def _ec2():
+    return boto3.client('ec2', region_name='us-east-2', aws_access_key_id='test', aws_secret_access_key='test')
+
+
+#
+def _instances(state):
+    return {'Reservations': [{'Instances': [{'InstanceId': 'i-1', 'State': {'Name': state, 'Code': 0}}]}]}
+
+
+#
+class FakeClock(object):
+    """
+    Time which only moves when somebody sleeps.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+#
+class ThrottlingStub(object):
+    """
+    Stands in for EC2 on 'client': answers every call, but with RequestLimitExceeded
+    once more than 'limit' calls arrive within one second of the fake clock.
+    """
+
+    def __init__(self, client, clock, limit):
+        self.clock = clock
+        self.limit = limit
+        self.calls = []
+        self.throttled = 0
+        client.meta.events.register_first('before-call.ec2.*', self.answer)
+
+    def answer(self, model, **kwargs):
+        now = self.clock()
+        self.calls = [t for t in self.calls if t > now - 1.0] + [now]
+        if len(self.calls) > self.limit:
+            self.throttled += 1
+            return (AWSResponse(None, 503, {}, None),
+                    {'Error': {'Code': 'RequestLimitExceeded', 'Message': 'Request limit exceeded.'},
+                     'ResponseMetadata': {'HTTPStatusCode': 503}})
+        return (AWSResponse(None, 200, {}, None), {'ResponseMetadata': {'HTTPStatusCode': 200}})
+
+
+#
+class TokenBucketTest(unittest.TestCase):
+
+    #
+    def test_burst_is_free_then_paced_at_rate(self):
+        clock = FakeClock()
+        bucket = TokenBucket(2.0, 3, clock=clock, sleep=clock.sleep)
+
+        waited = [bucket.acquire() for i in range(5)]
+
+        self.assertEqual([0.0, 0.0, 0.0, 0.5, 0.5], waited)
+        self.assertEqual(1.0, clock.now)
+
+    #
+    def test_refills_while_idle_up_to_burst(self):
+        clock = FakeClock()
+        bucket = TokenBucket(1.0, 2, clock=clock, sleep=clock.sleep)
+        bucket.acquire(2)
+
+        clock.now += 10.0
+        self.assertEqual(0.0, bucket.acquire(2))
+        self.assertEqual(1.0, bucket.acquire())
+
+    #
+    def test_rejects_impossible_requests(self):
+        with self.assertRaises(RateLimitError):
+            TokenBucket(0, 1)
+        with self.assertRaises(RateLimitError):
+            TokenBucket(1.0, 2).acquire(3)
+
+    #
+    def test_limiter_keeps_one_bucket_per_action(self):
+        clock = FakeClock()
+        limiter = RateLimiter({'RunInstances': (1.0, 1)}, rate=10.0, burst=1, clock=clock, sleep=clock.sleep)
+
+        limiter.acquire('RunInstances')
+        limiter.acquire('DescribeInstances')
+        limiter.acquire('RunInstances')
+
+        self.assertEqual({'RunInstances': 1.0}, limiter.waited)
+
+
+#
+class ThrottledClientTest(unittest.TestCase):
+
+    #
+    def setUp(self):
+        self.clock = FakeClock()
+        self.ec2 = _ec2()
+
+    #
+    def limiter(self, limits, rate=10.0, burst=1):
+        return RateLimiter(limits, rate=rate, burst=burst, clock=self.clock, sleep=self.clock.sleep)
+
+    #
+    def test_unthrottled_client_hits_request_limit(self):
+        stub = ThrottlingStub(self.ec2, self.clock, limit=3)
+
+        with self.assertRaises(ClientError) as raised:
+            for i in range(10):
+                self.ec2.terminate_instances(InstanceIds=['i-1'])
+
+        self.assertEqual('RequestLimitExceeded', raised.exception.response['Error']['Code'])
+        self.assertEqual(1, stub.throttled)
+
+    #
+    def test_throttled_client_stays_under_request_limit(self):
+        stub = ThrottlingStub(self.ec2, self.clock, limit=3)
+        client = ThrottledClient(self.ec2, self.limiter({'TerminateInstances': (2.0, 2)}))
+
+        for i in range(20):
+            client.terminate_instances(InstanceIds=['i-1'])
+
+        self.assertEqual(0, stub.throttled)
+        self.assertEqual(9.0, self.clock.now)
+
+    #
+    def test_request_limit_errors_reach_the_caller(self):
+        stubber = Stubber(self.ec2)
+        stubber.add_client_error('run_instances', 'RequestLimitExceeded', 'Request limit exceeded.', 503)
+        client = ThrottledClient(self.ec2, self.limiter({}))
+
+        with stubber:
+            with self.assertRaises(ClientError) as raised:
+                client.run_instances(ImageId='ami-12345678', MinCount=1, MaxCount=1)
+
+        self.assertEqual('RequestLimitExceeded', raised.exception.response['Error']['Code'])
+
+    #
+    def test_paginator_takes_a_token_per_page(self):
+        stubber = Stubber(self.ec2)
+        stubber.add_response('describe_instances', dict(_instances('running'), NextToken='page2'))
+        stubber.add_response('describe_instances', _instances('running'))
+        limiter = self.limiter({'DescribeInstances': (1.0, 1)})
+        client = ThrottledClient(self.ec2, limiter)
+
+        with stubber:
+            pages = list(client.get_paginator('describe_instances').paginate())
+            stubber.assert_no_pending_responses()
+
+        self.assertEqual(2, len(pages))
+        self.assertEqual(1.0, limiter.waited['DescribeInstances'])
+
+    #
+    def test_waiter_takes_a_token_per_poll(self):
+        stubber = Stubber(self.ec2)
+        stubber.add_response('describe_instances', _instances('pending'))
+        stubber.add_response('describe_instances', _instances('running'))
+        limiter = self.limiter({'DescribeInstances': (1.0, 1)})
+        client = ThrottledClient(self.ec2, limiter)
+
+        with stubber:
+            client.get_waiter('instance_running').wait(InstanceIds=['i-1'], WaiterConfig={'Delay': 0, 'MaxAttempts': 2})
+            stubber.assert_no_pending_responses()
+
+        self.assertEqual(1.0, limiter.waited['DescribeInstances'])
+
+
+#
+class ThrottledPlacementTest(unittest.TestCase):
+
+    #
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.clock = FakeClock()
+        self.ec2 = _ec2()
+        self.client = ThrottledClient(self.ec2, RateLimiter({'RunInstances': (1.0, 1)}, clock=self.clock, sleep=self.clock.sleep))
+        self.scheduler = PlacementScheduler('us-east-2', [('a', 'subnet-a'), ('b', 'subnet-b')],
+                                            statsfile=os.path.join(self.tmpdir, 'placement.json'))
+
+    #
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    #
+    def test_failover_on_capacity_errors_is_throttled_too(self):
+        stubber = Stubber(self.ec2)
+        stubber.add_client_error('run_instances', 'InsufficientInstanceCapacity', 'no capacity')
+        stubber.add_response('run_instances', {'Instances': [{'InstanceId': 'i-b1'}]})
+
+        def launch(instance_type, zone, subnet):
+            return self.client.run_instances(ImageId='ami-12345678', InstanceType=instance_type, SubnetId=subnet,
+                                             MinCount=1, MaxCount=1)['Instances'][0]['InstanceId']
+
+        with stubber:
+            result, placement = self.scheduler.launch('agent0', 'm4.large', launch)
+
+        self.assertEqual(('i-b1', ('b', 'subnet-b')), (result, placement))
+        self.assertEqual([1.0], self.clock.sleeps)
+
+
+if __name__ == '__main__':
+    unittest.main()
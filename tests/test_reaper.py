@@ -0,0 +1,97 @@
+import os, datetime, unittest
+
+from unittest import mock
+from botocore.stub import Stubber
+
+from lib.python.utils import aws_client
+from lib.python.utils.Lease import GROUP_TAG
+from lib.python.utils.Namespace import RUN_TAG, RUN_EXPIRES_TAG
+from lib.python.utils.Reaper import expire_run, expired_runs, reap_expired_runs
+
+
+NOW = 1500000000.0
+
+ENVIRON = {
+    'AWS_DEFAULT_REGION': 'us-east-2',
+    'AWS_ACCESS_KEY_ID': 'test',
+    'AWS_SECRET_ACCESS_KEY': 'test',
+    'RANCHER_CI_RUN_TTL': '3600',
+}
+
+
+#
+def _instance(instance_id, name, tags, launched=NOW):
+    tags = dict(tags, Name=name)
+    return {'InstanceId': instance_id,
+            'State': {'Name': 'running', 'Code': 16},
+            'LaunchTime': datetime.datetime.fromtimestamp(launched, datetime.timezone.utc),
+            'Tags': [{'Key': k, 'Value': v} for k, v in sorted(tags.items())]}
+
+
+#
+class ReaperTest(unittest.TestCase):
+
+    #
+    def setUp(self):
+        self.environ = mock.patch.dict(os.environ, ENVIRON)
+        self.environ.start()
+        self.ec2 = aws_client('ec2', 'us-east-2')
+        self.stubber = Stubber(self.ec2)
+
+    #
+    def tearDown(self):
+        self.environ.stop()
+
+    #
+    def describe(self, *instances):
+        self.stubber.add_response('describe_instances', {'Reservations': [{'Instances': list(instances)}]})
+
+    #
+    def test_only_runs_without_live_nodes_expire(self):
+        self.describe(
+            # every node past its expiry
+            _instance('i-1', 'dead0-server0', {RUN_TAG: 'dead0', RUN_EXPIRES_TAG: str(NOW - 10)}),
+            _instance('i-2', 'dead0-agent0', {RUN_TAG: 'dead0', RUN_EXPIRES_TAG: str(NOW - 20)}),
+            # one node still live keeps the whole run
+            _instance('i-3', 'live0-server0', {RUN_TAG: 'live0', RUN_EXPIRES_TAG: str(NOW - 10)}),
+            _instance('i-4', 'live0-agent0', {RUN_TAG: 'live0', RUN_EXPIRES_TAG: str(NOW + 10)}),
+            # no expiry tag, so launch time plus RANCHER_CI_RUN_TTL
+            _instance('i-5', 'old0-agent0', {RUN_TAG: 'old0'}, launched=NOW - 7200),
+            _instance('i-6', 'new0-agent0', {RUN_TAG: 'new0'}, launched=NOW - 60),
+            # leased servers and our own run are never reaped
+            _instance('i-7', 'shared-server0', {RUN_TAG: 'lease0', RUN_EXPIRES_TAG: str(NOW - 10), GROUP_TAG: 'ci|cattle'}),
+            _instance('i-8', 'mine0-agent0', {RUN_TAG: 'mine0', RUN_EXPIRES_TAG: str(NOW - 10)}))
+
+        with self.stubber:
+            runs = expired_runs('us-east-2', keep='mine0', now=NOW)
+
+        self.assertEqual({'dead0': ['i-1', 'i-2'], 'old0': ['i-5']},
+                         dict((run, sorted(r.id for r in records)) for run, records in runs.items()))
+
+    #
+    def test_reaps_nodes_and_key_pairs(self):
+        self.describe(_instance('i-1', 'ci-dead0-server0', {RUN_TAG: 'dead0', RUN_EXPIRES_TAG: '1'}))
+        self.stubber.add_response('terminate_instances', {}, {'InstanceIds': ['i-1']})
+        self.stubber.add_response('describe_key_pairs', {'KeyPairs': [{'KeyName': 'ci-dead0-rancher-ci'}]},
+                                  {'Filters': [{'Name': 'key-name', 'Values': ['*dead0-rancher-ci']}]})
+        self.stubber.add_response('delete_key_pair', {}, {'KeyName': 'ci-dead0-rancher-ci'})
+
+        with self.stubber:
+            reaped = reap_expired_runs('us-east-2', keep='mine0')
+            self.stubber.assert_no_pending_responses()
+
+        self.assertEqual({'runs': 1, 'nodes': 1, 'keypairs': 1}, reaped)
+
+    #
+    def test_expires_the_nodes_of_a_failed_run(self):
+        self.describe(_instance('i-1', 'ci-fail0-server0', {RUN_TAG: 'fail0', RUN_EXPIRES_TAG: str(NOW + 3600)}),
+                      _instance('i-2', 'shared-server0', {RUN_TAG: 'fail0', GROUP_TAG: 'ci|cattle'}))
+        self.stubber.add_response('create_tags', {}, {'Resources': ['i-1'], 'Tags': [{'Key': RUN_EXPIRES_TAG, 'Value': '{:.0f}'.format(NOW)}]})
+
+        with self.stubber, mock.patch('lib.python.utils.Reaper.time.time', return_value=NOW):
+            self.assertEqual(1, expire_run('fail0', 'us-east-2'))
+            self.stubber.assert_no_pending_responses()
+
+
+if __name__ == '__main__':
+    unittest.main()